@@ -1,138 +1,222 @@
+import sys
+
+if __name__ == "__main__" and "--profile-startup" in sys.argv[1:]:
+    # Profile a fresh interpreter's import of this module, before this one
+    # pays for the imports below.
+    from startup_profile import main
+
+    sys.exit(main(sys.argv[1:]))
+
 import dash
 from dash import Dash, html, dcc, Input, Output, State
 import json
+import logging
+from flask_compress import Compress
+
+from background import background_callback_manager
+from base import settings
+from error_rollup import start_rollup_refresher
+from export import export_bp
+from metrics import callback, instrument_app
+from query_log import start_slow_query_explainer
+from tenant_directory import start_tenant_directory_refresher
 
 
 with open('users.json', 'r') as f:
     users = json.load(f)
 
 
-app = Dash(__name__, use_pages=True, suppress_callback_exceptions=True)
-
-login_layout = html.Div(
-    style={
-        "display": "flex",
-        "flexDirection": "column",
-        "alignItems": "center",
-        "justifyContent": "center",
-        "height": "100vh",
-        "backgroundColor": "#f4f4f4",
-        "fontFamily": "Arial, sans-serif"
-    },
-    children=[
-        html.Div(
-            style={
-                "backgroundColor": "#ffffff",
-                "padding": "30px",
-                "borderRadius": "10px",
-                "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)",
-                "textAlign": "center",
-                "maxWidth": "400px",
-                "width": "100%"
-            },
-            children=[
-                html.Img(
-                    src="/assets/logo.jpeg",  
-                    style={
-                        "width": "100px",
-                        "marginBottom": "20px"
-                    }
-                ),
-                html.H1(
-                    "Login to We360.ai Internal Portal",
-                    style={
-                        "color": "#333",
-                        "fontSize": "24px",
-                        "marginBottom": "20px"
-                    }
-                ),
-                dcc.Input(
-                    id='username',
-                    type='text',
-                    placeholder='Enter username',
-                    style={
-                        "width": "100%",
-                        "padding": "10px",
-                        "marginBottom": "10px",
-                        "border": "1px solid #ccc",
-                        "borderRadius": "5px"
-                    }
-                ),
-                dcc.Input(
-                    id='password',
-                    type='password',
-                    placeholder='Enter password',
-                    style={
-                        "width": "100%",
-                        "padding": "10px",
-                        "marginBottom": "20px",
-                        "border": "1px solid #ccc",
-                        "borderRadius": "5px"
-                    }
-                ),
-                html.Button(
-                    'Login',
-                    id='login-button',
-                    n_clicks=0,
-                    style={
-                        "backgroundColor": "#4CAF50",
-                        "color": "white",
-                        "padding": "10px 20px",
-                        "border": "none",
-                        "borderRadius": "5px",
-                        "cursor": "pointer",
-                        "fontSize": "16px"
-                    }
-                ),
-                html.Div(
-                    id='login-status',
-                    style={
-                        "color": "red",
-                        "marginTop": "10px",
-                        "fontSize": "14px"
-                    }
-                )
-            ]
-        )
-    ]
+app = Dash(
+    __name__,
+    use_pages=True,
+    suppress_callback_exceptions=True,
+    background_callback_manager=background_callback_manager,
 )
+app.server.register_blueprint(export_bp)
 
-dashboard_layout = html.Div(
-    [
-        html.H1("Internal Dashboard for We360.ai"),
-        html.Div(
-            [
-                html.Div(
-                    dcc.Link(
-                        f"{page['name']} - {page['path']}", href=page["relative_path"]
-                    )
-                )
-                for page in dash.page_registry.values()
-                if not page.get("is_fallback", False)
-            ]
-        ),
-        dash.page_container,
-    ]
+# Set up here rather than through Dash(compress=True), which restricts
+# flask-compress to gzip: Brotli is markedly smaller on callback JSON.
+app.server.config.update(
+    COMPRESS_ALGORITHM=["br", "gzip"],
+    COMPRESS_BR_LEVEL=4,
+    COMPRESS_MIMETYPES=[
+        "application/json",
+        "application/javascript",
+        "text/javascript",
+        "text/css",
+        "text/html",
+        "text/csv",
+    ],
+    COMPRESS_REGISTER=False,
 )
+compress = Compress(app.server)
+
+
+@app.server.after_request
+def compress_response(response):
+    # RESPONSE_COMPRESSION is read on the first response rather than at
+    # import, so importing the app needs no settings.
+    if settings.RESPONSE_COMPRESSION:
+        return compress.after_request(response)
+    return response
+
+
+def login_layout():
+    return html.Div(
+        style={
+            "display": "flex",
+            "flexDirection": "column",
+            "alignItems": "center",
+            "justifyContent": "center",
+            "height": "100vh",
+            "backgroundColor": "#f4f4f4",
+            "fontFamily": "Arial, sans-serif"
+        },
+        children=[
+            html.Div(
+                style={
+                    "backgroundColor": "#ffffff",
+                    "padding": "30px",
+                    "borderRadius": "10px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)",
+                    "textAlign": "center",
+                    "maxWidth": "400px",
+                    "width": "100%"
+                },
+                children=[
+                    html.Img(
+                        src="/assets/logo.jpeg",  
+                        style={
+                            "width": "100px",
+                            "marginBottom": "20px"
+                        }
+                    ),
+                    html.H1(
+                        "Login to We360.ai Internal Portal",
+                        style={
+                            "color": "#333",
+                            "fontSize": "24px",
+                            "marginBottom": "20px"
+                        }
+                    ),
+                    dcc.Input(
+                        id='username',
+                        type='text',
+                        placeholder='Enter username',
+                        style={
+                            "width": "100%",
+                            "padding": "10px",
+                            "marginBottom": "10px",
+                            "border": "1px solid #ccc",
+                            "borderRadius": "5px"
+                        }
+                    ),
+                    dcc.Input(
+                        id='password',
+                        type='password',
+                        placeholder='Enter password',
+                        style={
+                            "width": "100%",
+                            "padding": "10px",
+                            "marginBottom": "20px",
+                            "border": "1px solid #ccc",
+                            "borderRadius": "5px"
+                        }
+                    ),
+                    html.Button(
+                        'Login',
+                        id='login-button',
+                        n_clicks=0,
+                        style={
+                            "backgroundColor": "#4CAF50",
+                            "color": "white",
+                            "padding": "10px 20px",
+                            "border": "none",
+                            "borderRadius": "5px",
+                            "cursor": "pointer",
+                            "fontSize": "16px"
+                        }
+                    ),
+                    html.Div(
+                        id='login-status',
+                        style={
+                            "color": "red",
+                            "marginTop": "10px",
+                            "fontSize": "14px"
+                        }
+                    )
+                ]
+            )
+        ]
+    )
+
 
-app.layout = html.Div(id='main-layout', children=[login_layout])
+def dashboard_layout():
+    return html.Div(
+        [
+            html.H1("Internal Dashboard for We360.ai"),
+            html.Div(
+                [
+                    html.Div(
+                        dcc.Link(
+                            f"{page['name']} - {page['path']}", href=page["relative_path"]
+                        )
+                    )
+                    for page in dash.page_registry.values()
+                    if not page.get("is_fallback", False)
+                ]
+            ),
+            dash.page_container,
+        ]
+    )
+
+
+def main_layout():
+    return html.Div([
+        # Identifies the logged-in user to background callbacks (per-user job cap).
+        dcc.Store(id='current-user', storage_type='session'),
+        html.Div(id='main-layout', children=[login_layout()]),
+    ])
 
 
-@app.callback(
-    Output('main-layout', 'children'),
+# Layouts are built per page load rather than at import time.
+app.layout = main_layout
+
+
+@callback(
+    [Output('main-layout', 'children'), Output('current-user', 'data')],
     [Input('login-button', 'n_clicks')],
     [State('username', 'value'), State('password', 'value')]
 )
 def check_credentials(n_clicks, username, password):
     if n_clicks > 0:
         if username in users and users[username] == password:
-            return dashboard_layout
+            return dashboard_layout(), username
         else:
             return html.Div([
-                login_layout,
+                login_layout(),
                 html.Div("Invalid username or password. Please try again.", style={'color': 'red'})
-            ])
-    return login_layout
+            ]), None
+    return login_layout(), None
+
+
+instrument_app(app)
+server = app.server
+
+
+def start_background_refreshers():
+    """
+    Keep the tenant directory and error rollup current, and explain sampled slow queries, from daemon threads.
+
+    Threads do not survive fork(), so a preforking server calls this in each
+    worker (see ``serve.py``) rather than at import time.
+    """
+    start_tenant_directory_refresher()
+    start_rollup_refresher()
+    start_slow_query_explainer()
+
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    start_background_refreshers()
     app.run(debug=True)
@@ -0,0 +1,117 @@
+import functools
+import os
+import threading
+
+import diskcache
+import psutil
+from dash import DiskcacheManager
+from dash.long_callback.managers import BaseLongCallbackManager
+
+from base import settings
+
+TOO_MANY_JOBS_MESSAGE = "Too many queries are already running for your session. Please wait for one to finish."
+
+# Pages cancel their running jobs when the user navigates away; the id is the
+# dcc.Location inside dash.page_container.
+PAGE_LOCATION = "_pages_location"
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_background_cache() -> diskcache.Cache:
+    """
+    Return the cache in ``BACKGROUND_CACHE_DIR`` holding job results and slots, opening it on first use.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = diskcache.Cache(settings.BACKGROUND_CACHE_DIR)
+    return _cache
+
+
+class _BackgroundCacheProxy:
+    """Forwards to ``get_background_cache()``; what the manager and its jobs hold instead of the cache."""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(get_background_cache(), name)
+
+
+class LazyDiskcacheManager(DiskcacheManager):
+    """
+    ``DiskcacheManager`` over ``get_background_cache()``.
+
+    Dash hands the manager's cache to every background callback as it is
+    registered, at import; here that is a proxy, and the cache and
+    ``BACKGROUND_RESULT_EXPIRE`` are only read once a background callback
+    runs, so the app can be imported without the settings.
+    """
+
+    def __init__(self, cache_by=None):
+        # DiskcacheManager.__init__ wants an open diskcache.Cache; skip to the base.
+        self.handle = _BackgroundCacheProxy()
+        BaseLongCallbackManager.__init__(self, cache_by)
+
+    @property
+    def expire(self) -> int:
+        return settings.BACKGROUND_RESULT_EXPIRE
+
+
+background_callback_manager = LazyDiskcacheManager()
+
+
+def _job_key(user) -> str:
+    return f"background-jobs:{user or 'anonymous'}"
+
+
+def _acquire_job_slot(user) -> bool:
+    key = _job_key(user)
+    cache = get_background_cache()
+    with diskcache.Lock(cache, f"{key}:lock"):
+        # Cancelled jobs are killed outright, so slots are tracked by pid and
+        # dead pids are dropped instead of relying on a release that never ran.
+        pids = [pid for pid in cache.get(key, []) if psutil.pid_exists(pid)]
+        if len(pids) >= settings.BACKGROUND_MAX_JOBS_PER_USER:
+            cache.set(key, pids)
+            return False
+        pids.append(os.getpid())
+        cache.set(key, pids)
+        return True
+
+
+def _release_job_slot(user) -> None:
+    key = _job_key(user)
+    cache = get_background_cache()
+    with diskcache.Lock(cache, f"{key}:lock"):
+        cache.set(key, [pid for pid in cache.get(key, []) if pid != os.getpid()])
+
+
+def limit_jobs_per_user(on_limit):
+    """
+    Cap how many background callback jobs one user can have running at once.
+
+    The decorated callback must take the ``current-user`` store as its last
+    argument. When the user is at ``settings.BACKGROUND_MAX_JOBS_PER_USER``,
+    the callback is skipped and ``on_limit()`` supplies its return value.
+
+    Args:
+    - on_limit (callable): Returns the callback outputs to use when the cap is hit.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args):
+            user = args[-1]
+            if not _acquire_job_slot(user):
+                return on_limit()
+            try:
+                return fn(*args)
+            finally:
+                _release_job_slot(user)
+
+        return wrapper
+
+    return decorator
@@ -1,3 +1,6 @@
+import threading
+from typing import Optional
+
 try:
     from pydantic_settings import BaseSettings, SettingsConfigDict
 except ImportError:
@@ -16,6 +19,71 @@ class Settings(BaseSettings):
     CH_DB_USER: str
     CH_DB_HOST: str
 
+    PG_POOL_MIN_SIZE: int = 1
+    PG_POOL_MAX_SIZE: int = 10
+    PG_POOL_TIMEOUT: float = 30.0
+    PG_POOL_IDLE_TIMEOUT: float = 300.0
+    PG_POOL_HEALTH_CHECK_INTERVAL: float = 30.0
+    CH_POOL_MAX_IDLE_PER_DATABASE: int = 4
+    CH_POOL_MAX_IDLE: int = 32
+    CH_POOL_IDLE_TIMEOUT: float = 300.0
+    CH_STREAM_BLOCK_SIZE: int = 65536
+    CH_FANOUT_MAX_WORKERS: int = 16
+    CH_FANOUT_TIMEOUT: float = 10.0
+    QUERY_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    QUERY_CACHE_TTL: float = 60.0
+    QUERY_CACHE_WATERMARK_INTERVAL: float = 2.0
+    QUERY_CACHE_BACKEND: str = "memory"
+    QUERY_CACHE_DIR: str = "./.cache/query"
+    QUERY_COALESCING: bool = True
+    BACKGROUND_CACHE_DIR: str = "./.cache/background"
+    BACKGROUND_RESULT_EXPIRE: int = 600
+    BACKGROUND_MAX_JOBS_PER_USER: int = 2
+    EXPORT_CHUNK_SIZE: int = 10000
+    RESPONSE_COMPRESSION: bool = True
+    ROLLUP_REFRESH_INTERVAL: float = 10.0
+    ROLLUP_RETENTION_DAYS: Optional[int] = 90
+    ROLLUP_BATCH_SIZE: int = 50000
+    TENANT_DIRECTORY_REFRESH_INTERVAL: float = 60.0
+    TENANT_HISTORY_CACHE_TENANTS: int = 32
+    TENANT_HISTORY_CACHE_TTL: float = 60.0
+    TREND_POINT_BUDGET: int = 500
+    LIVE_REFRESH_INTERVAL: float = 5.0
+    LIVE_REFRESH_MAX_INTERVAL: float = 60.0
+    LIVE_REFRESH_WINDOW: int = 500
+    LIVE_REFRESH_BATCH_SIZE: int = 200
+    FRESHNESS_EVENTS_TABLE: str = "events"
+    FRESHNESS_TIMESTAMP_COLUMN: str = "timestamp"
+    FRESHNESS_LOOKBACK_DAYS: int = 7
+    FRESHNESS_STALE_MINUTES: int = 60
+    METRICS_DIR: str = "./.cache/metrics"
+    METRICS_SNAPSHOT_INTERVAL: float = 5.0
+    SERVER_BIND: str = "0.0.0.0:8050"
+    SERVER_WORKERS: int = 4
+    SERVER_THREADS: int = 4
+    SERVER_TIMEOUT: int = 120
+    SERVER_GRACEFUL_TIMEOUT: int = 30
+    SERVER_PRELOAD: bool = True
+    SERVER_MAX_REQUESTS: int = 0
+    SLOW_QUERY_THRESHOLD: float = 1.0
+    SLOW_QUERY_EXPLAIN_SAMPLE_RATE: float = 0.1
+    SLOW_QUERY_EXPLAIN_INTERVAL: float = 600.0
+    SLOW_QUERY_EXPLAIN_TIMEOUT: float = 60.0
+    ANALYTICS_SOURCE: str = "postgres"
+    SNAPSHOT_DIR: str = "./.cache/snapshot"
+    SNAPSHOT_INTERVAL: float = 300.0
+    SNAPSHOT_BATCH_SIZE: int = 200000
+    SNAPSHOT_COMPACT_FILES: int = 24
+    HEALTH_STATE_PATH: str = "./.cache/health/state.npz"
+    HEALTH_CHECK_INTERVAL: float = 60.0
+    HEALTH_BATCH_SIZE: int = 50000
+    HEALTH_WARMUP_DAYS: int = 7
+    HEALTH_EWMA_ALPHA: float = 0.05
+    HEALTH_ANOMALY_Z: float = 4.0
+    HEALTH_MIN_RUNS: int = 20
+    HEALTH_STALE_MIN_SECONDS: float = 900.0
+    HEALTH_ALERT_RECIPIENTS: str = ""
+
     SMTP_HOST: str
     SMTP_PASSWORD: str
     SMTP_PORT: int
@@ -39,4 +107,31 @@ class Settings(BaseSettings):
             env_file = "./.env"
 
 
-settings = Settings()
+class _LazySettings:
+    """
+    Stand-in for ``Settings()`` that reads and validates the environment on first use.
+
+    Importing a module that does ``from base import settings`` stays cheap and
+    does not need a complete environment; a missing or invalid variable is
+    reported where a setting is first read.
+    """
+
+    def __init__(self):
+        self._settings = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Settings:
+        if self._settings is None:
+            with self._lock:
+                if self._settings is None:
+                    self._settings = Settings()
+        return self._settings
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self) -> str:
+        return repr(self._settings) if self._settings is not None else "<settings not loaded>"
+
+
+settings = _LazySettings()
@@ -0,0 +1,71 @@
+"""
+Micro-benchmark: per-row ``convert_to_ist`` vs. the vectorized ``results`` pipeline.
+
+Run from the repository root:
+
+    python benchmarks/bench_ist_formatting.py --rows 100000
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+import pytz
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from results import format_datetime_columns  # noqa: E402
+
+COLUMNS = ["finished_at", "last_event_timestamp", "first_event_timestamp"]
+
+
+def make_frame(rows: int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    start = pd.Timestamp("2024-01-01").value
+    end = pd.Timestamp("2025-01-01").value
+    return pd.DataFrame(
+        {column: pd.to_datetime(rng.integers(start, end, rows)).to_pydatetime() for column in COLUMNS}
+    )
+
+
+def legacy(df: pd.DataFrame) -> pd.DataFrame:
+    """The per-row path both pages used before ``results.format_datetime_columns``."""
+    ist = pytz.timezone("Asia/Kolkata")
+
+    def convert_to_ist(dt):
+        if dt.tzinfo is None:
+            return dt.tz_localize("UTC").tz_convert(ist)
+        else:
+            return dt.tz_convert(ist)
+
+    for column in COLUMNS:
+        df[column] = pd.to_datetime(df[column]).apply(convert_to_ist)
+    for column in COLUMNS:
+        df[column] = df[column].dt.strftime("%Y-%m-%d %H:%M:%S")
+    return df
+
+
+def vectorized(df: pd.DataFrame) -> pd.DataFrame:
+    return format_datetime_columns(df, columns=COLUMNS)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    df = make_frame(args.rows)
+    assert legacy(df.copy()).equals(vectorized(df.copy())), "outputs differ"
+
+    timings = {}
+    for name, fn in (("legacy", legacy), ("vectorized", vectorized)):
+        timings[name] = min(timeit.repeat(lambda: fn(df.copy()), number=1, repeat=args.repeat))
+        print(f"{name:>10}: {timings[name] * 1000:9.1f} ms for {args.rows} rows")
+    print(f"{'speedup':>10}: {timings['legacy'] / timings['vectorized']:9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
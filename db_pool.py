@@ -0,0 +1,420 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from lazy_imports import lazy_import
+
+# Only needed once a query runs; importing them costs more than the rest of the module.
+psycopg2 = lazy_import("psycopg2")
+sql = lazy_import("psycopg2.sql")
+clickhouse_driver = lazy_import("clickhouse_driver")
+ch_errors = lazy_import("clickhouse_driver.errors")
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available within the timeout."""
+
+
+class _PooledConnection:
+    __slots__ = ("conn", "created_at", "last_used_at", "search_path")
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used_at = now
+        self.search_path = None
+
+
+class PostgresPool:
+    """
+    Thread-safe, process-wide pool of PostgreSQL connections.
+
+    Connections are reused across callbacks, checked with ``SELECT 1`` when
+    they have been idle longer than ``health_check_interval`` and closed once
+    they have been idle longer than ``idle_timeout`` (never going below
+    ``min_size``). The ``search_path`` is switched on checkout, and only when
+    it differs from the one the connection already has.
+
+    Args:
+    - min_size (int): Connections kept open even when idle.
+    - max_size (int): Upper bound on open connections.
+    - timeout (float): Seconds to wait for a free connection before giving up.
+    - idle_timeout (float): Seconds after which an idle connection is recycled.
+    - health_check_interval (float): Idle seconds after which a connection is pinged before reuse.
+    - on_checkout (callable): Called with the seconds spent waiting on every checkout.
+    - connect_kwargs: Passed straight to ``psycopg2.connect``.
+    """
+
+    def __init__(
+        self,
+        min_size: int,
+        max_size: int,
+        timeout: float,
+        idle_timeout: float,
+        health_check_interval: float,
+        on_checkout=None,
+        **connect_kwargs,
+    ):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min_size={min_size}, max_size={max_size}")
+
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.on_checkout = on_checkout
+        self._connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "connections_created": 0,
+            "connections_closed": 0,
+            "health_check_failures": 0,
+        }
+
+    def _open(self) -> _PooledConnection:
+        conn = psycopg2.connect(**self._connect_kwargs)
+        with self._cond:
+            self._stats["connections_created"] += 1
+        return _PooledConnection(conn)
+
+    def _discard(self, pooled: _PooledConnection) -> None:
+        try:
+            pooled.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats["connections_closed"] += 1
+            self._cond.notify()
+
+    def _is_healthy(self, pooled: _PooledConnection, now: float) -> bool:
+        if pooled.conn.closed:
+            return False
+        if now - pooled.last_used_at < self.health_check_interval:
+            return True
+        try:
+            with pooled.conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            pooled.conn.rollback()
+            return True
+        except psycopg2.Error:
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+            return False
+
+    def _reap_idle(self, now: float) -> list:
+        """Pop idle connections past ``idle_timeout``; caller must hold the lock."""
+        expired = []
+        while (
+            self._idle
+            and self._size - len(expired) > self.min_size
+            and now - self._idle[0].last_used_at > self.idle_timeout
+        ):
+            expired.append(self._idle.popleft())
+        return expired
+
+    def _acquire(self) -> _PooledConnection:
+        started = time.monotonic()
+        deadline = started + self.timeout
+        waited = False
+
+        while True:
+            pooled = None
+            create = False
+            with self._cond:
+                if self._closed:
+                    raise PoolTimeout("Connection pool is closed")
+                expired = self._reap_idle(time.monotonic())
+                if self._idle:
+                    # LIFO keeps the hottest connections in use and lets the
+                    # coldest ones age out from the other end of the deque.
+                    pooled = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    create = True
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No PostgreSQL connection available after {self.timeout}s "
+                            f"(max_size={self.max_size})"
+                        )
+                    waited = True
+                    self._cond.wait(remaining)
+
+            for stale in expired:
+                self._discard(stale)
+
+            if create:
+                try:
+                    pooled = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif pooled is not None and not self._is_healthy(pooled, time.monotonic()):
+                self._discard(pooled)
+                pooled = None
+
+            if pooled is not None:
+                break
+
+        wait_time = time.monotonic() - started
+        with self._cond:
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+            if waited:
+                self._stats["waits"] += 1
+        if waited:
+            logger.debug("Waited %.3fs for a PostgreSQL connection", wait_time)
+        if self.on_checkout is not None:
+            self.on_checkout(wait_time)
+        return pooled
+
+    def _release(self, pooled: _PooledConnection, broken: bool = False) -> None:
+        if broken or pooled.conn.closed or self._closed:
+            self._discard(pooled)
+            return
+        pooled.last_used_at = time.monotonic()
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, search_path: str = "public"):
+        """
+        Check out a connection with ``search_path`` set to ``<search_path>, public``.
+
+        The transaction is committed when the block exits normally and rolled
+        back otherwise; the connection then goes back to the pool.
+
+        Args:
+        - search_path (str): Schema to put first on the search path.
+        """
+        pooled = self._acquire()
+        broken = False
+        try:
+            conn = pooled.conn
+            if pooled.search_path != search_path:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        sql.SQL("SET search_path TO {}, public").format(sql.Identifier(search_path))
+                    )
+                conn.commit()
+                pooled.search_path = search_path
+            yield conn
+            conn.commit()
+        except BaseException as e:
+            broken = isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+            try:
+                pooled.conn.rollback()
+            except psycopg2.Error:
+                broken = True
+            raise
+        finally:
+            self._release(pooled, broken=broken)
+
+    def stats(self) -> dict:
+        """Return a snapshot of pool usage, including time spent waiting for a connection."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            stats["max_size"] = self.max_size
+        checkouts = stats["checkouts"]
+        stats["wait_time_avg"] = stats["wait_time_total"] / checkouts if checkouts else 0.0
+        return stats
+
+    def close(self) -> None:
+        """Close every idle connection; checked-out ones are closed on release."""
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for pooled in idle:
+            self._discard(pooled)
+
+
+class ClickHousePool:
+    """
+    Reusable native-protocol ClickHouse clients, one sub-pool per database.
+
+    Clients are keyed by ``(database, use_numpy)`` because NumPy decoding is a
+    client-level setting in ``clickhouse_driver``. At most
+    ``max_idle_per_database`` clients are kept per key and ``max_idle`` in
+    all, the least recently returned disconnected first, so fanning out over
+    every tenant database does not leave a socket open per tenant. Idle
+    clients older than ``idle_timeout`` are disconnected on every checkout
+    and checkin, whichever database they belong to.
+
+    Args:
+    - max_idle_per_database (int): Idle clients kept per sub-pool.
+    - max_idle (int): Idle clients kept across all sub-pools.
+    - idle_timeout (float): Seconds after which an idle client is disconnected.
+    - client_kwargs: Passed straight to ``clickhouse_driver.Client``.
+    """
+
+    def __init__(self, max_idle_per_database: int, max_idle: int, idle_timeout: float, **client_kwargs):
+        self.max_idle_per_database = max_idle_per_database
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._client_kwargs = client_kwargs
+        self._lock = threading.Lock()
+        # Idle clients per key, most recently returned last, and every idle
+        # client in the order it was returned: client -> (key, returned at).
+        self._idle = {}
+        self._idle_order = OrderedDict()
+        self._stats = {
+            "checkouts": 0,
+            "clients_created": 0,
+            "clients_closed": 0,
+            "reconnects": 0,
+        }
+
+    def _new_client(self, database: str, use_numpy: bool):
+        settings = {"use_numpy": True} if use_numpy else None
+        client = clickhouse_driver.Client(database=database, settings=settings, **self._client_kwargs)
+        with self._lock:
+            self._stats["clients_created"] += 1
+        return client
+
+    def _close_client(self, client) -> None:
+        try:
+            client.disconnect()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats["clients_closed"] += 1
+
+    def _take_idle(self, client, key) -> None:
+        """Remove ``client`` from the idle sets; caller must hold the lock."""
+        del self._idle_order[client]
+        idle = self._idle[key]
+        idle.remove(client)
+        if not idle:
+            del self._idle[key]
+
+    def _reap_idle(self, now: float) -> list:
+        """
+        Pop idle clients past ``idle_timeout`` or over ``max_idle``, oldest first.
+
+        Caller must hold the lock and disconnect the returned clients.
+        """
+        expired = []
+        while self._idle_order:
+            client, (key, returned_at) = next(iter(self._idle_order.items()))
+            if len(self._idle_order) <= self.max_idle and now - returned_at <= self.idle_timeout:
+                break
+            self._take_idle(client, key)
+            expired.append(client)
+        return expired
+
+    def _acquire(self, database: str, use_numpy: bool):
+        key = (database, use_numpy)
+        client = None
+        with self._lock:
+            self._stats["checkouts"] += 1
+            expired = self._reap_idle(time.monotonic())
+            idle = self._idle.get(key)
+            if idle:
+                client = idle[-1]
+                self._take_idle(client, key)
+        for stale in expired:
+            self._close_client(stale)
+        return client or self._new_client(database, use_numpy)
+
+    def _release(self, client, database: str, use_numpy: bool, broken: bool = False) -> None:
+        expired = []
+        if not broken:
+            key = (database, use_numpy)
+            with self._lock:
+                idle = self._idle.setdefault(key, deque())
+                if len(idle) < self.max_idle_per_database:
+                    idle.append(client)
+                    self._idle_order[client] = (key, time.monotonic())
+                    client = None
+                elif not idle:
+                    del self._idle[key]
+                expired = self._reap_idle(time.monotonic())
+        for stale in expired:
+            self._close_client(stale)
+        if client is not None:
+            self._close_client(client)
+
+    @contextmanager
+    def client(self, database: str, use_numpy: bool = False):
+        """
+        Check out a client bound to ``database``; it returns to the pool on exit.
+
+        A client whose block raised is disconnected instead of being reused.
+        """
+        client = self._acquire(database, use_numpy)
+        broken = False
+        try:
+            yield client
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            self._release(client, database, use_numpy, broken=broken)
+
+    def run(self, database: str, fn, use_numpy: bool = False):
+        """
+        Call ``fn(client)`` on a pooled client, reconnecting once on a network failure.
+
+        Args:
+        - database (str): Database the client is bound to.
+        - fn (callable): Receives the client and returns the query result.
+        - use_numpy (bool): Use a client that decodes columns into NumPy arrays.
+        """
+        try:
+            with self.client(database, use_numpy=use_numpy) as client:
+                return fn(client)
+        except self.retryable_errors() as e:
+            logger.warning("ClickHouse connection to %s failed (%s), reconnecting", database, e)
+            with self._lock:
+                self._stats["reconnects"] += 1
+            with self.client(database, use_numpy=use_numpy) as client:
+                return fn(client)
+
+    @staticmethod
+    def retryable_errors() -> tuple:
+        """Errors after which the query is retried once on a fresh client."""
+        return (ch_errors.NetworkError, ch_errors.SocketTimeoutError, EOFError, ConnectionError)
+
+    def stats(self) -> dict:
+        """Return a snapshot of client reuse counters and idle clients per database."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = len(self._idle_order)
+            stats["idle_databases"] = len(self._idle)
+        return stats
+
+    def close(self) -> None:
+        """Disconnect every idle client."""
+        with self._lock:
+            idle = list(self._idle_order)
+            self._idle.clear()
+            self._idle_order.clear()
+        for client in idle:
+            self._close_client(client)
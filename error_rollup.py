@@ -0,0 +1,303 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timezone
+
+from base import settings
+from lazy_imports import lazy_import
+from write_history import PAGE_SIZE, fetch_new_runs
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_COLUMNS = ["id", "tenant_id", "finished_at", "records_count", "error_count"]
+_SCAN_CHUNK = 65536
+
+# One immutable snapshot of the per-run arrays, sorted by (finished_at, id)
+# ascending. Refreshes build a new snapshot and swap it in with a single
+# assignment, so readers (and forked background jobs) never see a half update.
+# ``records`` and ``errors`` are floats so that NULL counts can stay NaN.
+_Runs = namedtuple("_Runs", ["ids", "finished", "tenant_codes", "records", "errors", "error_rate"])
+
+
+def _empty_runs() -> _Runs:
+    return _Runs(
+        ids=np.empty(0, dtype=np.int64),
+        finished=np.empty(0, dtype=np.int64),
+        tenant_codes=np.empty(0, dtype=np.int32),
+        records=np.empty(0, dtype=np.float64),
+        errors=np.empty(0, dtype=np.float64),
+        error_rate=np.empty(0, dtype=np.float64),
+    )
+
+
+def _error_rate(records: np.ndarray, errors: np.ndarray) -> np.ndarray:
+    """
+    Errors as a percentage of records, matched like the SQL threshold filter.
+
+    Runs with no records match every threshold; a NULL (NaN) count gives a
+    NaN rate, which matches none.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = errors * 100.0 / records
+    return np.where((records == 0) & ~np.isnan(errors), np.inf, rate)
+
+
+def _sum_by_code(codes: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+    """Per-code sum of ``values`` ignoring NaN, NaN where every value is; like SQL ``sum``."""
+    present = ~np.isnan(values)
+    sums = np.bincount(codes, weights=np.where(present, values, 0.0), minlength=size)
+    return np.where(np.bincount(codes, weights=present, minlength=size) > 0, sums, np.nan)
+
+
+def _to_ns(values) -> np.ndarray:
+    """UTC epoch nanoseconds; naive timestamps are taken to be UTC."""
+    return pd.to_datetime(values, utc=True).to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+class ErrorRateRollup:
+    """
+    Precomputed error rate per run and per tenant, maintained from the write history tail.
+
+    Every run keeps its ``errors_count * 100 / records_count`` next to its
+    ``(finished_at, id)`` key, so "runs at or above X%" is a vectorized scan
+    over a precomputed column plus a binary search for the keyset cursor,
+    and "tenants above X% over the last N hours" is a binary search for the
+    window start plus a ``bincount`` per tenant. New rows are picked up by
+    ``id`` watermark; only runs newer than ``retention_days`` are kept.
+
+    Args:
+    - retention_days (int): Days of runs kept in memory; ``None`` keeps everything.
+    - batch_size (int): Rows fetched per round trip while catching up.
+    """
+
+    def __init__(self, retention_days: int = None, batch_size: int = 50000):
+        self.retention_days = retention_days
+        self.batch_size = batch_size
+        self._runs = _empty_runs()
+        self._tenants = []
+        self._tenant_codes = {}
+        self._counts = (self._runs, {})
+        self._last_id = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def covers_all(self) -> bool:
+        """Whether the rollup holds every run, or only the retention window."""
+        return self.retention_days is None
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def _check_fork(self) -> None:
+        # The refresher thread does not exist in a forked child and may have
+        # held the lock at fork time.
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def _retention_start_ns(self):
+        if self.retention_days is None:
+            return None
+        return time.time_ns() - self.retention_days * 86400 * 10**9
+
+    def _encode_tenants(self, tenant_ids) -> np.ndarray:
+        codes = np.empty(len(tenant_ids), dtype=np.int32)
+        for i, tenant_id in enumerate(tenant_ids):
+            code = self._tenant_codes.get(tenant_id)
+            if code is None:
+                code = self._tenant_codes[tenant_id] = len(self._tenants)
+                self._tenants.append(tenant_id)
+            codes[i] = code
+        return codes
+
+    def _merge(self, runs: _Runs, df: pd.DataFrame) -> _Runs:
+        records = df["records_count"].to_numpy(dtype=np.float64, na_value=np.nan)
+        errors = df["error_count"].to_numpy(dtype=np.float64, na_value=np.nan)
+        batch = _Runs(
+            ids=df["id"].to_numpy(dtype=np.int64),
+            finished=_to_ns(df["finished_at"]),
+            tenant_codes=self._encode_tenants(df["tenant_id"].tolist()),
+            records=records,
+            errors=errors,
+            error_rate=_error_rate(records, errors),
+        )
+        order = np.lexsort((batch.ids, batch.finished))
+        batch = _Runs(*(column[order] for column in batch))
+
+        # New runs almost always finish after everything already held, so only
+        # the overlapping tail (usually empty) needs re-sorting with the batch.
+        split = np.searchsorted(runs.finished, batch.finished[0], side="left") if len(batch.ids) else len(runs.ids)
+        tail = _Runs(*(np.concatenate([column[split:], new]) for column, new in zip(runs, batch)))
+        order = np.lexsort((tail.ids, tail.finished))
+        merged = _Runs(*(np.concatenate([column[:split], new[order]]) for column, new in zip(runs, tail)))
+
+        start = self._retention_start_ns()
+        if start is not None:
+            cut = np.searchsorted(merged.finished, start, side="left")
+            if cut:
+                merged = _Runs(*(column[cut:].copy() for column in merged))
+        return merged
+
+    def refresh(self) -> int:
+        """Pull every run added since the last refresh; returns how many were added."""
+        self._check_fork()
+        added = 0
+        with self._lock:
+            filters = {}
+            if self._last_id is None:
+                start = self._retention_start_ns()
+                if start is not None:
+                    filters["finished_after"] = datetime.fromtimestamp(start / 1e9, tz=timezone.utc)
+            while True:
+                df = fetch_new_runs(
+                    ROLLUP_COLUMNS,
+                    after_id=self._last_id if self._last_id is not None else -1,
+                    limit=self.batch_size,
+                    filters=filters,
+                )
+                if df.empty:
+                    break
+                self._runs = self._merge(self._runs, df)
+                self._last_id = int(df["id"].max())
+                added += len(df)
+                if len(df) < self.batch_size:
+                    break
+            self._loaded = True
+        if added:
+            logger.debug("Error rate rollup picked up %d runs (watermark id %s)", added, self._last_id)
+        return added
+
+    def runs_above(self, threshold: float, after=None, offset: int = 0, limit: int = PAGE_SIZE):
+        """
+        Ids of runs with an error rate of at least ``threshold`` percent, newest first.
+
+        Args:
+        - threshold (float): Error rate percentage.
+        - after (list): ``[finished_at, id]`` keyset cursor; only runs before it are returned.
+        - offset (int): Matching runs to skip after the cursor.
+        - limit (int): Page size.
+
+        Returns ``(ids, total_matching)``, or ``None`` when the rollup is not
+        loaded yet or the page reaches past the retention window, in which
+        case the caller should query the database instead. ``total_matching``
+        is ``None`` unless the rollup covers every run.
+        """
+        if not self._loaded:
+            return None
+        runs = self._runs
+        end = len(runs.ids)
+        if after is not None:
+            finished = _to_ns([after[0]])[0]
+            lo = np.searchsorted(runs.finished, finished, side="left")
+            hi = np.searchsorted(runs.finished, finished, side="right")
+            end = lo + np.searchsorted(runs.ids[lo:hi], int(after[1]), side="left")
+
+        # Walk back from the cursor in chunks and stop once the page is full,
+        # instead of testing every run on each page turn.
+        need = offset + limit
+        found, count = [], 0
+        while end > 0 and count < need:
+            start = max(0, end - _SCAN_CHUNK)
+            matches = np.flatnonzero(runs.error_rate[start:end] >= threshold)[::-1] + start
+            found.append(matches)
+            count += len(matches)
+            end = start
+        matches = np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+        page = matches[offset:need]
+        if len(page) < limit and not self.covers_all:
+            return None
+        total = self._count_above(runs, threshold) if self.covers_all else None
+        return runs.ids[page].tolist(), total
+
+    def _count_above(self, runs: _Runs, threshold: float) -> int:
+        # Counted once per snapshot and threshold; paging reuses the total.
+        snapshot, counts = self._counts
+        if snapshot is not runs:
+            counts = {}
+            self._counts = (runs, counts)
+        if threshold not in counts:
+            counts[threshold] = int(np.count_nonzero(runs.error_rate >= threshold))
+        return counts[threshold]
+
+    def tenants_above(self, threshold: float, hours: float) -> pd.DataFrame:
+        """
+        Tenants whose error rate over the last ``hours`` hours is at least ``threshold`` percent.
+
+        Returns a frame with ``tenant_id``, ``runs``, ``records_count``,
+        ``error_count`` and ``error_rate``, highest error rate first, or
+        ``None`` if the rollup is not loaded yet.
+        """
+        if not self._loaded:
+            return None
+        runs = self._runs
+        start = np.searchsorted(runs.finished, time.time_ns() - int(hours * 3600 * 10**9), side="left")
+        codes = runs.tenant_codes[start:]
+        size = len(self._tenants)
+        run_counts = np.bincount(codes, minlength=size)
+        records = _sum_by_code(codes, runs.records[start:], size)
+        errors = _sum_by_code(codes, runs.errors[start:], size)
+
+        active = np.flatnonzero(run_counts)
+        rate = _error_rate(records[active], errors[active])
+        keep = rate >= threshold
+        df = pd.DataFrame({
+            "tenant_id": [self._tenants[code] for code in active[keep]],
+            "runs": run_counts[active[keep]],
+            "records_count": records[active[keep]].astype(np.int64),
+            "error_count": errors[active[keep]].astype(np.int64),
+            "error_rate": rate[keep].round(2),
+        })
+        return df.sort_values("error_rate", ascending=False, ignore_index=True)
+
+
+_rollup = None
+_rollup_lock = threading.Lock()
+
+
+def get_error_rollup() -> ErrorRateRollup:
+    """
+    Return the process-wide error rate rollup, creating it on first use.
+    """
+    global _rollup
+    if _rollup is None:
+        with _rollup_lock:
+            if _rollup is None:
+                _rollup = ErrorRateRollup(
+                    retention_days=settings.ROLLUP_RETENTION_DAYS,
+                    batch_size=settings.ROLLUP_BATCH_SIZE,
+                )
+    return _rollup
+
+
+def start_rollup_refresher() -> threading.Thread:
+    """
+    Keep the rollup current from a daemon thread in the web process.
+
+    Only this process refreshes. Background callback jobs are forked from it
+    and read the snapshot they start with, at most
+    ``ROLLUP_REFRESH_INTERVAL`` seconds old; anything they refreshed would be
+    thrown away with the job.
+    """
+
+    def run():
+        rollup = get_error_rollup()
+        while True:
+            try:
+                rollup.refresh()
+            except Exception as e:
+                logger.warning("Error rate rollup refresh failed: %s", e)
+            time.sleep(settings.ROLLUP_REFRESH_INTERVAL)
+
+    thread = threading.Thread(target=run, name="error-rollup-refresher", daemon=True)
+    thread.start()
+    return thread
@@ -1,7 +1,243 @@
-import clickhouse_driver
-import psycopg2
+from __future__ import annotations
 
+import atexit
+import codecs
+import contextvars
+import functools
+import io
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from decimal import Decimal
+
+import metrics
+import query_log
 from base import settings
+from db_pool import ClickHousePool, PostgresPool
+from lazy_imports import lazy_import
+from query_cache import QueryCache, SharedQueryCache, estimate_size, make_cache_key
+
+pd = lazy_import("pandas")
+
+CLICKHOUSE_RESULT_FORMATS = ("rows", "columns", "dataframe")
+
+# Column types for execute_postgres_frame by PostgreSQL type OID; anything
+# not listed here is read as text. Integer and boolean columns holding NULLs
+# come back as float64 and object, as they would from pd.DataFrame(rows).
+FRAME_DTYPES = {
+    16: "bool",  # bool
+    20: "int64",  # int8
+    21: "int64",  # int2
+    23: "int64",  # int4
+    26: "int64",  # oid
+    700: "float64",  # float4
+    701: "float64",  # float8
+}
+# numeric is read as text and turned into Decimal, as psycopg2 returns it:
+# float64 would lose precision, and unconstrained numeric has no fixed
+# scale to read it as a fixed-point Arrow type.
+FRAME_NUMERIC = 1700
+# date, timestamp and timestamptz, which are sent as days or microseconds
+# since the epoch: (unit, whether the value is UTC).
+FRAME_DATETIMES = {1082: ("D", False), 1114: ("us", False), 1184: ("us", True)}
+FRAME_NULL = "\\N"
+
+# One tenant's outcome in fan_out_clickhouse_query: ``result`` on success,
+# ``error`` (the exception, or a TimeoutError) otherwise.
+TenantResult = namedtuple("TenantResult", ["tenant_id", "result", "error", "duration"])
+
+_postgres_pool = None
+_postgres_pool_lock = threading.Lock()
+_clickhouse_pool = None
+_clickhouse_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+# Pools inherited through fork() (background callback jobs, preforked
+# workers) share their sockets with the parent. They are kept referenced
+# and never closed here, since closing would end the parent's sessions.
+_inherited_pools = []
+_query_cache = None
+_query_cache_lock = threading.Lock()
+# Queries being run right now, by cache key, for execute_postgres_query to
+# share between identical concurrent calls.
+_inflight = {}
+_inflight_lock = threading.Lock()
+_inflight_pid = os.getpid()
+
+WRITE_HISTORY_WATERMARK_QUERY = """
+SELECT MAX(id), MAX(finished_at) FROM core_master.clickhouse_write_history
+"""
+
+
+def _check_fork() -> None:
+    """Start fresh pools in a forked child instead of reusing the parent's sockets."""
+    global _postgres_pool, _clickhouse_pool, _pool_pid, _postgres_pool_lock, _clickhouse_pool_lock
+    if _pool_pid == os.getpid():
+        return
+    # A lock held by another parent thread at fork time would never be
+    # released in the child, so the locks are replaced rather than acquired.
+    _postgres_pool_lock = threading.Lock()
+    _clickhouse_pool_lock = threading.Lock()
+    _inherited_pools.extend(pool for pool in (_postgres_pool, _clickhouse_pool) if pool)
+    _postgres_pool = None
+    _clickhouse_pool = None
+    _pool_pid = os.getpid()
+
+
+def _close_pools() -> None:
+    if _pool_pid != os.getpid():
+        return
+    for pool in (_postgres_pool, _clickhouse_pool):
+        if pool is not None:
+            pool.close()
+
+
+atexit.register(_close_pools)
+
+
+def close_pools() -> None:
+    """
+    Close this process's pools; they are created again on next use.
+
+    A preforking server calls this in the master before forking workers, so
+    no connection is ever shared between processes.
+    """
+    global _postgres_pool, _clickhouse_pool
+    _close_pools()
+    _postgres_pool = None
+    _clickhouse_pool = None
+
+
+def get_postgres_pool() -> PostgresPool:
+    """
+    Return the process-wide PostgreSQL pool, creating it on first use.
+    """
+    global _postgres_pool
+    _check_fork()
+    if _postgres_pool is None:
+        with _postgres_pool_lock:
+            if _postgres_pool is None:
+                _postgres_pool = PostgresPool(
+                    min_size=settings.PG_POOL_MIN_SIZE,
+                    max_size=settings.PG_POOL_MAX_SIZE,
+                    timeout=settings.PG_POOL_TIMEOUT,
+                    idle_timeout=settings.PG_POOL_IDLE_TIMEOUT,
+                    health_check_interval=settings.PG_POOL_HEALTH_CHECK_INTERVAL,
+                    on_checkout=functools.partial(metrics.observe_pool_wait, "postgres"),
+                    host=settings.POSTGRES_HOST,
+                    port=settings.DATABASE_PORT,
+                    user=settings.POSTGRES_USER,
+                    password=settings.POSTGRES_PASSWORD,
+                    dbname=settings.POSTGRES_DB,
+                )
+    return _postgres_pool
+
+
+def get_postgres_pool_stats() -> dict:
+    """
+    Pool usage counters (size, idle, in-use, checkouts and wait times in seconds).
+    """
+    return get_postgres_pool().stats()
+
+
+def get_clickhouse_pool() -> ClickHousePool:
+    """
+    Return the process-wide ClickHouse client pool, creating it on first use.
+    """
+    global _clickhouse_pool
+    _check_fork()
+    if _clickhouse_pool is None:
+        with _clickhouse_pool_lock:
+            if _clickhouse_pool is None:
+                _clickhouse_pool = ClickHousePool(
+                    max_idle_per_database=settings.CH_POOL_MAX_IDLE_PER_DATABASE,
+                    max_idle=settings.CH_POOL_MAX_IDLE,
+                    idle_timeout=settings.CH_POOL_IDLE_TIMEOUT,
+                    host=settings.CH_DB_HOST,
+                    port=settings.CH_DB_PORT,
+                    user=settings.CH_DB_USER,
+                    password=settings.CH_DB_PASSWORD,
+                )
+    return _clickhouse_pool
+
+
+def _probe_write_history_watermark():
+    with get_postgres_pool().connection() as pg_conn:
+        with pg_conn.cursor() as pg_cursor:
+            pg_cursor.execute(WRITE_HISTORY_WATERMARK_QUERY)
+            return pg_cursor.fetchone()
+
+
+def get_query_cache() -> QueryCache:
+    """
+    Return the process-wide query result cache, creating it on first use.
+
+    Cached results are dropped as soon as a new ``clickhouse_write_history``
+    row shows up in the watermark probe. With ``QUERY_CACHE_BACKEND=shared``
+    the cache lives in ``QUERY_CACHE_DIR`` and is shared by every worker
+    process; otherwise each process keeps its own in memory.
+    """
+    global _query_cache
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                options = dict(
+                    max_bytes=settings.QUERY_CACHE_MAX_BYTES,
+                    ttl=settings.QUERY_CACHE_TTL,
+                    watermark_fn=_probe_write_history_watermark,
+                    watermark_interval=settings.QUERY_CACHE_WATERMARK_INTERVAL,
+                )
+                if settings.QUERY_CACHE_BACKEND == "shared":
+                    _query_cache = SharedQueryCache(settings.QUERY_CACHE_DIR, **options)
+                elif settings.QUERY_CACHE_BACKEND == "memory":
+                    _query_cache = QueryCache(**options)
+                else:
+                    raise ValueError(f"Unknown QUERY_CACHE_BACKEND {settings.QUERY_CACHE_BACKEND!r}")
+    return _query_cache
+
+
+def get_query_cache_stats() -> dict:
+    """
+    Query cache counters (hits, misses, evictions, expirations, invalidations, size).
+    """
+    return get_query_cache().stats()
+
+
+def _collect_metrics():
+    # Read at scrape time, and only for pools this process created.
+    if _postgres_pool is not None and _pool_pid == os.getpid():
+        stats = _postgres_pool.stats()
+        yield "db_pool_connections", "Open PostgreSQL connections by state.", "gauge", [
+            ({"database": "postgres", "state": "idle"}, stats["idle"]),
+            ({"database": "postgres", "state": "in_use"}, stats["in_use"]),
+        ]
+        yield "db_pool_timeouts_total", "Checkouts that gave up waiting for a connection.", "counter", [
+            ({"database": "postgres"}, stats["timeouts"]),
+        ]
+    if _clickhouse_pool is not None and _pool_pid == os.getpid():
+        stats = _clickhouse_pool.stats()
+        yield "db_pool_reconnects_total", "ClickHouse queries retried on a new connection.", "counter", [
+            ({"database": "clickhouse"}, stats["reconnects"]),
+        ]
+    if _query_cache is not None:
+        stats = _query_cache.stats()
+        yield "query_cache_lookups_total", "Query cache lookups by result.", "counter", [
+            ({"result": "hit"}, stats["hits"]),
+            ({"result": "miss"}, stats["misses"]),
+        ]
+        yield "query_cache_bytes", "Estimated size of the cached query results.", "gauge", [({}, stats["bytes"])]
+
+
+metrics.REGISTRY.add_collector(_collect_metrics)
+
+
+def _query_name(query_name: str = None) -> str:
+    """The explicit query name, else the function that called ``execute_*``."""
+    return query_name or sys._getframe(2).f_code.co_name
 
 
 def execute_clickhouse_query(
@@ -10,32 +246,208 @@ def execute_clickhouse_query(
     tenant_id: str,
     echo_query: bool = False,
     echo_params: bool = False,
-) -> None:
+    result_format: str = "rows",
+    query_name: str = None,
+    query_settings: dict = None,
+):
     """
     Execute a query on ClickHouse databases.
 
     Args:
     - query (str): The SQL query to execute.
     - params (dict): The parameters to pass to the query.
-    -tenant_id(str):
+    -tenant_id(str): Database to run the query in.
+    - result_format (str): ``"rows"`` for a list of tuples, ``"columns"`` for a
+      dict of column name to NumPy array, ``"dataframe"`` for a pandas DataFrame.
+      The last two are decoded column-wise from the native protocol.
+    - query_name (str): Label for the query metrics, defaults to the calling function's name.
+    - query_settings (dict): ClickHouse settings for this query, e.g. ``max_execution_time``.
+    - echo_query, echo_params (bool): Log this query through ``query_log`` even when it is fast.
+    """
+    if result_format not in CLICKHOUSE_RESULT_FORMATS:
+        raise ValueError(f"Unknown result_format {result_format!r}, expected one of {CLICKHOUSE_RESULT_FORMATS}")
+
+    def fetch_columns(client):
+        data, column_types = client.execute(
+            query, params, with_column_types=True, columnar=True, settings=query_settings
+        )
+        return {name: column for (name, _), column in zip(column_types, data)}
+
+    query_name = _query_name(query_name)
+    started = time.perf_counter()
+    with metrics.track_query("clickhouse", query_name) as observation:
+        if result_format == "rows":
+            result = get_clickhouse_pool().run(
+                tenant_id, lambda client: client.execute(query, params, settings=query_settings)
+            )
+        elif result_format == "dataframe":
+            result = get_clickhouse_pool().run(
+                tenant_id, lambda client: client.query_dataframe(query, params, settings=query_settings),
+                use_numpy=True,
+            )
+        else:
+            result = get_clickhouse_pool().run(tenant_id, fetch_columns, use_numpy=True)
+        observation.record(result)
+    query_log.observe(
+        "clickhouse", query, params, tenant_id, time.perf_counter() - started,
+        rows=observation.rows, query_name=query_name, force=echo_query or echo_params,
+    )
+    return result
+
+
+def fan_out_clickhouse_query(
+    query: str,
+    params: dict,
+    tenant_ids,
+    timeout: float = None,
+    max_workers: int = None,
+    result_format: str = "rows",
+    query_name: str = None,
+):
+    """
+    Run the same query in many tenant databases at once, yielding results as they finish.
+
+    Yields one ``TenantResult`` per tenant, in completion order. A tenant
+    whose query fails or runs longer than ``timeout`` gets a result with
+    ``error`` set instead of aborting the others. ClickHouse is also asked to
+    stop the query after ``timeout`` (``max_execution_time``), so a timed-out
+    worker does not linger. Closing the generator early cancels the queries
+    that have not started.
+
+    Args:
+    - query (str): The SQL query to execute in every database.
+    - params (dict): The parameters to pass to the query.
+    - tenant_ids (list): Tenant databases to run the query in.
+    - timeout (float): Seconds each tenant's query may run, defaults to ``settings.CH_FANOUT_TIMEOUT``.
+    - max_workers (int): Queries in flight at once, defaults to ``settings.CH_FANOUT_MAX_WORKERS``.
+    - result_format (str): As for ``execute_clickhouse_query``.
+    - query_name (str): Label for the query metrics, defaults to the calling function's name.
+    """
+    timeout = settings.CH_FANOUT_TIMEOUT if timeout is None else timeout
+    query_name = _query_name(query_name)
+    query_settings = {"max_execution_time": max(1, int(timeout))}
+    tenant_ids = list(dict.fromkeys(tenant_ids))
+    started = {}
+
+    def run(tenant_id):
+        started[tenant_id] = time.monotonic()
+        try:
+            result = execute_clickhouse_query(
+                query, params, tenant_id,
+                result_format=result_format, query_name=query_name, query_settings=query_settings,
+            )
+            return TenantResult(tenant_id, result, None, time.monotonic() - started[tenant_id])
+        except Exception as e:
+            return TenantResult(tenant_id, None, e, time.monotonic() - started[tenant_id])
+
+    executor = ThreadPoolExecutor(
+        max_workers=max_workers or settings.CH_FANOUT_MAX_WORKERS, thread_name_prefix="clickhouse-fan-out"
+    )
+    try:
+        # Each task gets its own copy of the context, so queries keep the
+        # metrics labels of the callback that fanned out.
+        pending = {
+            executor.submit(contextvars.copy_context().run, run, tenant_id): tenant_id for tenant_id in tenant_ids
+        }
+        while pending:
+            now = time.monotonic()
+            deadlines = [started[tenant_id] + timeout for tenant_id in pending.values() if tenant_id in started]
+            done, _ = wait(
+                pending,
+                timeout=max(0.01, min(deadlines) - now) if deadlines else timeout,
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                pending.pop(future)
+                yield future.result()
+
+            now = time.monotonic()
+            for future, tenant_id in list(pending.items()):
+                if tenant_id in started and now - started[tenant_id] > timeout:
+                    pending.pop(future)
+                    yield TenantResult(
+                        tenant_id, None, TimeoutError(f"No result after {timeout}s"), now - started[tenant_id]
+                    )
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_clickhouse_query(
+    query: str,
+    params: dict,
+    tenant_id: str,
+    block_size: int = None,
+):
+    """
+    Stream the rows of a ClickHouse query without materializing the whole result.
+
+    The pooled client is held until the iterator is exhausted; if the caller
+    stops early the client is disconnected rather than returned mid-stream.
+
+    Args:
+    - query (str): The SQL query to execute.
+    - params (dict): The parameters to pass to the query.
+    -tenant_id(str): Database to run the query in.
+    - block_size (int): ``max_block_size`` sent to the server, defaults to ``settings.CH_STREAM_BLOCK_SIZE``.
+    """
+    query_settings = {"max_block_size": block_size or settings.CH_STREAM_BLOCK_SIZE}
+    with get_clickhouse_pool().client(tenant_id) as client:
+        yield from client.execute_iter(query, params, settings=query_settings)
+
+
+def _run_postgres_query(query: str, params: dict, tenant_id: str):
+    with get_postgres_pool().connection(search_path=tenant_id) as pg_conn:
+        with pg_conn.cursor() as pg_cursor:
+            pg_cursor.execute(query, params)
+            columns = [column.name for column in pg_cursor.description]
+            return columns, pg_cursor.fetchall()
+
 
+def _single_flight(key, fn, database: str, query_name: str):
     """
-    if echo_query:
-        print(query)
-    if echo_params:
-        print(params)
+    Call ``fn()`` once for all concurrent calls with the same ``key``.
+
+    The first caller runs it; callers arriving while it is in flight wait for
+    its result (or exception) and share it, and are counted as coalesced.
+    """
+    global _inflight, _inflight_lock, _inflight_pid
+    if _inflight_pid != os.getpid():
+        # Whoever was running these in the parent does not exist in a forked child.
+        _inflight, _inflight_lock, _inflight_pid = {}, threading.Lock(), os.getpid()
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        metrics.observe_coalesced(database, query_name)
+        return future.result()
+    try:
+        result = fn()
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            if _inflight.get(key) is future:
+                del _inflight[key]
+
 
-    with clickhouse_driver.connect(
-        host=settings.CH_DB_HOST,
-        port=9000,
-        user=settings.CH_DB_USER,
-        password=settings.CH_DB_PASSWORD,
-        database=tenant_id,
-    ) as ch_conn:
-        with ch_conn.cursor() as ch_cursor:
-            ch_cursor.execute(query, params)
-            ch_result = ch_cursor.fetchall()
-            return ch_result
+def _timed_postgres_query(query: str, params: dict, tenant_id: str, query_name: str, echo: bool = False):
+    # Only queries that reach the database are timed; cache hits are counted
+    # by the query cache.
+    started = time.perf_counter()
+    with metrics.track_query("postgres", query_name) as observation:
+        pg_result = _run_postgres_query(query, params, tenant_id)
+        observation.record(pg_result[1])
+    query_log.observe(
+        "postgres", query, params, tenant_id, time.perf_counter() - started,
+        rows=observation.rows, query_name=query_name, force=echo,
+    )
+    return pg_result
 
 
 def execute_postgres_query(
@@ -44,29 +456,254 @@ def execute_postgres_query(
     tenant_id: str,
     echo_query: bool = False,
     echo_params: bool = False,
-) -> None:
+    use_cache: bool = False,
+    include_columns: bool = False,
+    query_name: str = None,
+):
     """
     Execute a query on PostgreSQL databases.
 
     Args:
     - query (str): The SQL query to execute.
     - params (dict): The parameters to pass to the query.
-    -tenant_id(str):
-    """
-    if echo_query:
-        print(query)
-    if echo_params:
-        print(params)
-
-    with psycopg2.connect(
-        host=settings.POSTGRES_HOST,
-        port=settings.DATABASE_PORT,
-        user=settings.POSTGRES_USER,
-        password=settings.POSTGRES_PASSWORD,
-        dbname=settings.POSTGRES_DB,
-        options=f"-c search_path={tenant_id},public",
-    ) as pg_conn:
-        with pg_conn.cursor() as pg_cursor:
+    -tenant_id(str): Schema put first on the ``search_path`` of the pooled connection.
+    - use_cache (bool): Serve the result from the query cache when possible.
+      Only for read-only queries over ``clickhouse_write_history``, whose
+      watermark drives invalidation.
+    - include_columns (bool): Return ``(column_names, rows)`` with the names
+      taken from ``cursor.description`` instead of just the rows.
+    - query_name (str): Label for the query metrics, defaults to the calling function's name.
+    - echo_query, echo_params (bool): Log this query through ``query_log`` even when it is fast.
+
+    With ``QUERY_COALESCING``, a read-only query that is already running in
+    this process with the same text, params and schema is not run again: the
+    caller waits for that run and gets the same result, so treat the rows as
+    read-only. Each such call counts towards ``db_query_coalesced_total``.
+    """
+    query_name = _query_name(query_name)
+    echo = echo_query or echo_params
+    key = make_cache_key(query, params, tenant_id)
+    hit = False
+    if use_cache:
+        cache = get_query_cache()
+        hit, pg_result, generation = cache.get(key)
+
+    def fetch():
+        pg_result = _timed_postgres_query(query, params, tenant_id, query_name, echo)
+        if use_cache:
+            cache.set(key, pg_result, generation, size=estimate_size(pg_result[1]))
+        return pg_result
+
+    if not hit:
+        if settings.QUERY_COALESCING and query_log.is_read_only(query):
+            pg_result = _single_flight(key, fetch, "postgres", query_name)
+        else:
+            pg_result = fetch()
+
+    return pg_result if include_columns else pg_result[1]
+
+
+def stream_postgres_query(
+    query: str,
+    params: dict,
+    tenant_id: str,
+    chunk_size: int = None,
+):
+    """
+    Stream a query's result in fixed-size chunks through a server-side cursor.
+
+    Yields ``(column_names, rows)`` with at most ``chunk_size`` rows each, so
+    memory stays bounded however large the result is. A pooled connection is
+    held until the generator is exhausted or closed.
+
+    Args:
+    - query (str): The SQL query to execute.
+    - params (dict): The parameters to pass to the query.
+    -tenant_id(str): Schema put first on the ``search_path`` of the pooled connection.
+    - chunk_size (int): Rows per chunk, defaults to ``settings.EXPORT_CHUNK_SIZE``.
+    """
+    chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+    with get_postgres_pool().connection(search_path=tenant_id) as pg_conn:
+        with pg_conn.cursor(name=f"stream_{uuid.uuid4().hex}") as pg_cursor:
+            pg_cursor.itersize = chunk_size
             pg_cursor.execute(query, params)
-            pg_result = pg_cursor.fetchall()
-            return pg_result
+            columns = None
+            while True:
+                rows = pg_cursor.fetchmany(chunk_size)
+                if columns is None:
+                    columns = [column.name for column in pg_cursor.description]
+                if not rows:
+                    break
+                yield columns, rows
+
+
+def _frame_copy(literal: str, type_codes: list) -> str:
+    # Columns are renamed positionally, so duplicate names don't matter, and
+    # dates and timestamps are sent as integers, which parse far faster than
+    # their text forms.
+    aliases = [f"c{i}" for i in range(len(type_codes))]
+    select = []
+    for alias, type_code in zip(aliases, type_codes):
+        unit = FRAME_DATETIMES.get(type_code, (None,))[0]
+        if unit == "us":
+            select.append(f"floor(extract(epoch FROM {alias}) * 1000000)::int8")
+        elif unit == "D":
+            select.append(f"{alias} - DATE '1970-01-01'")
+        else:
+            select.append(alias)
+    query = f"SELECT {', '.join(select)} FROM ({literal}) AS frame({', '.join(aliases)})"
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, NULL '{FRAME_NULL}')"
+
+
+def _frame_type(type_code: int) -> str:
+    return "int64" if type_code in FRAME_DATETIMES else FRAME_DTYPES.get(type_code, "text")
+
+
+def _read_frame_arrow(buffer: io.BytesIO, type_codes: list, encoding: str) -> pd.DataFrame:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+
+    arrow_types = {"bool": pa.bool_(), "int64": pa.int64(), "float64": pa.float64(), "text": pa.string()}
+    names = [str(i) for i in range(len(type_codes))]
+    # The buffer's bytes are taken over without a copy and dropped once
+    # parsed; each column's Arrow memory is then released as it is converted.
+    text = buffer.getvalue()
+    buffer.close()
+    table = pa_csv.read_csv(
+        pa.BufferReader(text),
+        # Under its canonical name UTF-8 is read directly rather than transcoded.
+        read_options=pa_csv.ReadOptions(column_names=names, encoding=codecs.lookup(encoding).name),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={name: arrow_types[_frame_type(t)] for name, t in zip(names, type_codes)},
+            null_values=[FRAME_NULL],
+            strings_can_be_null=True,
+            true_values=["t"],
+            false_values=["f"],
+        ),
+    )
+    del text
+    df = table.to_pandas(split_blocks=True, self_destruct=True)
+    df.columns = range(len(type_codes))
+    return df
+
+
+def _read_frame_pandas(buffer: io.BytesIO, type_codes: list, encoding: str) -> pd.DataFrame:
+    # Integer and boolean columns are left to the parser, which only falls
+    # back to float64 or object when there are NULLs.
+    dtypes = {i: FRAME_DTYPES.get(t, object) for i, t in enumerate(type_codes) if _frame_type(t) in ("float64", "text")}
+    df = pd.read_csv(
+        buffer,
+        header=None,
+        dtype=dtypes,
+        encoding=encoding,
+        na_values=[FRAME_NULL],
+        keep_default_na=False,
+        true_values=["t"],
+        false_values=["f"],
+    )
+    for i in df.columns:
+        if df[i].dtype == object and df[i].hasnans:
+            # NULLs as None, like the tuple path, rather than NaN.
+            df[i] = df[i].where(df[i].notna(), None)
+    return df
+
+
+def _run_postgres_frame(query: str, params: dict, tenant_id: str) -> pd.DataFrame:
+    from psycopg2.extensions import encodings
+
+    with get_postgres_pool().connection(search_path=tenant_id) as pg_conn:
+        with pg_conn.cursor() as pg_cursor:
+            encoding = encodings[pg_conn.encoding]
+            literal = pg_cursor.mogrify(query, params).decode(encoding)
+            pg_cursor.execute(f"SELECT * FROM ({literal}) AS frame LIMIT 0")
+            names = [column.name for column in pg_cursor.description]
+            type_codes = [column.type_code for column in pg_cursor.description]
+            buffer = io.BytesIO()
+            pg_cursor.copy_expert(_frame_copy(literal, type_codes), buffer)
+
+    if not buffer.getbuffer().nbytes:
+        df = pd.DataFrame({
+            i: pd.Series([], dtype=object if _frame_type(t) == "text" else _frame_type(t))
+            for i, t in enumerate(type_codes)
+        })
+    else:
+        try:
+            df = _read_frame_arrow(buffer, type_codes, encoding)
+        except ImportError:
+            buffer.seek(0)
+            df = _read_frame_pandas(buffer, type_codes, encoding)
+    del buffer
+    for i, type_code in enumerate(type_codes):
+        if type_code in FRAME_DATETIMES:
+            unit, utc = FRAME_DATETIMES[type_code]
+            df[i] = pd.to_datetime(df[i], unit=unit, utc=utc)
+        elif type_code == FRAME_NUMERIC:
+            df[i] = df[i].map(lambda value: Decimal(value) if isinstance(value, str) else value)
+    df.columns = names
+    return df
+
+
+def execute_postgres_frame(
+    query: str,
+    params: dict,
+    tenant_id: str,
+    echo_query: bool = False,
+    echo_params: bool = False,
+    query_name: str = None,
+) -> pd.DataFrame:
+    """
+    Execute a query on PostgreSQL straight into a DataFrame, for large results.
+
+    The result is copied out with ``COPY (query) TO STDOUT`` and parsed column
+    by column, by pyarrow's CSV reader when installed (the ``parquet`` extra)
+    and pandas' otherwise, so no Python object is made per row or per value
+    except for text and ``numeric``. Column dtypes follow the PostgreSQL types
+    (see ``FRAME_DTYPES``); ``numeric`` comes back as ``Decimal`` objects, as
+    from ``execute_postgres_query``, ``timestamptz`` as UTC ``datetime64``,
+    ``timestamp`` and ``date`` as naive ``datetime64``.
+    Takes an extra round trip to describe the columns, so prefer
+    ``execute_postgres_query`` for small results. Never cached.
+
+    Args:
+    - query (str): The SELECT to execute; it is inlined into ``COPY``, so no trailing semicolon.
+    - params (dict): The parameters to pass to the query.
+    -tenant_id(str): Schema put first on the ``search_path`` of the pooled connection.
+    - query_name (str): Label for the query metrics, defaults to the calling function's name.
+    - echo_query, echo_params (bool): Log this query through ``query_log`` even when it is fast.
+    """
+    query_name = _query_name(query_name)
+    started = time.perf_counter()
+    with metrics.track_query("postgres", query_name) as observation:
+        df = _run_postgres_frame(query, params, tenant_id)
+        observation.record(df)
+    query_log.observe(
+        "postgres", query, params, tenant_id, time.perf_counter() - started,
+        rows=observation.rows, query_name=query_name, force=echo_query or echo_params,
+    )
+    return df
+
+
+def estimate_postgres_row_count(
+    query: str,
+    params: dict,
+    tenant_id: str,
+) -> int:
+    """
+    Planner estimate of the rows ``query`` returns, without running it.
+
+    Uses ``EXPLAIN (FORMAT JSON)``, so the cost is a planning round trip no
+    matter how many rows match; good enough for an approximate page count.
+
+    Args:
+    - query (str): The SQL query to estimate.
+    - params (dict): The parameters to pass to the query.
+    -tenant_id(str): Schema put first on the ``search_path`` of the pooled connection.
+    """
+    with metrics.track_query("postgres", f"estimate:{sys._getframe(1).f_code.co_name}"):
+        with get_postgres_pool().connection(search_path=tenant_id) as pg_conn:
+            with pg_conn.cursor() as pg_cursor:
+                pg_cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+                plan = pg_cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
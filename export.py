@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+import io
+from urllib.parse import urlencode
+
+from flask import Blueprint, Response, abort, request, stream_with_context
+
+from exec import stream_postgres_query
+from lazy_imports import lazy_import
+from write_history import EXPORT_COLUMNS, add_tenant_columns, build_select, format_datetimes, split_tenant_columns
+
+pd = lazy_import("pandas")
+
+EXPORT_PATH = "/export/write-history"
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+export_bp = Blueprint("export", __name__)
+
+
+def export_url(fmt: str = "csv", **filters) -> str:
+    """Link to the write history export for ``filters``; falsy filters are dropped."""
+    params = {"format": fmt, **{name: value for name, value in filters.items() if value}}
+    return f"{EXPORT_PATH}?{urlencode(params)}"
+
+
+def _filters_from_request() -> dict:
+    filters = {
+        "tenant_id": request.args.get("tenant_id") or None,
+        "active_tenants": request.args.get("active_tenants") == "1",
+        "error_threshold": None,
+    }
+    if request.args.get("error_threshold"):
+        try:
+            filters["error_threshold"] = float(request.args["error_threshold"])
+        except ValueError:
+            abort(400, "error_threshold must be a number")
+    return filters
+
+
+def _frames(filters: dict):
+    db_columns, filters, tenant_columns = split_tenant_columns(EXPORT_COLUMNS, filters)
+    query, params = build_select(db_columns, filters=filters, limit=None)
+    for columns, rows in stream_postgres_query(query=query, params=params, tenant_id="public"):
+        df = add_tenant_columns(pd.DataFrame(rows, columns=columns), EXPORT_COLUMNS, tenant_columns)
+        yield format_datetimes(df)
+
+
+def _csv_chunks(frames):
+    header = True
+    for df in frames:
+        yield df.to_csv(index=False, header=header)
+        header = False
+    if header:
+        yield ",".join(EXPORT_COLUMNS) + "\n"
+
+
+def _parquet_chunks(frames):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = io.BytesIO()
+    writer = None
+    for df in frames:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            # A column that is entirely NULL in the first chunk would be typed
+            # "null" and reject later chunks; every such column is text here.
+            schema = pa.schema(
+                [field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema]
+            )
+            writer = pq.ParquetWriter(sink, schema)
+        writer.write_table(table.cast(writer.schema))
+        yield sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+    if writer is None:
+        writer = pq.ParquetWriter(sink, pa.schema([(column, pa.string()) for column in EXPORT_COLUMNS]))
+    writer.close()
+    yield sink.getvalue()
+
+
+@export_bp.route(EXPORT_PATH)
+def export_write_history():
+    """
+    Stream ``clickhouse_write_history`` rows as CSV or Parquet.
+
+    Query string: ``format`` (``csv`` or ``parquet``), and optionally
+    ``tenant_id``, ``error_threshold`` and ``active_tenants=1``, which apply
+    the same filters as the dashboard tables. Rows are read through a
+    server-side cursor in ``EXPORT_CHUNK_SIZE`` chunks and written out as they
+    arrive, so memory use does not grow with the size of the export.
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        abort(400, f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if fmt == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            abort(501, "Parquet export needs pyarrow; install the 'parquet' extra")
+
+    filters = _filters_from_request()
+    chunks = _csv_chunks(_frames(filters)) if fmt == "csv" else _parquet_chunks(_frames(filters))
+    mimetype, extension = EXPORT_FORMATS[fmt]
+    name = filters["tenant_id"] or "all-tenants"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="write-history-{name}.{extension}"'},
+    )
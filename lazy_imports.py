@@ -0,0 +1,39 @@
+"""
+Deferred imports for the heavy libraries, so importing the app stays fast.
+
+``pd = lazy_import("pandas")`` binds a stand-in that imports pandas the first
+time one of its attributes is used. Modules using it start with
+``from __future__ import annotations`` so that ``pd.DataFrame`` in a
+signature is not evaluated at import time.
+"""
+import importlib
+
+
+class LazyModule:
+    """A module that is only imported when one of its attributes is first read."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            # import_module takes the import lock, so concurrent first uses
+            # from several threads still import the module once.
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        value = getattr(self._load(), attr)
+        # Later reads of the same attribute skip __getattr__ entirely.
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """Return a stand-in for module ``name`` that imports it on first attribute access."""
+    return LazyModule(name)
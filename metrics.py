@@ -0,0 +1,566 @@
+"""
+Prometheus text-format metrics for the dashboard callbacks and queries.
+
+Callbacks registered with ``metrics.callback`` (``dash.callback``, timed) are
+timed, ``exec`` times every query through ``track_query``, and the
+``/metrics`` route that ``instrument_app`` adds renders it all in the
+Prometheus exposition format. Queries are labelled with the page and
+callback they ran under, so a slow query can be traced back to a view.
+
+Background callbacks run in forked job processes that exit (or are killed)
+once their result is stored. Each job hands its metrics to the web process
+by writing them to ``settings.METRICS_DIR`` before returning; the web process
+folds those files into its own registry when it is scraped.
+
+Under a preforking server every worker is a web process with its own
+registry. ``start_worker_snapshots`` has each worker keep a snapshot of its
+metrics in the same directory, and a scrape answered by any worker adds up
+all of them. Collector values (pool sizes, cache counters) are the answering
+worker's own.
+"""
+import contextvars
+import copy
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import dash
+from dash import Output
+from dash.exceptions import PreventUpdate
+from flask import Blueprint, Response, request
+
+from base import settings
+from query_cache import estimate_size
+
+logger = logging.getLogger(__name__)
+
+METRICS_PATH = "/metrics"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+BYTE_BUCKETS = (1024, 16384, 131072, 1048576, 8388608, 67108864)
+RESPONSE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 8388608)
+
+# Rows sampled to estimate the size of a list-of-tuples result.
+SIZE_SAMPLE_ROWS = 64
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, registry, name: str, documentation: str, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._registry = registry
+        self._values = {}
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _labels(self, key: tuple) -> dict:
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    """A monotonically increasing count per label set."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._registry.lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _merge(self, key: tuple, value) -> None:
+        self._values[key] = self._values.get(key, 0) + value
+
+    def _samples(self):
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+
+class Histogram(_Metric):
+    """Observations counted into cumulative ``le`` buckets, plus their sum and count."""
+
+    kind = "histogram"
+
+    def __init__(self, registry, name: str, documentation: str, labelnames, buckets):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._registry.lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def _merge(self, key: tuple, value) -> None:
+        counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+        self._values[key] = ([a + b for a, b in zip(counts, value[0])], total + value[1])
+
+    def _samples(self):
+        for key, (counts, total) in self._values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(float(bound))}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """
+    Process-local set of metrics, plus collectors read at scrape time.
+
+    A collector is a callable returning ``(name, documentation, kind, samples)``
+    tuples, ``samples`` being ``(labels, value)`` pairs; it is how gauges such
+    as pool sizes are exposed without being updated on every change.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        return self._add(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _add(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def add_collector(self, collector) -> None:
+        self._collectors.append(collector)
+
+    def reset(self) -> None:
+        """Drop every recorded value, e.g. in a freshly forked child."""
+        # The lock may have been held by another thread at fork time.
+        self.lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._values = {}
+
+    def dump(self, reset: bool = False) -> dict:
+        """Recorded values as JSON-serializable data, optionally clearing them."""
+        with self.lock:
+            data = {
+                name: [[list(key), value] for key, value in metric._values.items()]
+                for name, metric in self._metrics.items()
+                if metric._values
+            }
+            if reset:
+                for metric in self._metrics.values():
+                    metric._values = {}
+        return data
+
+    def merge(self, data: dict) -> None:
+        """Add values produced by ``dump`` in another process."""
+        with self.lock:
+            for name, values in data.items():
+                metric = self._metrics.get(name)
+                if metric is None:
+                    continue
+                for key, value in values:
+                    metric._merge(tuple(key), value)
+
+    def combined(self, others) -> "MetricsRegistry":
+        """A registry with the same metrics and collectors, holding this one's values plus ``others``."""
+        registry = MetricsRegistry()
+        for metric in self._metrics.values():
+            clone = copy.copy(metric)
+            clone._registry = registry
+            clone._values = {}
+            registry._add(clone)
+        registry._collectors = list(self._collectors)
+        registry.merge(self.dump())
+        for data in others:
+            registry.merge(data)
+        return registry
+
+    def render(self) -> str:
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            families = [
+                (metric.name, metric.documentation, metric.kind, list(metric._samples()))
+                for metric in self._metrics.values()
+            ]
+        for collector in self._collectors:
+            try:
+                for name, documentation, kind, samples in collector():
+                    families.append((name, documentation, kind, [(name, labels, value) for labels, value in samples]))
+            except Exception as e:
+                logger.warning("Metrics collector %r failed: %s", collector, e)
+
+        for name, documentation, kind, samples in families:
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples:
+                lines.append(f"{sample_name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=REGISTRY.reset)
+
+CALLBACK_DURATION = REGISTRY.histogram(
+    "dash_callback_duration_seconds", "Time spent running a Dash callback.", ("page", "callback")
+)
+CALLBACK_ERRORS = REGISTRY.counter(
+    "dash_callback_errors_total", "Dash callbacks that raised.", ("page", "callback")
+)
+QUERY_LABELS = ("database", "page", "callback", "query")
+QUERY_DURATION = REGISTRY.histogram(
+    "db_query_duration_seconds", "Query latency, including the wait for a pooled connection.", QUERY_LABELS
+)
+QUERY_ROWS = REGISTRY.histogram("db_query_rows", "Rows returned per query.", QUERY_LABELS, ROW_BUCKETS)
+QUERY_BYTES = REGISTRY.histogram(
+    "db_query_result_bytes", "Approximate in-memory size of query results.", QUERY_LABELS, BYTE_BUCKETS
+)
+QUERY_ERRORS = REGISTRY.counter("db_query_errors_total", "Queries that raised.", QUERY_LABELS)
+QUERY_COALESCED = REGISTRY.counter(
+    "db_query_coalesced_total", "Queries answered by an identical query already in flight.", QUERY_LABELS
+)
+POOL_WAIT = REGISTRY.histogram(
+    "db_pool_wait_seconds", "Time spent waiting to check out a pooled connection.", ("database",)
+)
+RESPONSE_BYTES = REGISTRY.histogram(
+    "http_response_bytes",
+    "Size of response bodies as sent, after compression.",
+    ("page", "callback", "encoding"),
+    RESPONSE_BUCKETS,
+)
+
+# (page, callback) of the callback running in this context, for query labels.
+_current_callback = contextvars.ContextVar("metrics_callback", default=("", ""))
+_server_pid = None
+_worker_snapshots = False
+# (component id, property) of every callback output -> the callback's
+# (page, callback) labels, to label the responses of its requests.
+_output_labels = {}
+
+
+def callback_labels(fn) -> tuple:
+    """``(page, callback)`` labels for a callback function."""
+    module = getattr(fn, "__module__", "") or ""
+    page = module[len("pages."):] if module.startswith("pages.") else module
+    return page, getattr(fn, "__name__", "callback")
+
+
+@contextmanager
+def track_callback(page: str, callback: str):
+    """Time the block as one run of ``callback``; queries inside it carry its labels."""
+    token = _current_callback.set((page, callback))
+    started = time.perf_counter()
+    try:
+        yield
+    except PreventUpdate:
+        raise
+    except Exception:
+        CALLBACK_ERRORS.inc(page=page, callback=callback)
+        raise
+    finally:
+        CALLBACK_DURATION.observe(time.perf_counter() - started, page=page, callback=callback)
+        _current_callback.reset(token)
+
+
+def result_size(result) -> tuple:
+    """``(rows, bytes)`` of a query result: rows, a dict of column arrays or a DataFrame."""
+    if isinstance(result, dict):
+        columns = list(result.values())
+        return (len(columns[0]) if columns else 0), sum(getattr(column, "nbytes", 0) for column in columns)
+    if hasattr(result, "memory_usage"):
+        return len(result), int(result.memory_usage(index=False).sum())
+    rows = len(result)
+    if not rows:
+        return 0, 0
+    sample = result[:SIZE_SAMPLE_ROWS]
+    return rows, estimate_size(sample) * rows // len(sample)
+
+
+class _QueryObservation:
+    __slots__ = ("rows", "bytes")
+
+    def __init__(self):
+        self.rows = None
+        self.bytes = None
+
+    def record(self, result) -> None:
+        self.rows, self.bytes = result_size(result)
+
+
+@contextmanager
+def track_query(database: str, query: str):
+    """
+    Time a query; call ``record(result)`` on the yielded object to count its rows and bytes.
+
+    Args:
+    - database (str): ``"postgres"`` or ``"clickhouse"``.
+    - query (str): Query name label, usually the calling function.
+    """
+    page, callback = _current_callback.get()
+    labels = {"database": database, "page": page, "callback": callback, "query": query}
+    observation = _QueryObservation()
+    started = time.perf_counter()
+    try:
+        yield observation
+    except Exception:
+        QUERY_ERRORS.inc(**labels)
+        raise
+    finally:
+        QUERY_DURATION.observe(time.perf_counter() - started, **labels)
+        if observation.rows is not None:
+            QUERY_ROWS.observe(observation.rows, **labels)
+            QUERY_BYTES.observe(observation.bytes, **labels)
+
+
+def observe_coalesced(database: str, query: str) -> None:
+    """Count a query that shared an identical in-flight query's round trip instead of running."""
+    page, callback = _current_callback.get()
+    QUERY_COALESCED.inc(database=database, page=page, callback=callback, query=query)
+
+
+def observe_pool_wait(database: str, seconds: float) -> None:
+    POOL_WAIT.observe(seconds, database=database)
+
+
+def flush() -> None:
+    """
+    Hand this process's metrics to the web process through ``settings.METRICS_DIR``.
+
+    Only does anything in a forked job process; the web process keeps its
+    metrics in memory.
+    """
+    if _server_pid is None or os.getpid() == _server_pid:
+        return
+    data = REGISTRY.dump(reset=True)
+    if not data:
+        return
+    try:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        path = os.path.join(settings.METRICS_DIR, f"{os.getpid()}-{uuid.uuid4().hex}.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning("Could not write metrics to %s: %s", settings.METRICS_DIR, e)
+
+
+def _absorb_flushed() -> None:
+    try:
+        names = os.listdir(settings.METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(settings.METRICS_DIR, name)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            os.remove(path)
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping metrics file %s: %s", path, e)
+            continue
+        REGISTRY.merge(data)
+
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(settings.METRICS_DIR, f"worker-{pid}.snapshot")
+
+
+def write_worker_snapshot() -> None:
+    """Write this worker's metrics where the other workers' scrapes read them."""
+    path = _snapshot_path(os.getpid())
+    try:
+        os.makedirs(settings.METRICS_DIR, exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(REGISTRY.dump(), f)
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        logger.warning("Could not write metrics to %s: %s", settings.METRICS_DIR, e)
+
+
+def _other_worker_snapshots():
+    own = os.path.basename(_snapshot_path(os.getpid()))
+    try:
+        names = os.listdir(settings.METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        # Snapshots of workers that have exited stay, so totals never go
+        # backwards across a graceful reload.
+        if not name.startswith("worker-") or not name.endswith(".snapshot") or name == own:
+            continue
+        path = os.path.join(settings.METRICS_DIR, name)
+        try:
+            with open(path) as f:
+                yield json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping metrics snapshot %s: %s", path, e)
+
+
+def clear_worker_snapshots() -> None:
+    """Remove every worker snapshot; for the server to call once at start-up."""
+    try:
+        names = os.listdir(settings.METRICS_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name.startswith("worker-") and name.endswith(".snapshot"):
+            try:
+                os.remove(os.path.join(settings.METRICS_DIR, name))
+            except OSError:
+                pass
+
+
+def start_worker_snapshots() -> threading.Thread:
+    """
+    Make this process a web process that shares its metrics with its sibling workers.
+
+    Call in each worker right after the fork. Its snapshot is rewritten every
+    ``settings.METRICS_SNAPSHOT_INTERVAL`` seconds and on every scrape it answers.
+    """
+    global _server_pid, _worker_snapshots
+    _server_pid = os.getpid()
+    _worker_snapshots = True
+
+    def run():
+        while True:
+            time.sleep(settings.METRICS_SNAPSHOT_INTERVAL)
+            write_worker_snapshot()
+
+    thread = threading.Thread(target=run, name="metrics-snapshot", daemon=True)
+    thread.start()
+    return thread
+
+
+def _instrument(fn, flush_after: bool):
+    page, name = callback_labels(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            with track_callback(page, name):
+                return fn(*args, **kwargs)
+        finally:
+            # Must happen before the job stores its result: the job process
+            # is terminated as soon as the result has been read.
+            if flush_after:
+                flush()
+
+    return wrapper
+
+
+def _output_key(component_id, component_property) -> tuple:
+    # Pattern-matching ids are dicts; key them by their JSON.
+    if isinstance(component_id, dict):
+        component_id = json.dumps(component_id, sort_keys=True)
+    return component_id, component_property
+
+
+def _outputs(args, kwargs):
+    for value in (*args, kwargs.get("output")):
+        for item in value if isinstance(value, (list, tuple)) else [value]:
+            if isinstance(item, Output):
+                yield item
+
+
+def callback(*args, **kwargs):
+    """
+    ``dash.callback``, with every run of the callback timed under its page and name.
+
+    Takes the same arguments. Regular callbacks are timed where Dash
+    dispatches them; background callbacks are timed inside their job, since
+    the dispatch only starts the job and polls for its result, and the job
+    flushes its metrics before returning.
+    """
+
+    def decorator(fn):
+        labels = callback_labels(fn)
+        for output in _outputs(args, kwargs):
+            _output_labels[_output_key(output.component_id, output.component_property)] = labels
+        return dash.callback(*args, **kwargs)(_instrument(fn, flush_after=bool(kwargs.get("background"))))
+
+    return decorator
+
+
+def _observe_response_size(response):
+    # Streamed responses (exports) have no size until they are sent.
+    if response.is_streamed:
+        return response
+    if request.path.endswith("_dash-update-component"):
+        # Callback requests name their outputs; the first one identifies the callback.
+        output = (request.get_json(silent=True) or {}).get("outputs")
+        while isinstance(output, list):
+            output = output[0] if output else None
+        labels = _output_labels.get(_output_key(output.get("id"), output.get("property"))) if output else None
+        page, name = labels or ("", "unknown")
+    else:
+        page, name = "", request.endpoint or "unknown"
+    encoding = response.headers.get("Content-Encoding", "identity")
+    RESPONSE_BYTES.observe(response.calculate_content_length() or 0, page=page, callback=name, encoding=encoding)
+    return response
+
+
+metrics_bp = Blueprint("metrics", __name__)
+
+
+@metrics_bp.route(METRICS_PATH)
+def metrics():
+    _absorb_flushed()
+    if not _worker_snapshots:
+        return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+    write_worker_snapshot()
+    registry = REGISTRY.combined(_other_worker_snapshots())
+    return Response(registry.render(), content_type=CONTENT_TYPE)
+
+
+def instrument_app(app) -> None:
+    """
+    Serve ``/metrics`` on ``app.server`` and record response sizes.
+
+    Sizes are recorded per callback and content encoding. Call once
+    compression is set up. Callbacks are timed by registering them with
+    ``metrics.callback``.
+    """
+    global _server_pid
+    _server_pid = os.getpid()
+
+    # Flask runs after_request functions last registered first; at the front
+    # of the list this one runs after compression and sees the final size.
+    app.server.after_request_funcs.setdefault(None, []).insert(0, _observe_response_size)
+    app.server.register_blueprint(metrics_bp)
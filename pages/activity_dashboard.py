@@ -1,125 +1,284 @@
+import logging
+
 import dash
-import pytz
-from dash import dcc, html, Input, Output, dash_table, callback
-import pandas as pd
-from exec import execute_postgres_query
+from dash import dcc, html, Input, Output, State, dash_table, clientside_callback
+from dash.exceptions import PreventUpdate
+from background import PAGE_LOCATION, TOO_MANY_JOBS_MESSAGE, limit_jobs_per_user
+from base import settings
+from export import export_url
+from metrics import callback
+from results import table_records
+from tenant_directory import get_tenant_directory
+from write_history import (
+    ACTIVITY_COLUMNS,
+    PAGE_SIZE,
+    fetch_runs,
+    fetch_runs_since,
+    format_datetimes,
+    last_row_cursor,
+    row_cursor,
+    seek_column,
+    seek_position,
+    table_filters,
+)
+
+logger = logging.getLogger(__name__)
+
+TENANT_SUGGESTIONS = 20
+# Not displayed; live refresh merges new rows by id.
+HIDDEN_COLUMNS = ("id",)
 
 dash.register_page(__name__, path='/activity-dashboard')
 
-layout = html.Div(
-    [
-        html.Div(
-            [
-                html.H1(
-                    "Tenant Activity Dashboard",
+TABLE_COLUMNS = [
+    {"name": "Tenant ID", "id": "tenant_id"},
+    {"name": "Base Domain", "id": "base_domain"},
+    {"name": "Name", "id": "name"},
+    {"name": "Contact Email", "id": "contact_email"},
+    {"name": "Finished At (IST)", "id": "finished_at", "type": "datetime"},
+    {"name": "Last Event Time (IST)", "id": "last_event_timestamp", "type": "datetime"},
+    {"name": "Duration", "id": "duration", "type": "numeric"},
+]
+
+
+def layout(**kwargs):
+    return html.Div(
+        [
+            html.Div(
+                [
+                    html.H1(
+                        "Tenant Activity Dashboard",
+                        style={
+                            "textAlign": "center",
+                            "color": "#ffffff",
+                            "font-family": "Arial, sans-serif",
+                            "font-size": "24px",
+                        },
+                    ),
+                ],
+                style={
+                    "padding": "20px",
+                    "backgroundColor": "#0f082d",
+                    "borderBottom": "4px solid #ea0d13",
+                },
+            ),
+            html.Div([
+                dcc.Dropdown(
+                    id="tenant-id-input",
+                    placeholder="Search tenants by ID, name, domain or email",
+                    options=[],
+                    searchable=True,
                     style={
-                        "textAlign": "center",
-                        "color": "#ffffff",
-                        "font-family": "Arial, sans-serif",
-                        "font-size": "24px",
+                        "width": "420px",
+                        "font-size": "16px",
+                        "margin-right": "10px",
                     },
                 ),
-            ],
-            style={
-                "padding": "20px",
-                "backgroundColor": "#0f082d",
-                "borderBottom": "4px solid #ea0d13",
-            },
-        ),
-        html.Div([
-            dcc.Input(
-                id="tenant-id-input",
-                type="text",
-                placeholder="Enter Tenant ID",
-                style={
-                    "margin-bottom": "10px",
-                    "padding": "10px",
-                    "font-size": "16px",
+                html.Button(
+                    "Search",
+                    id="search-button",
+                    n_clicks=0,
+                    style={
+                        "padding": "10px 20px",
+                        "background-color": "#0056b3",
+                        "color": "white",
+                        "border": "none",
+                        "borderRadius": "5px",
+                        "font-size": "16px",
+                        "margin-right": "10px",
+                    },
+                ),
+                html.Button(
+                    "ACTIVE",
+                    id="active-button",
+                    n_clicks=0,
+                    style={
+                        "padding": "10px 20px",
+                        "background-color": "#FFC0CB",
+                        "color": "black",
+                        "border": "none",
+                        "borderRadius": "5px",
+                        "font-size": "16px",
+                        "margin-right": "10px",
+                    },
+                ),
+                html.A(
+                    "Download CSV",
+                    id="activity-download-csv",
+                    href=export_url("csv"),
+                    style={
+                        "padding": "10px 20px",
+                        "background-color": "#0f082d",
+                        "color": "white",
+                        "borderRadius": "5px",
+                        "font-size": "16px",
+                        "text-decoration": "none",
+                        "margin-right": "10px",
+                    },
+                ),
+                html.A(
+                    "Download Parquet",
+                    id="activity-download-parquet",
+                    href=export_url("parquet"),
+                    style={
+                        "padding": "10px 20px",
+                        "background-color": "#0f082d",
+                        "color": "white",
+                        "borderRadius": "5px",
+                        "font-size": "16px",
+                        "text-decoration": "none",
+                        "margin-right": "10px",
+                    },
+                ),
+                dcc.Checklist(
+                    id="activity-live-toggle",
+                    options=[{"label": " Live", "value": "live"}],
+                    value=[],
+                    style={"font-size": "16px"},
+                ),
+            ], style={"display": "flex", "alignItems": "center", "marginBottom": "20px"}),
+            html.Div(id="activity-progress", style={"marginBottom": "10px", "color": "#0056b3"}),
+            html.Div(id="activity-live-status", style={"marginBottom": "10px", "color": "#0056b3"}),
+            dash_table.DataTable(
+                id="data-table",
+                columns=TABLE_COLUMNS,
+                # Sorted, filtered and paged by the database.
+                page_action="custom",
+                page_current=0,
+                page_size=PAGE_SIZE,
+                sort_action="custom",
+                sort_by=[],
+                filter_action="custom",
+                filter_query="",
+                style_table={
+                    "overflowX": "auto",
+                    "border": "1px solid #007BFF",
+                    "font-size": "14px",
+                    "backgroundColor": "#0f082d",
+                    "boxShadow": "0 2px 4px rgba(0,0,0,0.1)",
                     "borderRadius": "5px",
-                    "border": "1px solid #ea0d13",
-                    "margin-right": "10px",
                 },
-            ),
-            html.Button(
-                "Search",
-                id="search-button",
-                n_clicks=0,
-                style={
-                    "padding": "10px 20px",
-                    "background-color": "#0056b3",
+                style_header={
+                    "backgroundColor": "#0f082d",
                     "color": "white",
-                    "border": "none",
-                    "borderRadius": "5px",
-                    "font-size": "16px",
-                    "margin-right": "10px",
+                    "fontWeight": "bold",
+                    "border": "1px solid #0056b3",
                 },
+                style_data_conditional=[
+                    {
+                        "if": {"row_index": "even"},
+                        "backgroundColor": "#f1f1f1",
+                        "border": "1px solid #007BFF",
+                    }
+                ],
             ),
-            html.Button(
-                "ACTIVE",
-                id="active-button",
-                n_clicks=0,
+            html.Div(
+                id="tenant-summary",
                 style={
-                    "padding": "10px 20px",
-                    "background-color": "#FFC0CB",
-                    "color": "black",
-                    "border": "none",
-                    "borderRadius": "5px",
-                    "font-size": "16px",
+                    "margin-top": "20px",
+                    "font-weight": "bold",
+                    "text-align": "center",
+                    "color": "#0056b3",
+                    "font-size": "18px",
                 },
             ),
-        ], style={"display": "flex", "alignItems": "center", "marginBottom": "20px"}),
-        dash_table.DataTable(
-            id="data-table",
-            columns=[
-                {"name": "Tenant ID", "id": "tenant_id"},
-                {"name": "Base Domain", "id": "base_domain"},
-                {"name": "Name", "id": "name"}, 
-                {"name": "Contact Email", "id": "contact_email"},  
-                {"name": "Finished At (IST)", "id": "finished_at"},
-                {"name": "Last Event Time (IST)", "id": "last_event_timestamp"},
-            ],
-            page_size=20,
-            style_table={
-                "overflowX": "auto",
-                "border": "1px solid #007BFF",
-                "font-size": "14px",
-                "backgroundColor": "#0f082d",
-                "boxShadow": "0 2px 4px rgba(0,0,0,0.1)",
-                "borderRadius": "5px",
-            },
-            style_header={
-                "backgroundColor": "#0f082d",
-                "color": "white",
-                "fontWeight": "bold",
-                "border": "1px solid #0056b3",
-            },
-            style_data_conditional=[
-                {
-                    "if": {"row_index": "even"},
-                    "backgroundColor": "#f1f1f1",
-                    "border": "1px solid #007BFF",
-                }
-            ],
-        ),
-        html.Div(
-            id="tenant-summary",
-            style={
-                "margin-top": "20px",
-                "font-weight": "bold",
-                "text-align": "center",
-                "color": "#0056b3",
-                "font-size": "18px",
-            },
-        ),
-    ]
-)
+            dcc.Interval(
+                id="activity-live-interval",
+                interval=int(settings.LIVE_REFRESH_INTERVAL * 1000),
+                disabled=True,
+            ),
+            dcc.Store(
+                id="activity-live-config",
+                data={
+                    "interval_ms": int(settings.LIVE_REFRESH_INTERVAL * 1000),
+                    "max_interval_ms": int(settings.LIVE_REFRESH_MAX_INTERVAL * 1000),
+                    "window": settings.LIVE_REFRESH_WINDOW,
+                },
+            ),
+            # Filters and [finished_at, id] of the newest run on screen.
+            dcc.Store(id="activity-live-state"),
+            dcc.Store(id="activity-live-tick"),
+            dcc.Store(id="activity-live-batch"),
+            # The search, sort and filter being paged through, and its keyset cursors.
+            dcc.Store(id="activity-paging"),
+        ]
+    )
+
 
 @callback(
-    [Output("data-table", "data"), Output("tenant-summary", "children")],
+    [Output("activity-download-csv", "href"), Output("activity-download-parquet", "href")],
     [Input("search-button", "n_clicks"), Input("active-button", "n_clicks")],
     [Input("tenant-id-input", "value")]
 )
-def update_table(search_clicks, active_clicks, tenant_id):
+def update_download_links(search_clicks, active_clicks, tenant_id):
+    ctx = dash.callback_context
+    button_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
+    if button_id == "active-button":
+        filters = {"active_tenants": "1"}
+    else:
+        filters = {"tenant_id": tenant_id}
+    return export_url("csv", **filters), export_url("parquet", **filters)
+
+
+def tenant_option(tenant: dict) -> dict:
+    label = f"{tenant['tenant_name'] or tenant['tenant_id']} ({tenant['base_domain'] or 'no domain'})"
+    if tenant["deleted"]:
+        label += " [deleted]"
+    # The dropdown filters options again client-side; searching on every
+    # field keeps all the server-side matches visible.
+    search = " ".join(
+        str(tenant[field] or "") for field in ("tenant_id", "tenant_name", "base_domain", "contact_email")
+    )
+    return {"label": label, "value": tenant["tenant_id"], "search": search}
+
+
+@callback(
+    Output("tenant-id-input", "options"),
+    Input("tenant-id-input", "search_value"),
+    State("tenant-id-input", "value"),
+)
+def update_tenant_options(search_value, tenant_id):
+    if not search_value:
+        raise PreventUpdate
+
+    directory = get_tenant_directory()
+    options = [tenant_option(tenant) for tenant in directory.search(search_value, limit=TENANT_SUGGESTIONS)]
+    if not directory.loaded:
+        # Still loading: let an exact ID through as typed.
+        options = [{"label": search_value, "value": search_value}]
+    # Keep the current selection selectable, or the dropdown clears it.
+    if tenant_id and all(option["value"] != tenant_id for option in options):
+        selected = directory.get(tenant_id)
+        options.append(tenant_option(selected) if selected else {"label": tenant_id, "value": tenant_id})
+    return options
+
+
+@callback(
+    [Output("data-table", "data"),
+     Output("tenant-summary", "children"),
+     Output("activity-live-state", "data"),
+     Output("data-table", "page_count"),
+     Output("data-table", "page_current"),
+     Output("activity-paging", "data")],
+    [Input("search-button", "n_clicks"), Input("active-button", "n_clicks")],
+    [Input("tenant-id-input", "value"),
+     Input("data-table", "page_current"),
+     Input("data-table", "sort_by"),
+     Input("data-table", "filter_query")],
+    [State("activity-paging", "data"), State("current-user", "data")],
+    background=True,
+    progress=Output("activity-progress", "children"),
+    progress_default="",
+    cancel=[Input(PAGE_LOCATION, "pathname")],
+)
+@limit_jobs_per_user(
+    on_limit=lambda: (
+        dash.no_update, TOO_MANY_JOBS_MESSAGE, dash.no_update, dash.no_update, dash.no_update, dash.no_update
+    )
+)
+def update_table(
+    set_progress, search_clicks, active_clicks, tenant_id, page_current, sort_by, filter_query, paging, current_user
+):
     ctx = dash.callback_context
     if not ctx.triggered:
         button_id = None
@@ -127,113 +286,147 @@ def update_table(search_clicks, active_clicks, tenant_id):
         button_id = ctx.triggered[ 0]['prop_id'].split('.')[0]
 
     if button_id == "active-button":
-        query = """
-        SELECT 
-            cwh.*, 
-            TO_TIMESTAMP(cwh.last_event_received_at / 1000) AS last_event_timestamp,
-            TO_TIMESTAMP(cwh.first_event_received_at / 1000) AS first_event_timestamp,
-            tenant.base_domain,
-            tenant.name,
-            tenant.contact_email 
-        FROM core_master.clickhouse_write_history cwh
-        LEFT JOIN core_master.tenant tenant
-        ON cwh.tenant_id = tenant.id
-        WHERE tenant.deleted_date IS NULL
-        ORDER BY cwh.finished_at DESC
-        LIMIT 20;
-        """
-        params = {}
+        filters = {"active_tenants": True}
+    elif button_id == "data-table" and paging:
+        # Paging, sorting or filtering the table keeps the current search.
+        filters = paging["view"]["filters"]
     else:
-        if tenant_id:
-            query = """
-            SELECT 
-                cwh.*, 
-                TO_TIMESTAMP(cwh.last_event_received_at / 1000) AS last_event_timestamp,
-                TO_TIMESTAMP(cwh.first_event_received_at / 1000) AS first_event_timestamp,
-                tenant.base_domain,
-                tenant.name,
-                tenant.contact_email 
-            FROM core_master.clickhouse_write_history cwh
-            LEFT JOIN core_master.tenant tenant
-            ON cwh.tenant_id = tenant.id
-            WHERE cwh.tenant_id = %(tenant_id)s
-            ORDER BY cwh.finished_at DESC
-            LIMIT 20;
-            """
-            params = {"tenant_id": tenant_id}
-        else:
-            query = """
-            SELECT 
-                cwh.*, 
-                TO_TIMESTAMP(cwh.last_event_received_at / 1000) AS last_event_timestamp,
-                TO_TIMESTAMP(cwh.first_event_received_at / 1000) AS first_event_timestamp,
-                tenant.base_domain,
-                tenant.name,
-                tenant.contact_email  
-            FROM core_master.clickhouse_write_history cwh
-            LEFT JOIN core_master.tenant tenant
-            ON cwh.tenant_id = tenant.id
-            ORDER BY cwh.finished_at DESC 
-            LIMIT 20;
-            """
-            params = {}
+        filters = {"tenant_id": tenant_id or None}
+
+    # Cursors are only valid for the search, sort and filter they were collected under.
+    view = {"filters": filters, "sort_by": sort_by or [], "filter_query": filter_query or ""}
+    if not paging or paging["view"] != view:
+        paging = {"view": view, "cursors": {}}
+        page_current = 0
+    page_current = page_current or 0
+    cursor, offset = seek_position(page_current, paging["cursors"])
 
     try:
-        pg_result = execute_postgres_query(
-            query=query,
-            params=params,
-            tenant_id=tenant_id if tenant_id else "public",
-            echo_query=False,
-            echo_params=False,
-        )
-
-        if pg_result:
-            columns = [
-                "id",
-                "tenant_id",
-                "last_event_recieved_at",
-                "finished_at",
-                "records_count",
-                "error_count",
-                "duration",
-                "db_persist_duration",
-                "run_id",
-                "first_event_recieved_at",
-                "last_event_timestamp",
-                "first_event_timestamp",
-                "base_domain",
-                "name",  
-                "contact_email"  
-            ]
-            df = pd.DataFrame(pg_result, columns=columns)
-            
-            df["finished_at"] = pd.to_datetime(df["finished_at"])
-            df["last_event_timestamp"] = pd.to_datetime(df["last_event_timestamp"])
-            df["first_event_timestamp"] = pd.to_datetime(df["first_event_timestamp"])
-
-            def convert_to_ist(dt):
-                if dt.tzinfo is None:
-                    return dt.tz_localize('UTC').tz_convert(ist)
-                else:
-                    return dt.tz_convert(ist)
-
-            ist = pytz.timezone('Asia/Kolkata')
-
-            df["finished_at"] = df["finished_at"].apply(convert_to_ist)
-            df["last_event_timestamp"] = df["last_event_timestamp"].apply(convert_to_ist)
-            df["first_event_timestamp"] = df["first_event_timestamp"].apply(convert_to_ist)
-
-            df["finished_at"] = df["finished_at"].dt.strftime("%Y-%m-%d %H:%M:%S")
-            df["last_event_timestamp"] = df["last_event_timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
-            df["first_event_timestamp"] = df["first_event_timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
+        query_filters = table_filters(filters, filter_query)
+        set_progress("Querying write history...")
+        df = fetch_runs(ACTIVITY_COLUMNS, filters=query_filters, after=cursor, offset=offset, sort_by=sort_by)
+
+        column = seek_column(sort_by)
+        if column and not df.empty:
+            paging["cursors"][str(page_current)] = last_row_cursor(df, column)
+        page_count = page_current + 2 if len(df) == PAGE_SIZE else page_current + 1
+
+        # Live refresh picks up from the newest run shown here, when the
+        # table shows the newest runs at all.
+        live_state = None
+        if page_current == 0 and not sort_by:
+            live_state = {"filters": query_filters, "cursor": row_cursor(df, 0) if not df.empty else None}
+
+        if not df.empty:
+            set_progress(f"Formatting {len(df)} rows...")
+            format_datetimes(df)
 
             row_count = len(df)
             error_count = df["error_count"].sum()
             summary = f"Row Count: {row_count}, Error Count: {error_count}"
 
-            return df.to_dict("records"), summary
+            records = table_records(df, TABLE_COLUMNS, HIDDEN_COLUMNS)
+            return records, summary, live_state, page_count, page_current, paging
 
-        return [], "No data found for the specified criteria."
+        return [], "No data found for the specified criteria.", live_state, page_count, page_current, paging
 
     except Exception as e:
-        return [], f"An error occurred: {str(e)}"
\ No newline at end of file
+        return [], f"An error occurred: {str(e)}", None, page_current + 1, page_current, paging
+
+
+# Turns the interval on and off with the Live toggle and decides whether each
+# tick polls. While the tab is hidden ticks are skipped and the interval
+# doubles up to the configured maximum; it drops back to normal as soon as
+# the tab is visible again.
+clientside_callback(
+    """
+    function(n_intervals, live, config, interval) {
+        const noUpdate = window.dash_clientside.no_update;
+        const base = config.interval_ms;
+        if (!window.activityLiveVisibilityListener) {
+            window.activityLiveVisibilityListener = true;
+            document.addEventListener("visibilitychange", function() {
+                if (!document.hidden && window.dash_clientside.set_props) {
+                    window.dash_clientside.set_props("activity-live-interval", {interval: base});
+                }
+            });
+        }
+        const triggered = window.dash_clientside.callback_context.triggered.map(t => t.prop_id);
+        if (!triggered.includes("activity-live-interval.n_intervals")) {
+            return [noUpdate, base, !(live && live.length)];
+        }
+        if (document.hidden) {
+            return [noUpdate, Math.min(interval * 2, config.max_interval_ms), noUpdate];
+        }
+        return [n_intervals, interval === base ? noUpdate : base, noUpdate];
+    }
+    """,
+    [
+        Output("activity-live-tick", "data"),
+        Output("activity-live-interval", "interval"),
+        Output("activity-live-interval", "disabled"),
+    ],
+    [Input("activity-live-interval", "n_intervals"), Input("activity-live-toggle", "value")],
+    [State("activity-live-config", "data"), State("activity-live-interval", "interval")],
+)
+
+
+@callback(
+    Output("activity-live-batch", "data"),
+    Input("activity-live-tick", "data"),
+    State("activity-live-state", "data"),
+    prevent_initial_call=True,
+)
+def poll_new_runs(tick, live_state):
+    """Fetch only the runs newer than the newest one on screen."""
+    if not live_state:
+        raise PreventUpdate
+
+    filters, cursor = live_state["filters"], live_state["cursor"]
+    try:
+        if cursor is None:
+            df = fetch_runs(
+                ACTIVITY_COLUMNS, filters=filters, limit=settings.LIVE_REFRESH_BATCH_SIZE, use_cache=False
+            ).iloc[::-1]
+        else:
+            df = fetch_runs_since(ACTIVITY_COLUMNS, cursor, settings.LIVE_REFRESH_BATCH_SIZE, filters=filters)
+    except Exception:
+        logger.exception("Live refresh of the activity table failed")
+        raise PreventUpdate
+
+    if df.empty:
+        raise PreventUpdate
+
+    newest = last_row_cursor(df)
+    format_datetimes(df)
+    rows = table_records(df, TABLE_COLUMNS, HIDDEN_COLUMNS)
+    return {"filters": filters, "since": cursor, "cursor": newest, "rows": rows}
+
+
+# Merges a batch of new runs into the table, newest first, keeping at most
+# the configured window of rows. A batch is dropped if the table has moved
+# on since its poll started (a new search, or another batch got there first).
+clientside_callback(
+    """
+    function(batch, data, state, config) {
+        const noUpdate = window.dash_clientside.no_update;
+        if (!batch || !state
+            || JSON.stringify([batch.filters, batch.since]) !== JSON.stringify([state.filters, state.cursor])) {
+            return [noUpdate, noUpdate, noUpdate];
+        }
+        const fresh = batch.rows.slice().reverse();
+        const seen = new Set(fresh.map(row => row.id));
+        const merged = fresh.concat((data || []).filter(row => !seen.has(row.id))).slice(0, config.window);
+        const status = `${batch.rows.length} new run(s) at ${new Date().toLocaleTimeString()}`;
+        return [merged, Object.assign({}, state, {cursor: batch.cursor}), status];
+    }
+    """,
+    [
+        Output("data-table", "data", allow_duplicate=True),
+        Output("activity-live-state", "data", allow_duplicate=True),
+        Output("activity-live-status", "children"),
+    ],
+    Input("activity-live-batch", "data"),
+    [State("data-table", "data"), State("activity-live-state", "data"), State("activity-live-config", "data")],
+    prevent_initial_call=True,
+)
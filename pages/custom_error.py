@@ -1,359 +1,637 @@
-import pandas as pd
-from dash import dcc, html, Input, Output, dash_table, callback, State
+import logging
+import math
+import time
+from datetime import datetime, timezone
+
+from dash import dcc, html, Input, Output, dash_table, State
 import dash
-from exec import execute_postgres_query
-import pytz
+from background import PAGE_LOCATION, TOO_MANY_JOBS_MESSAGE, limit_jobs_per_user
+from base import settings
+from error_rollup import get_error_rollup
+from export import export_url
+from metrics import callback
+from results import format_ist, table_records
+from tenant_history import get_tenant_history
+from write_history import (
+    HIGH_ERROR_COLUMNS,
+    PAGE_SIZE,
+    bucket_width,
+    estimate_runs,
+    fetch_run_buckets,
+    fetch_runs,
+    fetch_tenants,
+    format_datetimes,
+    last_row_cursor,
+    seek_column,
+    seek_position,
+    table_filters,
+)
+
+logger = logging.getLogger(__name__)
 
 dash.register_page(__name__, path='/custom-error')
 
-layout = html.Div(
-    [
-        html.Div(
-            [
-                html.H1(
-                    "Error Filtered Tenants Dashboard",
-                    style={
-                        "textAlign": "center",
-                        "color": "#ea0d13",
-                        "fontSize": "32px",
-                        "fontWeight": "bold",
-                        "marginBottom": "20px",
-                        "textShadow": "2px 2px 4px rgba(0,0,0,0.1)"
-                    },
-                ),
-            ],
-            style={
-                "backgroundColor": "white",
-                "padding": "20px",
-                "borderRadius": "10px",
-                "marginBottom": "20px",
-                "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
-            }
-        ),
-
-        html.Div(
-            [
-                html.Div(
-                    [
-                        html.Label(
-                            "Error Rate Threshold:", 
-                            style={"marginRight": "10px", "fontWeight": "bold"}
-                        ),
-                        dcc.Dropdown(
-                            id="error-threshold-dropdown",
-                            options=[
-                                {"label": "10%", "value": 10},
-                                {"label": "20%", "value": 20},
-                                {"label": "30%", "value": 30},
-                                {"label": "50%", "value": 50},
-                            ],
-                            value=20,
-                            placeholder="Select error rate threshold",
-                            style={
-                                "width": "200px",
-                                "display": "inline-block",
-                                "verticalAlign": "middle"
-                            },
-                        ),
-                    ],
-                    style={
-                        "display": "flex", 
-                        "justifyContent": "center", 
-                        "alignItems": "center",
-                        "marginBottom": "20px"
-                    }
-                )
-            ],
-            style={
-                "backgroundColor": "white",
-                "padding": "15px",
-                "borderRadius": "10px",
-                "marginBottom": "20px",
-                "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
-            }
-        ),
-
-        html.Div(
-            [
-                dash_table.DataTable(
-                    id="high-error-table",
-                    columns=[
-                        {"name": "Tenant ID", "id": "tenant_id"},
-                        {"name": "Tenant Name", "id": "tenant_name"},
-                        {"name": "Base Domain", "id": "base_domain"},
-                        {"name": "Contact Email", "id": "contact_email"},  
-                        {"name": "Error Count", "id": "error_count"},
-                        {"name": "Total Events", "id": "records_count"},
-                    ],
-                    page_size=20,
-                    style_table={
-                        "overflowX": "auto",
-                        "border": "1px solid #ddd",
-                        "borderRadius": "5px",
-                    },
-                    style_header={
-                        "backgroundColor": "#ea0d13",
-                        "color": "white",
-                        "fontWeight": "bold",
-                        "textAlign": "center",
-                        "padding": "12px",
-                        "textTransform": "uppercase"
-                    },
-                    style_data={
-                        "backgroundColor": "#f9f9f9",
-                        "color": "#333",
-                        "border": "1px solid #ddd",
-                        "padding": "10px"
-                    },
-                    style_data_conditional=[
-                        {
-                            "if": {"row_index": "even"},
-                            "backgroundColor": "#f1f1f1",
+HIGH_ERROR_TABLE_COLUMNS = [
+    {"name": "Tenant ID", "id": "tenant_id"},
+    {"name": "Tenant Name", "id": "tenant_name"},
+    {"name": "Base Domain", "id": "base_domain"},
+    {"name": "Contact Email", "id": "contact_email"},
+    {"name": "Error Count", "id": "error_count", "type": "numeric"},
+    {"name": "Total Events", "id": "records_count", "type": "numeric"},
+]
+
+TREND_RANGES = [
+    {"label": "24 hours", "value": 1},
+    {"label": "7 days", "value": 7},
+    {"label": "30 days", "value": 30},
+    {"label": "90 days", "value": 90},
+    {"label": "1 year", "value": 365},
+]
+
+TENANT_ERROR_RATE_TABLE_COLUMNS = [
+    {"name": "Tenant ID", "id": "tenant_id"},
+    {"name": "Tenant Name", "id": "tenant_name"},
+    {"name": "Base Domain", "id": "base_domain"},
+    {"name": "Runs", "id": "runs"},
+    {"name": "Total Events", "id": "records_count"},
+    {"name": "Error Count", "id": "error_count"},
+    {"name": "Error Rate (%)", "id": "error_rate"},
+]
+
+
+def layout(**kwargs):
+    return html.Div(
+        [
+            html.Div(
+                [
+                    html.H1(
+                        "Error Filtered Tenants Dashboard",
+                        style={
+                            "textAlign": "center",
+                            "color": "#ea0d13",
+                            "fontSize": "32px",
+                            "fontWeight": "bold",
+                            "marginBottom": "20px",
+                            "textShadow": "2px 2px 4px rgba(0,0,0,0.1)"
                         },
-                        {
-                            "if": {"state": "active"},
-                            "backgroundColor": "rgba(234, 13, 19, 0.1)",
-                            "border": "2px solid #ea0d13",
+                    ),
+                ],
+                style={
+                    "backgroundColor": "white",
+                    "padding": "20px",
+                    "borderRadius": "10px",
+                    "marginBottom": "20px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
+                }
+            ),
+
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.Label(
+                                "Error Rate Threshold:", 
+                                style={"marginRight": "10px", "fontWeight": "bold"}
+                            ),
+                            dcc.Dropdown(
+                                id="error-threshold-dropdown",
+                                options=[
+                                    {"label": "10%", "value": 10},
+                                    {"label": "20%", "value": 20},
+                                    {"label": "30%", "value": 30},
+                                    {"label": "50%", "value": 50},
+                                ],
+                                value=20,
+                                placeholder="Select error rate threshold",
+                                style={
+                                    "width": "200px",
+                                    "display": "inline-block",
+                                    "verticalAlign": "middle"
+                                },
+                            ),
+                            html.A(
+                                "Download",
+                                id="high-error-download",
+                                href=export_url("csv", error_threshold=20),
+                                style={
+                                    "marginLeft": "20px",
+                                    "padding": "8px 16px",
+                                    "backgroundColor": "#ea0d13",
+                                    "color": "white",
+                                    "borderRadius": "5px",
+                                    "textDecoration": "none",
+                                }
+                            ),
+                        ],
+                        style={
+                            "display": "flex", 
+                            "justifyContent": "center", 
+                            "alignItems": "center",
+                            "marginBottom": "20px"
+                        }
+                    )
+                ],
+                style={
+                    "backgroundColor": "white",
+                    "padding": "15px",
+                    "borderRadius": "10px",
+                    "marginBottom": "20px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
+                }
+            ),
+
+            html.Div(
+                [
+                    html.Div(id="high-error-progress", style={"textAlign": "center", "color": "#ea0d13"}),
+                    html.Div(id="high-error-status", style={"textAlign": "center", "marginBottom": "10px"}),
+                    dash_table.DataTable(
+                        id="high-error-table",
+                        columns=HIGH_ERROR_TABLE_COLUMNS,
+                        page_action="custom",
+                        page_current=0,
+                        page_size=PAGE_SIZE,
+                        sort_action="custom",
+                        sort_by=[],
+                        filter_action="custom",
+                        filter_query="",
+                        style_table={
+                            "overflowX": "auto",
+                            "border": "1px solid #ddd",
+                            "borderRadius": "5px",
                         },
-                        {
-                            "if": {"state": "selected"},
+                        style_header={
                             "backgroundColor": "#ea0d13",
                             "color": "white",
+                            "fontWeight": "bold",
+                            "textAlign": "center",
+                            "padding": "12px",
+                            "textTransform": "uppercase"
+                        },
+                        style_data={
+                            "backgroundColor": "#f9f9f9",
+                            "color": "#333",
+                            "border": "1px solid #ddd",
+                            "padding": "10px"
                         },
-                    ],
-                    style_cell={
-                        "textAlign": "center",
-                        "padding": "10px",
-                        "border": "1px solid #ddd",
-                        "maxWidth": "200px",
-                        "overflow": "hidden",
-                        "textOverflow": "ellipsis"
-                    },
-                    style_as_list_view=True,
-                )
-            ],
-            style={
-                "backgroundColor": "white",
-                "padding": "15px",
-                "borderRadius": "10px",
-                "marginBottom": "20px",
-                "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
-            }
-        ),
-        html.Div(
-            [
-                html.Div(id="page-info", style={"textAlign": "center", "marginBottom": "10px"}),
-                html.Div(
-                    id="tenant-details-output",
-                    style={
-                        "border": "1px solid #ddd",
-                        "borderRadius": "5px",
-                        "padding": "15px",
-                        "backgroundColor": "white",
-                    }
-                ),
-                html.Div(
-                    [
-                        html.Button(
-                            "Previous", 
-                            id="prev-page-btn", 
-                            style={
-                                "margin": "10px",
-                                "padding": "10px 20px",
+                        style_data_conditional=[
+                            {
+                                "if": {"row_index": "even"},
                                 "backgroundColor": "#f1f1f1",
-                                "color": "#333",
-                                "border": "1px solid #ddd",
-                                "borderRadius": "5px",
-                                "cursor": "pointer"
-                            }
-                        ),
-                        html.Button(
-                            "Next", 
-                            id="next-page-btn", 
-                            style={
-                                "margin": "10px",
-                                "padding": "10px 20px",
+                            },
+                            {
+                                "if": {"state": "active"},
+                                "backgroundColor": "rgba(234, 13, 19, 0.1)",
+                                "border": "2px solid #ea0d13",
+                            },
+                            {
+                                "if": {"state": "selected"},
                                 "backgroundColor": "#ea0d13",
                                 "color": "white",
-                                "border": "none",
-                                "borderRadius": "5px",
-                                "cursor": "pointer"
-                            }
-                        )
-                    ],
-                    style={
-                        "display": "flex", 
-                        "justifyContent": "center", 
-                        "alignItems": "center"
-                    }
-                )
-            ],
-            style={
-                "backgroundColor": "white",
-                "padding": "15px",
-                "borderRadius": "10px",
-                "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
-            }
-        ),
-
-        dcc.Store(id='tenant-details-tenant-id'),
-        dcc.Store(id='tenant-details-current-page')
-    ],
-    style={
-        "fontFamily": "'Segoe UI', Tahoma, Geneva, Verdana, sans-serif",
-        "backgroundColor": "#f5f5f5",
-        "padding": "20px",
-        "maxWidth": "1200px",
-        "margin": "0 auto",
-        "borderRadius": "10px",
-        "boxShadow": "0 8px 16px rgba(0, 0, 0, 0.2)"
-    }
+                            },
+                        ],
+                        style_cell={
+                            "textAlign": "center",
+                            "padding": "10px",
+                            "border": "1px solid #ddd",
+                            "maxWidth": "200px",
+                            "overflow": "hidden",
+                            "textOverflow": "ellipsis"
+                        },
+                        style_as_list_view=True,
+                    )
+                ],
+                style={
+                    "backgroundColor": "white",
+                    "padding": "15px",
+                    "borderRadius": "10px",
+                    "marginBottom": "20px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
+                }
+            ),
+            html.Div(
+                [
+                    html.Div(id="page-info", style={"textAlign": "center", "marginBottom": "10px"}),
+                    html.Div(id="tenant-details-progress", style={"textAlign": "center", "color": "#ea0d13"}),
+                    html.Div(
+                        html.A(
+                            "Download tenant history",
+                            id="tenant-details-download",
+                            style={"color": "#ea0d13"}
+                        ),
+                        id="tenant-details-download-container",
+                        style={"textAlign": "center", "display": "none"}
+                    ),
+                    html.Div(
+                        id="tenant-details-output",
+                        style={
+                            "border": "1px solid #ddd",
+                            "borderRadius": "5px",
+                            "padding": "15px",
+                            "backgroundColor": "white",
+                        }
+                    ),
+                    html.Div(
+                        [
+                            html.Button(
+                                "Previous", 
+                                id="prev-page-btn", 
+                                style={
+                                    "margin": "10px",
+                                    "padding": "10px 20px",
+                                    "backgroundColor": "#f1f1f1",
+                                    "color": "#333",
+                                    "border": "1px solid #ddd",
+                                    "borderRadius": "5px",
+                                    "cursor": "pointer"
+                                }
+                            ),
+                            html.Button(
+                                "Next", 
+                                id="next-page-btn", 
+                                style={
+                                    "margin": "10px",
+                                    "padding": "10px 20px",
+                                    "backgroundColor": "#ea0d13",
+                                    "color": "white",
+                                    "border": "none",
+                                    "borderRadius": "5px",
+                                    "cursor": "pointer"
+                                }
+                            )
+                        ],
+                        style={
+                            "display": "flex", 
+                            "justifyContent": "center", 
+                            "alignItems": "center"
+                        }
+                    ),
+                    html.Div(
+                        [
+                            html.Div(
+                                [
+                                    html.Label(
+                                        "Trend over the last:",
+                                        style={"marginRight": "10px", "fontWeight": "bold"}
+                                    ),
+                                    dcc.Dropdown(
+                                        id="tenant-trend-range",
+                                        options=TREND_RANGES,
+                                        value=30,
+                                        clearable=False,
+                                        style={"width": "200px"},
+                                    ),
+                                    html.Div(id="tenant-trend-status", style={"marginLeft": "20px"}),
+                                ],
+                                style={
+                                    "display": "flex",
+                                    "justifyContent": "center",
+                                    "alignItems": "center",
+                                }
+                            ),
+                            dcc.Loading(dcc.Graph(id="tenant-trend-graph", config={"displaylogo": False})),
+                        ],
+                        id="tenant-trend-container",
+                        style={"display": "none"}
+                    ),
+                ],
+                style={
+                    "backgroundColor": "white",
+                    "padding": "15px",
+                    "borderRadius": "10px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
+                }
+            ),
+
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.Label(
+                                "Tenants above the threshold over the last:",
+                                style={"marginRight": "10px", "fontWeight": "bold"}
+                            ),
+                            dcc.Dropdown(
+                                id="error-window-dropdown",
+                                options=[
+                                    {"label": "1 hour", "value": 1},
+                                    {"label": "6 hours", "value": 6},
+                                    {"label": "24 hours", "value": 24},
+                                    {"label": "3 days", "value": 72},
+                                    {"label": "7 days", "value": 168},
+                                ],
+                                value=24,
+                                clearable=False,
+                                style={
+                                    "width": "200px",
+                                    "display": "inline-block",
+                                    "verticalAlign": "middle"
+                                },
+                            ),
+                        ],
+                        style={
+                            "display": "flex",
+                            "justifyContent": "center",
+                            "alignItems": "center",
+                            "marginBottom": "10px"
+                        }
+                    ),
+                    html.Div(id="tenant-error-rate-status", style={"textAlign": "center", "marginBottom": "10px"}),
+                    dash_table.DataTable(
+                        id="tenant-error-rate-table",
+                        columns=TENANT_ERROR_RATE_TABLE_COLUMNS,
+                        page_size=PAGE_SIZE,
+                        style_table={"overflowX": "auto"},
+                        style_header={
+                            "backgroundColor": "#ea0d13",
+                            "color": "white",
+                            "fontWeight": "bold",
+                            "textAlign": "center",
+                        },
+                        style_cell={"textAlign": "center", "padding": "10px"},
+                        style_as_list_view=True,
+                    ),
+                ],
+                style={
+                    "backgroundColor": "white",
+                    "padding": "15px",
+                    "borderRadius": "10px",
+                    "marginBottom": "20px",
+                    "marginTop": "20px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
+                }
+            ),
+
+            dcc.Store(id='high-error-cursors'),
+            dcc.Store(id='tenant-details-tenant-id'),
+            dcc.Store(id='tenant-details-current-page')
+        ],
+        style={
+            "fontFamily": "'Segoe UI', Tahoma, Geneva, Verdana, sans-serif",
+            "backgroundColor": "#f5f5f5",
+            "padding": "20px",
+            "maxWidth": "1200px",
+            "margin": "0 auto",
+            "borderRadius": "10px",
+            "boxShadow": "0 8px 16px rgba(0, 0, 0, 0.2)"
+        }
+    )
+
+
+@callback(
+    Output("high-error-download", "href"),
+    Input("error-threshold-dropdown", "value"),
 )
+def update_high_error_download(error_threshold):
+    return export_url("csv", error_threshold=error_threshold)
 
 
 @callback(
-    Output("high-error-table", "data"),
+    [Output("tenant-details-download", "href"),
+     Output("tenant-details-download-container", "style")],
+    Input("tenant-details-tenant-id", "data"),
+)
+def update_tenant_details_download(tenant_id):
+    if not tenant_id:
+        return None, {"textAlign": "center", "display": "none"}
+    return export_url("csv", tenant_id=tenant_id), {"textAlign": "center"}
+
+
+@callback(
+    [Output("high-error-table", "data"),
+     Output("high-error-table", "page_count"),
+     Output("high-error-table", "page_current"),
+     Output("high-error-cursors", "data"),
+     Output("high-error-status", "children")],
     [Input("error-threshold-dropdown", "value"),
-     Input("high-error-table", "page_current")],
-    prevent_initial_call=True
+     Input("high-error-table", "page_current"),
+     Input("high-error-table", "sort_by"),
+     Input("high-error-table", "filter_query")],
+    [State("high-error-cursors", "data"),
+     State("current-user", "data")],
+    prevent_initial_call=True,
+    background=True,
+    progress=Output("high-error-progress", "children"),
+    progress_default="",
+    running=[(Output("error-threshold-dropdown", "disabled"), True, False)],
+    cancel=[Input(PAGE_LOCATION, "pathname")],
 )
-def update_high_error_table(error_threshold, page_current):
+@limit_jobs_per_user(
+    on_limit=lambda: (dash.no_update, dash.no_update, dash.no_update, dash.no_update, TOO_MANY_JOBS_MESSAGE)
+)
+def update_high_error_table(
+    set_progress, error_threshold, page_current, sort_by, filter_query, paging, current_user
+):
     if page_current is None:
         page_current = 0
 
-    offset = page_current * 20
-    query = """
-    SELECT 
-        cwh.*, 
-        TO_TIMESTAMP(cwh.last_event_received_at/1000) AS last_event_timestamp,
-        TO_TIMESTAMP(cwh.first_event_received_at/1000) AS first_event_timestamp,
-        tenant.base_domain,
-        tenant.name,
-        tenant.contact_email  
-    FROM core_master.clickhouse_write_history cwh
-    LEFT JOIN core_master.tenant tenant
-    ON cwh.tenant_id = tenant.id
-    WHERE cwh.errors_count >= (cwh.records_count * %(error_threshold)s / 100.0)
-    ORDER BY cwh.finished_at DESC
-    LIMIT 20 OFFSET %(offset)s;
-"""
-    params = {"error_threshold": error_threshold, "offset": offset}
+    # Cursors are only valid for the threshold, sort and filter they were collected under.
+    view = {"error_threshold": error_threshold, "sort_by": sort_by or [], "filter_query": filter_query or ""}
+    if not paging or paging.get("view") != view:
+        paging = {"view": view, "cursors": {}, "page_count": None}
+        page_current = 0
+
+    cursor, offset = seek_position(page_current, paging["cursors"])
 
     try:
-        pg_result = execute_postgres_query(
-            query=query,
-            params=params,
-            tenant_id="public",
-            echo_query=False,
-            echo_params=False,
-        )
-
-        if pg_result:
-            columns = [
-                "id",
-                "tenant_id",
-                "last_event_recieved_at",
-                "finished_at",
-                "records_count",
-                "error_count",
-                "duration",
-                "db_persist_duration",
-                "run_id",
-                "first_event_recieved_at",
-                "last_event_timestamp",
-                "first_event_timestamp",
-                "base_domain",
-                "tenant_name",
-                "contact_email"  
-            ]
-            df = pd.DataFrame(pg_result, columns=columns)
-            return df.to_dict("records")
-
-        return []
+        filters = table_filters({"error_threshold": error_threshold}, filter_query)
+
+        # The precomputed error rates turn the threshold filter into an array
+        # scan; the database then only serves the page's rows by primary key.
+        # Other sorts and filters are left to the database. The job only reads
+        # the snapshot it was forked with; the web process keeps it current.
+        rollup = get_error_rollup()
+        matching = None
+        if not sort_by and not filter_query:
+            matching = rollup.runs_above(error_threshold, after=cursor, offset=offset)
+
+        if matching is not None and rollup.covers_all:
+            paging["page_count"] = max(1, math.ceil(matching[1] / PAGE_SIZE))
+        if paging["page_count"] is None:
+            set_progress("Estimating matching runs...")
+            paging["page_count"] = max(1, math.ceil(estimate_runs(filters) / PAGE_SIZE))
+
+        set_progress(f"Loading page {page_current + 1}...")
+        if matching is None:
+            df = fetch_runs(HIGH_ERROR_COLUMNS, filters=filters, after=cursor, offset=offset, sort_by=sort_by)
+        elif matching[0]:
+            df = fetch_runs(HIGH_ERROR_COLUMNS, filters={"ids": matching[0]}, limit=len(matching[0]))
+        else:
+            return [], paging["page_count"], page_current, paging, "No runs above this error rate."
+
+        column = seek_column(sort_by)
+        if not df.empty:
+            if column:
+                paging["cursors"][str(page_current)] = last_row_cursor(df, column)
+            # The planner estimate can undershoot; never hide a page we can reach.
+            if len(df) == PAGE_SIZE:
+                paging["page_count"] = max(paging["page_count"], page_current + 2)
+            return table_records(df, HIGH_ERROR_TABLE_COLUMNS), paging["page_count"], page_current, paging, ""
+
+        return [], paging["page_count"], page_current, paging, "No runs above this error rate."
 
     except Exception as e:
         print(f"An error occurred: {str(e)}")
-        return []
+        return [], paging["page_count"], page_current, paging, f"An error occurred: {str(e)}"
+
+
 @callback(
-    Output("tenant-details-output", "children"),
-    [Input("high-error-table", "active_cell"), Input("high-error-table", "page_current")],
-    [State("high-error-table", "data")],
+    [Output("tenant-error-rate-table", "data"),
+     Output("tenant-error-rate-status", "children")],
+    [Input("error-threshold-dropdown", "value"),
+     Input("error-window-dropdown", "value")],
 )
-def display_tenant_details(active_cell, page_current=0, table_data=None):
-    if active_cell:
+def update_tenant_error_rates(error_threshold, hours):
+    # Runs in the web process, whose rollup is kept current by the refresher
+    # thread; the aggregation itself is a couple of array operations.
+    tenants = get_error_rollup().tenants_above(error_threshold or 0, hours)
+    if tenants is None:
+        return [], "Error rates are still being computed, try again shortly."
+    if tenants.empty:
+        return [], f"No tenant is above {error_threshold}% over the last {hours} hours."
+
+    try:
+        details = fetch_tenants(tenants["tenant_id"].tolist())
+        tenants = tenants.join(details, on="tenant_id")
+    except Exception:
+        logger.exception("Could not look up tenant details for the tenant error rates")
+    records = table_records(tenants, TENANT_ERROR_RATE_TABLE_COLUMNS)
+    return records, f"{len(tenants)} tenants above {error_threshold}% over the last {hours} hours."
+
+
+@callback(
+    [Output("tenant-details-output", "children"),
+     Output("page-info", "children"),
+     Output("tenant-details-tenant-id", "data"),
+     Output("tenant-details-current-page", "data")],
+    [Input("high-error-table", "active_cell"),
+     Input("prev-page-btn", "n_clicks"),
+     Input("next-page-btn", "n_clicks")],
+    [State("high-error-table", "data"),
+     State("tenant-details-tenant-id", "data"),
+     State("tenant-details-current-page", "data")],
+    running=[
+        (Output("prev-page-btn", "disabled"), True, False),
+        (Output("next-page-btn", "disabled"), True, False),
+        (Output("tenant-details-progress", "children"), "Loading tenant history...", ""),
+    ],
+)
+def display_tenant_details(active_cell, prev_clicks, next_clicks, table_data=None, tenant_id=None, paging=None):
+    # Not a background job: pages come from the tenant history cache in this
+    # process, which also prefetches the next page while this one is read.
+    ctx = dash.callback_context
+    button_id = ctx.triggered[0]["prop_id"].split(".")[0] if ctx.triggered else None
+
+    if button_id == "high-error-table" or not paging:
+        if not active_cell or not table_data or active_cell["row"] >= len(table_data):
+            return html.Div("Click on a Tenant ID to view details."), "", None, None
         tenant_id = table_data[active_cell["row"]]["tenant_id"]
-        if page_current is None:
-            page_current = 0
-        offset = page_current * 20
-        query = """
-        SELECT 
-            cwh.*, 
-            tenant.base_domain, 
-            tenant.name AS tenant_name,
-            TO_TIMESTAMP(cwh.last_event_received_at/1000) AS last_event_timestamp,
-            TO_TIMESTAMP(cwh.first_event_received_at/1000) AS first_event_timestamp
-        FROM core_master.clickhouse_write_history cwh
-        LEFT JOIN core_master.tenant tenant
-        ON cwh.tenant_id = tenant.id
-        WHERE cwh.tenant_id = %(tenant_id)s
-        ORDER BY cwh.finished_at DESC
-        LIMIT 20 OFFSET %(offset)s;
-        """
-        params = {"tenant_id": tenant_id, "offset": offset}
-
-        try:
-            pg_result = execute_postgres_query(
-                query=query,
-                params=params,
-                tenant_id="public",
-                echo_query=False,
-                echo_params=False,
-            )
-
-            columns = [
-                "id",
-                "tenant_id",
-                "last_event_recieved_at",
-                "finished_at",
-                "records_count",
-                "error_count",
-                "duration",
-                "db_persist_duration",
-                "run_id",
-                "first_event_recieved_at",
-                "base_domain",
-                "tenant_name",
-                "last_event_timestamp",
-                "first_event_timestamp",
-            ]
-
-            if pg_result:
-                df = pd.DataFrame(pg_result, columns=columns)
-
-                ist = pytz.timezone('Asia/Kolkata')
-
-                def convert_to_ist(dt):
-                    if dt.tzinfo is None:
-                        return dt.tz_localize('UTC').tz_convert(ist)
-                    else:
-                        return dt.tz_convert(ist)
-
-                df["finished_at"] = pd.to_datetime(df["finished_at"]).apply(convert_to_ist)
-                df["last_event_timestamp"] = pd.to_datetime(df["last_event_timestamp"]).apply(convert_to_ist)
-                df["first_event_timestamp"] = pd.to_datetime(df["first_event_timestamp"]).apply(convert_to_ist)
-
-                df["finished_at"] = df["finished_at"].dt.strftime("%Y-%m-%d %H:%M:%S")
-                df["last_event_timestamp"] = df["last_event_timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
-                df["first_event_timestamp"] = df["first_event_timestamp"].dt.strftime("%Y-%m-%d %H:%M:%S")
-
-                return dash_table.DataTable(
-                    data=df.to_dict("records"),
-                    columns=[{"name": col, "id": col} for col in df.columns],
-                    style_table={"overflowX": "auto", "margin": "15px"},
-                    page_size=20,
-                )
-
-        except Exception as e:
-            return html.Div(f"Error fetching details for tenant ID {tenant_id}: {str(e)}")
-
-    return html.Div("Click on a Tenant ID to view details.")
+        paging = {"page": 0, "cursors": {}, "page_count": None, "has_next": False}
+    elif button_id == "next-page-btn" and paging["has_next"]:
+        paging["page"] += 1
+    elif button_id == "prev-page-btn" and paging["page"] > 0:
+        paging["page"] -= 1
+
+    page = paging["page"]
+    cursor, offset = seek_position(page, paging["cursors"])
+
+    try:
+        history = get_tenant_history()
+        if paging["page_count"] is None:
+            paging["page_count"] = max(1, math.ceil(history.estimate(tenant_id) / PAGE_SIZE))
+
+        df = history.page(tenant_id, cursor, offset)
+
+        paging["has_next"] = len(df) == PAGE_SIZE
+        page_info = f"Tenant {tenant_id} - Page {page + 1} of ~{max(paging['page_count'], page + 1)}"
+
+        if not df.empty:
+            paging["cursors"][str(page)] = last_row_cursor(df)
+            format_datetimes(df)
+
+            return dash_table.DataTable(
+                data=df.to_dict("records"),
+                columns=[{"name": col, "id": col} for col in df.columns],
+                style_table={"overflowX": "auto", "margin": "15px"},
+                page_action="none",
+            ), page_info, tenant_id, paging
+
+        return html.Div(f"No more history for tenant ID {tenant_id}."), page_info, tenant_id, paging
+
+    except Exception as e:
+        return html.Div(f"Error fetching details for tenant ID {tenant_id}: {str(e)}"), "", tenant_id, paging
+
+
+def bucket_label(seconds: int) -> str:
+    for unit, size in (("day", 86400), ("hour", 3600), ("minute", 60)):
+        if seconds % size == 0:
+            count = seconds // size
+            return f"{count} {unit}" + ("s" if count != 1 else "")
+    return f"{seconds} seconds"
+
+
+def _band(x, low, high, name: str, color: str, yaxis: str) -> list:
+    """A shaded min-max band: the upper edge first, then the lower one filled up to it."""
+    edge = {"type": "scatter", "mode": "lines", "x": x, "line": {"width": 0}, "yaxis": yaxis, "hoverinfo": "skip"}
+    return [
+        {**edge, "y": high, "showlegend": False, "legendgroup": name},
+        {**edge, "y": low, "name": f"{name} (min-max)", "legendgroup": name, "fill": "tonexty", "fillcolor": color},
+    ]
+
+
+def trend_figure(buckets) -> dict:
+    """Event counts on top, durations with their per-bucket range below, sharing the time axis."""
+    x = format_ist(buckets["bucket"], unit="s").tolist()
+    line = {"type": "scatter", "mode": "lines", "x": x}
+    data = [
+        {**line, "y": buckets["records_count"].tolist(), "name": "Events", "line": {"color": "#0f082d"}},
+        {**line, "y": buckets["error_count"].tolist(), "name": "Errors", "line": {"color": "#ea0d13"}},
+        *_band(x, buckets["duration_min"].tolist(), buckets["duration_max"].tolist(), "Duration",
+               "rgba(0, 86, 179, 0.2)", "y2"),
+        {**line, "y": buckets["duration_avg"].tolist(), "name": "Duration (mean)", "yaxis": "y2",
+         "line": {"color": "#0056b3"}},
+        *_band(x, buckets["db_persist_duration_min"].tolist(), buckets["db_persist_duration_max"].tolist(),
+               "DB persist", "rgba(234, 13, 19, 0.15)", "y2"),
+        {**line, "y": buckets["db_persist_duration_avg"].tolist(), "name": "DB persist (mean)", "yaxis": "y2",
+         "line": {"color": "#ea0d13", "dash": "dot"}},
+    ]
+    layout = {
+        "height": 520,
+        "margin": {"l": 60, "r": 20, "t": 20, "b": 40},
+        "hovermode": "x unified",
+        "legend": {"orientation": "h", "y": -0.12},
+        "xaxis": {"type": "date"},
+        "yaxis": {"domain": [0.55, 1], "title": {"text": "Events per bucket"}},
+        "yaxis2": {"domain": [0, 0.45], "anchor": "x", "title": {"text": "Seconds"}},
+    }
+    return {"data": data, "layout": layout}
+
+
+@callback(
+    [Output("tenant-trend-graph", "figure"),
+     Output("tenant-trend-status", "children"),
+     Output("tenant-trend-container", "style")],
+    [Input("tenant-details-tenant-id", "data"),
+     Input("tenant-trend-range", "value")],
+)
+def update_tenant_trend(tenant_id, days):
+    if not tenant_id:
+        return {}, "", {"display": "none"}
+    shown = {"marginTop": "20px"}
+
+    # The database aggregates the runs into at most TREND_POINT_BUDGET
+    # buckets, so a year of a busy tenant's runs arrives as a few hundred
+    # rows. The start is aligned to the bucket width so repeated views
+    # share a cached result.
+    width = bucket_width(days * 86400, settings.TREND_POINT_BUDGET)
+    since = (time.time() - days * 86400) // width * width
+    filters = {"tenant_id": tenant_id, "finished_after": datetime.fromtimestamp(since, timezone.utc)}
+    try:
+        buckets = fetch_run_buckets(width, filters)
+    except Exception as e:
+        logger.exception("Could not load the trend buckets of tenant %s", tenant_id)
+        return {}, f"An error occurred: {str(e)}", shown
+    if buckets.empty:
+        return {}, f"No runs for tenant {tenant_id} in this period.", shown
+
+    status = f"{int(buckets['runs'].sum())} runs in {len(buckets)} buckets of {bucket_label(width)}"
+    return trend_figure(buckets), status, shown
@@ -0,0 +1,216 @@
+import logging
+import re
+
+import dash
+from dash import html, Input, Output, State, dash_table
+from background import PAGE_LOCATION, TOO_MANY_JOBS_MESSAGE, limit_jobs_per_user
+from base import settings
+from exec import fan_out_clickhouse_query
+from lazy_imports import lazy_import
+from metrics import callback
+from results import format_ist, table_records
+from tenant_directory import active_tenant_ids
+from write_history import fetch_tenants
+
+pd = lazy_import("pandas")
+
+logger = logging.getLogger(__name__)
+
+dash.register_page(__name__, path='/event-freshness')
+
+_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)?$")
+
+# How often the progress line is updated while tenants report back.
+PROGRESS_EVERY = 10
+
+TABLE_COLUMNS = [
+    {"name": "Tenant ID", "id": "tenant_id"},
+    {"name": "Tenant Name", "id": "tenant_name"},
+    {"name": "Base Domain", "id": "base_domain"},
+    {"name": "Last Event (IST)", "id": "last_event"},
+    {"name": "Minutes Since Last Event", "id": "minutes_since_last_event"},
+    {"name": "Events (Last Hour)", "id": "events_last_hour"},
+    {"name": "Status", "id": "status"},
+    {"name": "Query Time (ms)", "id": "query_ms"},
+]
+# Every field freshness_row can produce; rows for failed tenants leave most out.
+ROW_COLUMNS = ["tenant_id", "last_event", "minutes_since_last_event", "events_last_hour", "status", "query_ms"]
+
+
+def layout(**kwargs):
+    return html.Div(
+        [
+            html.Div(
+                [
+                    html.H1(
+                        "Event Freshness",
+                        style={
+                            "textAlign": "center",
+                            "color": "#ea0d13",
+                            "fontSize": "32px",
+                            "fontWeight": "bold",
+                            "marginBottom": "20px",
+                            "textShadow": "2px 2px 4px rgba(0,0,0,0.1)"
+                        },
+                    ),
+                ],
+                style={
+                    "backgroundColor": "white",
+                    "padding": "20px",
+                    "borderRadius": "10px",
+                    "marginBottom": "20px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
+                }
+            ),
+            html.Div(
+                [
+                    html.Div(
+                        [
+                            html.Button(
+                                "Refresh",
+                                id="freshness-refresh",
+                                n_clicks=0,
+                                style={
+                                    "padding": "10px 20px",
+                                    "backgroundColor": "#ea0d13",
+                                    "color": "white",
+                                    "border": "none",
+                                    "borderRadius": "5px",
+                                    "fontSize": "16px",
+                                    "marginRight": "10px",
+                                },
+                            ),
+                            html.Div(id="freshness-progress", style={"color": "#ea0d13"}),
+                        ],
+                        style={"display": "flex", "alignItems": "center", "marginBottom": "10px"}
+                    ),
+                    html.Div(
+                        "Press Refresh to check when each active tenant last received events.",
+                        id="freshness-status",
+                        style={"marginBottom": "10px"},
+                    ),
+                    dash_table.DataTable(
+                        id="freshness-table",
+                        columns=TABLE_COLUMNS,
+                        page_size=50,
+                        sort_action="native",
+                        filter_action="native",
+                        style_table={"overflowX": "auto"},
+                        style_header={
+                            "backgroundColor": "#ea0d13",
+                            "color": "white",
+                            "fontWeight": "bold",
+                            "textAlign": "center",
+                        },
+                        style_cell={"textAlign": "center", "padding": "10px"},
+                        style_data_conditional=[
+                            {
+                                "if": {"filter_query": '{status} = "stale"'},
+                                "backgroundColor": "#fff3cd",
+                            },
+                            {
+                                "if": {"filter_query": '{status} contains "error" || {status} = "timed out"'},
+                                "backgroundColor": "#f8d7da",
+                            },
+                        ],
+                        style_as_list_view=True,
+                    ),
+                ],
+                style={
+                    "backgroundColor": "white",
+                    "padding": "15px",
+                    "borderRadius": "10px",
+                    "marginBottom": "20px",
+                    "boxShadow": "0 4px 8px rgba(0, 0, 0, 0.1)"
+                }
+            ),
+        ]
+    )
+
+
+def freshness_query() -> str:
+    """Latest event and last hour's event count in one tenant database."""
+    table, column = settings.FRESHNESS_EVENTS_TABLE, settings.FRESHNESS_TIMESTAMP_COLUMN
+    for name in (table, column):
+        if not _IDENTIFIER.match(name):
+            raise ValueError(f"Invalid ClickHouse identifier {name!r}")
+    # Only the lookback window is read, so the scan stays within a few
+    # partitions however much history a tenant has.
+    return f"""
+    SELECT
+        toUnixTimestamp(maxOrNull({column})) AS last_event,
+        dateDiff('second', maxOrNull({column}), now()) AS seconds_since_last_event,
+        countIf({column} >= now() - INTERVAL 1 HOUR) AS events_last_hour
+    FROM {table}
+    WHERE {column} >= now() - INTERVAL %(lookback_days)s DAY
+    """
+
+
+def freshness_row(outcome) -> dict:
+    row = {"tenant_id": outcome.tenant_id, "query_ms": round(outcome.duration * 1000)}
+    if outcome.error is not None:
+        status = "timed out" if isinstance(outcome.error, TimeoutError) else f"error: {outcome.error}"
+        return {**row, "status": status}
+
+    last_event, seconds_since, events_last_hour = outcome.result[0]
+    if last_event is None:
+        return {**row, "events_last_hour": 0, "status": f"no events in {settings.FRESHNESS_LOOKBACK_DAYS} days"}
+    minutes_since = round(seconds_since / 60, 1)
+    return {
+        **row,
+        "last_event": last_event,
+        "minutes_since_last_event": minutes_since,
+        "events_last_hour": events_last_hour,
+        "status": "stale" if minutes_since > settings.FRESHNESS_STALE_MINUTES else "ok",
+    }
+
+
+@callback(
+    [Output("freshness-table", "data"), Output("freshness-status", "children")],
+    [Input("freshness-refresh", "n_clicks")],
+    [State("current-user", "data")],
+    background=True,
+    progress=Output("freshness-progress", "children"),
+    progress_default="",
+    running=[(Output("freshness-refresh", "disabled"), True, False)],
+    cancel=[Input(PAGE_LOCATION, "pathname")],
+    # Each check queries every active tenant; only run it when asked.
+    prevent_initial_call=True,
+)
+@limit_jobs_per_user(on_limit=lambda: (dash.no_update, TOO_MANY_JOBS_MESSAGE))
+def update_event_freshness(set_progress, n_clicks, current_user):
+    try:
+        tenant_ids = active_tenant_ids()
+        query = freshness_query()
+    except Exception as e:
+        return [], f"An error occurred: {str(e)}"
+
+    set_progress(f"Checking {len(tenant_ids)} tenants...")
+    rows = []
+    outcomes = fan_out_clickhouse_query(query, {"lookback_days": settings.FRESHNESS_LOOKBACK_DAYS}, tenant_ids)
+    for checked, outcome in enumerate(outcomes, 1):
+        rows.append(freshness_row(outcome))
+        if checked % PROGRESS_EVERY == 0:
+            set_progress(f"Checked {checked} of {len(tenant_ids)} tenants...")
+
+    if not rows:
+        return [], "No active tenants."
+
+    # A fixed set of columns, so a run where no tenant answered (ClickHouse
+    # down) still sorts and renders, with blanks for the missing values.
+    df = pd.DataFrame(rows).reindex(columns=ROW_COLUMNS)
+    try:
+        df = df.join(fetch_tenants(df["tenant_id"].tolist()), on="tenant_id")
+    except Exception:
+        logger.exception("Could not look up tenant details for the event freshness table")
+    # Stalest first; tenants without recent events or without an answer on top.
+    df = df.sort_values("minutes_since_last_event", ascending=False, na_position="first", ignore_index=True)
+    df["last_event"] = format_ist(df["last_event"], unit="s")
+    # Plain ints with None for the gaps, rather than floats padded with NaN.
+    events = df["events_last_hour"]
+    df["events_last_hour"] = events.astype("Int64").astype(object).where(events.notna(), None)
+
+    failed = int(df["status"].str.startswith("error").sum() + (df["status"] == "timed out").sum())
+    stale = int((df["status"] == "stale").sum())
+    summary = f"{len(df)} tenants checked, {stale} stale, {failed} without an answer."
+    return table_records(df, TABLE_COLUMNS), summary
@@ -8,8 +8,10 @@ dash.register_page(
     is_fallback=True
 )
 
-layout = html.Div([
-    html.H1("404 - Page Not Found"),
-    html.P("The page you are looking for does not exist."),
-    html.A("Go back to Home", href="/", style={"textDecoration": "underline"})
-])
+
+def layout(**kwargs):
+    return html.Div([
+        html.H1("404 - Page Not Found"),
+        html.P("The page you are looking for does not exist."),
+        html.A("Go back to Home", href="/", style={"textDecoration": "underline"})
+    ])
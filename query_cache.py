@@ -0,0 +1,326 @@
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import diskcache
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(query: str, params: dict, tenant_id: str) -> tuple:
+    """
+    Key a query by its whitespace-normalized text, its params and its tenant schema.
+    """
+    normalized = " ".join(query.split())
+    return normalized, json.dumps(params or {}, sort_keys=True, default=str), tenant_id
+
+
+def estimate_size(rows) -> int:
+    """Rough in-memory size in bytes of a list of result tuples."""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        for value in row:
+            size += sys.getsizeof(value)
+    return size
+
+
+class QueryCache:
+    """
+    Memory-bounded LRU cache of query results with a TTL and watermark invalidation.
+
+    ``watermark_fn`` is a cheap probe (e.g. ``max(id)`` of the write history)
+    called at most every ``watermark_interval`` seconds; whenever its value
+    changes, every cached result is dropped. Results computed under an older
+    watermark are not stored.
+
+    Args:
+    - max_bytes (int): Upper bound on the estimated size of all cached results.
+    - ttl (float): Seconds a result stays valid.
+    - watermark_fn (callable): Returns a comparable value that changes when the underlying data does.
+    - watermark_interval (float): Minimum seconds between two probes.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, watermark_fn=None, watermark_interval: float = 2.0):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.watermark_fn = watermark_fn
+        self.watermark_interval = watermark_interval
+
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._generation = 0
+        self._watermark = None
+        self._probed_at = float("-inf")
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "oversized": 0,
+        }
+
+    def _check_watermark(self) -> None:
+        if self.watermark_fn is None or time.monotonic() - self._probed_at < self.watermark_interval:
+            return
+        # One probe at a time; concurrent readers keep using the last known watermark.
+        if not self._probe_lock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() - self._probed_at < self.watermark_interval:
+                return
+            try:
+                watermark = self.watermark_fn()
+            except Exception as e:
+                logger.warning("Query cache watermark probe failed: %s", e)
+                return
+            finally:
+                self._probed_at = time.monotonic()
+            if watermark != self._watermark:
+                if self._watermark is not None:
+                    self.invalidate()
+                self._watermark = watermark
+        finally:
+            self._probe_lock.release()
+
+    def _pop(self, key) -> None:
+        """Remove ``key``; caller must hold the lock."""
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def get(self, key):
+        """
+        Look up ``key``.
+
+        Returns ``(hit, value, generation)``; pass ``generation`` back to
+        ``set`` so a result computed across an invalidation is discarded.
+        """
+        self._check_watermark()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, _, expires_at = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return True, value, self._generation
+                self._pop(key)
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return False, None, self._generation
+
+    def set(self, key, value, generation: int, size: int = None) -> None:
+        """
+        Store ``value`` unless the cache was invalidated since ``generation`` was read.
+
+        ``size`` defaults to ``estimate_size(value)``.
+        """
+        if size is None:
+            size = estimate_size(value)
+        with self._lock:
+            if generation != self._generation:
+                return
+            if size > self.max_bytes:
+                self._stats["oversized"] += 1
+                return
+            if key in self._entries:
+                self._pop(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self) -> None:
+        """Drop every cached result."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._generation += 1
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters and current size."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class SharedQueryCache:
+    """
+    Query result cache shared by every process on the host, backed by ``diskcache``.
+
+    Same interface as ``QueryCache``, for preforked servers: all workers (and
+    their background jobs) read and fill one cache directory, so adding
+    workers does not add cold caches or database load. Entries are evicted
+    least recently stored first once ``max_bytes`` is exceeded, which keeps
+    reads free of writes.
+
+    The watermark is part of every key. When it moves, entries stored under
+    the old one are simply never read again and age out by TTL, so no
+    cross-process invalidation is needed; ``invalidate`` likewise moves an
+    epoch that is part of every key. The probe is shared too: the watermark
+    and epoch are stored in a small cache of their own next to the results,
+    which is never culled, and only the one process that finds the watermark
+    older than ``watermark_interval`` probes again.
+
+    Args:
+    - directory (str): Cache directory, shared by the processes.
+    - max_bytes (int): Upper bound on the on-disk size of the cached results.
+    - ttl (float): Seconds a result stays valid.
+    - watermark_fn (callable): Returns a value that changes when the underlying data does.
+    - watermark_interval (float): Minimum seconds between two probes, across all processes.
+    """
+
+    WATERMARK_KEY = "watermark"
+    # Generation handed out while no watermark is known; results read under
+    # it are not stored.
+    UNKNOWN = None
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        ttl: float,
+        watermark_fn=None,
+        watermark_interval: float = 2.0,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.watermark_fn = watermark_fn
+        self.watermark_interval = watermark_interval
+        # cull_limit=0 turns off the culling diskcache does inside set(), so
+        # that _reap can count what it removes.
+        self._cache = diskcache.Cache(
+            directory, size_limit=max_bytes, eviction_policy="least-recently-stored", cull_limit=0
+        )
+        self._state = diskcache.Cache(os.path.join(directory, "state"), eviction_policy="none")
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "oversized": 0, "invalidations": 0,
+        }
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self._stats[name] += amount
+
+    def _reap(self) -> None:
+        # Results past their TTL first, then the least recently stored ones
+        # while the cache is over max_bytes; each counted by the process that
+        # removed it.
+        self._count("expirations", self._cache.expire())
+        if self._cache.volume() > self.max_bytes:
+            self._count("evictions", self._cache.cull())
+
+    @classmethod
+    def _generation(cls, state) -> str:
+        """The generation for a stored ``(watermark, probed_at, epoch)``."""
+        if state is None or state[0] is cls.UNKNOWN:
+            return cls.UNKNOWN
+        return f"{state[2]}:{state[0]}"
+
+    def _watermark(self) -> str:
+        if self.watermark_fn is None:
+            state = self._state.get(self.WATERMARK_KEY)
+            return f"{state[2]}:" if state is not None else "0:"
+        stored = self._state.get(self.WATERMARK_KEY)
+        if stored is not None and time.time() - stored[1] < self.watermark_interval:
+            return self._generation(stored)
+        # Only the process that moves the probe time forward probes; the
+        # others keep using the stored watermark until it is replaced. (No
+        # expiring lock key, so that expirations only count results.)
+        with self._state.transact():
+            current = self._state.get(self.WATERMARK_KEY)
+            if current is not None and current != stored:
+                return self._generation(current)
+            if current is None:
+                current = (self.UNKNOWN, 0.0, 0)
+            self._state.set(self.WATERMARK_KEY, (current[0], time.time(), current[2]))
+        try:
+            watermark = json.dumps(self.watermark_fn(), default=str)
+        except Exception as e:
+            logger.warning("Query cache watermark probe failed: %s", e)
+            return self._generation(current)
+        with self._state.transact():
+            # Re-read the epoch, in case invalidate() moved it meanwhile.
+            state = self._state.get(self.WATERMARK_KEY, default=current)
+            state = (watermark, time.time(), state[2])
+            self._state.set(self.WATERMARK_KEY, state)
+        if current[0] is not self.UNKNOWN and current[0] != watermark:
+            self._count("invalidations")
+        return self._generation(state)
+
+    @staticmethod
+    def _key(watermark: str, key) -> str:
+        return hashlib.sha1(json.dumps([watermark, *key]).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Look up ``key`` under the current watermark.
+
+        Returns ``(hit, value, generation)``; pass ``generation`` back to ``set``.
+        """
+        watermark = self._watermark()
+        if watermark is not self.UNKNOWN:
+            value = self._cache.get(self._key(watermark, key), default=self)
+            if value is not self:
+                self._count("hits")
+                return True, value, watermark
+        self._count("misses")
+        return False, None, watermark
+
+    def set(self, key, value, generation, size: int = None) -> None:
+        """
+        Store ``value`` under the watermark it was read with (``generation``).
+
+        ``size`` defaults to ``estimate_size(value)``.
+        """
+        if generation is self.UNKNOWN:
+            return
+        if size is None:
+            size = estimate_size(value)
+        if size > self.max_bytes:
+            self._count("oversized")
+            return
+        self._cache.set(self._key(generation, key), value, expire=self.ttl)
+        self._reap()
+
+    def invalidate(self) -> None:
+        """
+        Drop every cached result, for every process.
+
+        Moves the epoch rather than clearing the results, which then age out
+        like those of an old watermark; the next lookup also probes again.
+        """
+        with self._state.transact():
+            state = self._state.get(self.WATERMARK_KEY, default=(self.UNKNOWN, 0.0, 0))
+            self._state.set(self.WATERMARK_KEY, (state[0], 0.0, state[2] + 1))
+        self._count("invalidations")
+
+    def stats(self) -> dict:
+        """
+        Counters of this process, and the shared cache's current size.
+
+        Evictions and expirations are counted by whichever process removed
+        the entries, so one process's counts are its share of the total.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(entries=len(self._cache), bytes=self._cache.volume())
+        stats["max_bytes"] = self.max_bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
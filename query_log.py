@@ -0,0 +1,254 @@
+"""
+Structured slow-query log with sampled ``EXPLAIN (ANALYZE, BUFFERS)`` capture.
+
+``exec`` reports every query it runs through ``observe``. Queries slower than
+``settings.SLOW_QUERY_THRESHOLD`` are logged with their fingerprint,
+redacted parameters, tenant schema, duration and row count. A sample of the
+slow PostgreSQL SELECTs is explained again on a background thread, never on
+the request that was slow, and the plan is logged with its sequential scans
+called out.
+
+Most slow queries run in background callback jobs, processes that are killed
+once their result is read. Sampled queries are therefore handed off through
+a small queue in ``BACKGROUND_CACHE_DIR``. They are explained by the
+long-lived processes that called ``start_slow_query_explainer`` (the web
+process, or each gunicorn worker), at most once per fingerprint per
+``SLOW_QUERY_EXPLAIN_INTERVAL`` in each of them.
+"""
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from datetime import date, datetime
+
+import diskcache
+
+from base import settings
+
+logger = logging.getLogger(__name__)
+
+EXPLAIN_QUEUE_SIZE = 16
+# Seconds the explainer waits before looking at an empty queue again.
+EXPLAIN_POLL_INTERVAL = 1.0
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WRITES = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|TRUNCATE|CREATE|DROP|ALTER|GRANT|COPY|CALL)\b", re.IGNORECASE)
+
+
+def fingerprint(query: str) -> tuple:
+    """
+    ``(fingerprint, normalized_sql)`` with whitespace collapsed and literals replaced by ``?``.
+
+    Queries that differ only in literal values share a fingerprint;
+    ``%(name)s`` placeholders are kept as they are.
+    """
+    normalized = _NUMBER_LITERAL.sub("?", _STRING_LITERAL.sub("?", " ".join(query.split())))
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16], normalized
+
+
+def redact(params):
+    """Parameters with their values reduced to what is safe to log."""
+    if isinstance(params, dict):
+        return {name: redact(value) for name, value in params.items()}
+    if params is None or isinstance(params, (bool, int, float)):
+        return params
+    if isinstance(params, (datetime, date)):
+        return params.isoformat()
+    if isinstance(params, (list, tuple, set)):
+        return f"<{type(params).__name__} len={len(params)}>"
+    if isinstance(params, (str, bytes)):
+        return f"<{type(params).__name__} len={len(params)}>"
+    return f"<{type(params).__name__}>"
+
+
+def is_read_only(query: str) -> bool:
+    """Whether ``query`` is a plain SELECT, i.e. safe to run again under EXPLAIN ANALYZE."""
+    head = query.lstrip().split(None, 1)[0].upper() if query.strip() else ""
+    return head in ("SELECT", "WITH") and not _WRITES.search(_STRING_LITERAL.sub("", query))
+
+
+def observe(
+    database: str,
+    query: str,
+    params,
+    tenant_id: str,
+    duration: float,
+    rows: int = None,
+    query_name: str = None,
+    force: bool = False,
+) -> None:
+    """
+    Log the query if it was slow (or ``force`` is set) and maybe queue an EXPLAIN.
+
+    Args:
+    - database (str): ``"postgres"`` or ``"clickhouse"``.
+    - query (str): The SQL that ran.
+    - params (dict): Its parameters; only redacted values are logged.
+    - tenant_id (str): Tenant schema (PostgreSQL) or database (ClickHouse).
+    - duration (float): Seconds, including the wait for a pooled connection.
+    - rows (int): Rows returned, if known.
+    - query_name (str): Name of the calling function, as in the query metrics.
+    - force (bool): Log at INFO even when the query was fast.
+    """
+    slow = duration >= settings.SLOW_QUERY_THRESHOLD
+    if not slow and not force:
+        return
+    query_id, normalized = fingerprint(query)
+    record = {
+        "fingerprint": query_id,
+        "database": database,
+        "query_name": query_name,
+        "tenant": tenant_id,
+        "duration_ms": round(duration * 1000, 1),
+        "rows": rows,
+        "params": redact(params),
+        "sql": normalized,
+    }
+    if slow:
+        logger.warning("Slow query %s", json.dumps(record, default=str))
+    else:
+        logger.info("Query %s", json.dumps(record, default=str))
+
+    if (
+        slow
+        and database == "postgres"
+        and random.random() < settings.SLOW_QUERY_EXPLAIN_SAMPLE_RATE
+        and is_read_only(query)
+    ):
+        _submit_explain(query_id, query, params, tenant_id)
+
+
+_explain_queue = None
+_explain_queue_pid = None
+_explain_queue_lock = threading.Lock()
+
+
+def _get_explain_queue() -> diskcache.Deque:
+    global _explain_queue, _explain_queue_pid, _explain_queue_lock
+    if _explain_queue_pid != os.getpid():
+        # A job process opens its own connection to the queue rather than
+        # using the one inherited through fork().
+        _explain_queue_lock = threading.Lock()
+        _explain_queue = None
+        _explain_queue_pid = os.getpid()
+    if _explain_queue is None:
+        with _explain_queue_lock:
+            if _explain_queue is None:
+                _explain_queue = diskcache.Deque(
+                    directory=os.path.join(settings.BACKGROUND_CACHE_DIR, "explain-queue"),
+                    maxlen=EXPLAIN_QUEUE_SIZE,
+                )
+    return _explain_queue
+
+
+def _submit_explain(query_id: str, query: str, params, tenant_id: str) -> None:
+    # A full queue drops its oldest entry.
+    try:
+        _get_explain_queue().append((query_id, query, params, tenant_id))
+    except Exception as e:
+        logger.debug("Could not queue EXPLAIN of %s: %s", query_id, e)
+
+
+def _plan_nodes(node: dict):
+    yield node
+    for child in node.get("Plans", ()):
+        yield from _plan_nodes(child)
+
+
+class _Explainer:
+    """Daemon thread running the queued ``EXPLAIN (ANALYZE, BUFFERS)`` captures."""
+
+    def __init__(self):
+        self._explained_at = {}
+        self._thread = threading.Thread(target=self._run, name="slow-query-explain", daemon=True)
+        self._thread.start()
+
+    def _should_explain(self, query_id: str) -> bool:
+        # One plan per fingerprint per interval is plenty and keeps the extra
+        # load on the database bounded.
+        now = time.monotonic()
+        if now - self._explained_at.get(query_id, float("-inf")) < settings.SLOW_QUERY_EXPLAIN_INTERVAL:
+            return False
+        self._explained_at[query_id] = now
+        return True
+
+    def _run(self) -> None:
+        while True:
+            try:
+                query_id, query, params, tenant_id = _get_explain_queue().popleft()
+            except IndexError:
+                time.sleep(EXPLAIN_POLL_INTERVAL)
+                continue
+            except Exception as e:
+                logger.warning("Could not read the EXPLAIN queue: %s", e)
+                time.sleep(EXPLAIN_POLL_INTERVAL)
+                continue
+            if not self._should_explain(query_id):
+                continue
+            try:
+                self._explain(query_id, query, params, tenant_id)
+            except Exception as e:
+                logger.warning("EXPLAIN of slow query %s failed: %s", query_id, e)
+
+    def _explain(self, query_id: str, query: str, params, tenant_id: str) -> None:
+        from exec import get_postgres_pool
+
+        timeout_ms = int(settings.SLOW_QUERY_EXPLAIN_TIMEOUT * 1000)
+        with get_postgres_pool().connection(search_path=tenant_id) as pg_conn:
+            try:
+                with pg_conn.cursor() as pg_cursor:
+                    pg_cursor.execute("SET LOCAL statement_timeout = %s", (timeout_ms,))
+                    pg_cursor.execute(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}", params)
+                    result = pg_cursor.fetchone()[0]
+            finally:
+                # ANALYZE really executes the query; never keep anything it did.
+                pg_conn.rollback()
+        if isinstance(result, str):
+            result = json.loads(result)
+        plan = result[0]
+        seq_scans = sorted({
+            node.get("Relation Name")
+            for node in _plan_nodes(plan["Plan"])
+            if node.get("Node Type") == "Seq Scan"
+        })
+        logger.warning(
+            "Slow query plan %s",
+            json.dumps(
+                {
+                    "fingerprint": query_id,
+                    "tenant": tenant_id,
+                    "execution_time_ms": plan.get("Execution Time"),
+                    "planning_time_ms": plan.get("Planning Time"),
+                    "seq_scans": seq_scans,
+                    "plan": plan["Plan"],
+                },
+                default=str,
+            ),
+        )
+
+
+_explainer = None
+_explainer_pid = None
+_explainer_lock = threading.Lock()
+
+
+def start_slow_query_explainer() -> None:
+    """
+    Explain the sampled slow queries of every process from a daemon thread in this one.
+
+    Call it from long-lived processes only; threads do not survive fork(),
+    so a preforking server calls it in each worker.
+    """
+    global _explainer, _explainer_pid, _explainer_lock
+    if _explainer_pid != os.getpid():
+        _explainer_lock = threading.Lock()
+        _explainer = None
+        _explainer_pid = os.getpid()
+    with _explainer_lock:
+        if _explainer is None:
+            _explainer = _Explainer()
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+from lazy_imports import lazy_import
+
+pd = lazy_import("pandas")
+
+IST = "Asia/Kolkata"
+DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_ist(series: pd.Series, unit: str = None) -> pd.Series:
+    """
+    Convert a whole column to IST in one vectorized step.
+
+    Naive timestamps are taken to be UTC, aware ones are converted from their
+    own offset, and ``unit="ms"`` reads the column as epoch milliseconds.
+
+    Args:
+    - series (pd.Series): Timestamps, datetimes, strings or epoch numbers.
+    - unit (str): Epoch unit for numeric columns, e.g. ``"ms"``.
+    """
+    return pd.to_datetime(series, unit=unit, utc=True).dt.tz_convert(IST)
+
+
+def format_ist(series: pd.Series, unit: str = None) -> pd.Series:
+    """
+    Convert a column to IST and render it as ``YYYY-MM-DD HH:MM:SS``.
+
+    Formatting goes through NumPy's datetime64 string conversion instead of
+    ``strftime``, which is several times faster for the fixed format the
+    tables use. Missing values stay missing.
+    """
+    local = to_ist(series, unit=unit).dt.tz_localize(None)
+    formatted = pd.Series(
+        local.to_numpy(dtype="datetime64[s]").astype(str), index=series.index
+    ).str.replace("T", " ", regex=False)
+    return formatted.where(local.notna(), None)
+
+
+def table_records(df: pd.DataFrame, columns, extra=()) -> list:
+    """
+    ``df`` as DataTable records with only the table's ``columns``.
+
+    Callback responses then carry just what the table displays, however many
+    columns the query needed. ``columns`` are the DataTable column dicts;
+    ``extra`` names hidden fields the page still reads from the records.
+    """
+    names = [column["id"] for column in columns] + list(extra)
+    return df.reindex(columns=names).to_dict("records")
+
+
+def format_datetime_columns(
+    df: pd.DataFrame,
+    columns=(),
+    epoch_ms_columns=(),
+) -> pd.DataFrame:
+    """
+    Format every datetime column of a result frame as IST strings, in place.
+
+    Args:
+    - df (pd.DataFrame): Query result.
+    - columns: Timestamp columns (naive UTC or timezone-aware).
+    - epoch_ms_columns: Integer columns holding epoch milliseconds.
+    """
+    for column in columns:
+        df[column] = format_ist(df[column])
+    for column in epoch_ms_columns:
+        df[column] = format_ist(df[column], unit="ms")
+    return df
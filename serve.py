@@ -0,0 +1,123 @@
+"""
+Production entry point: serves ``app.server`` under gunicorn.
+
+    python serve.py [--bind HOST:PORT] [--workers N] [--threads N] [--no-preload]
+
+Defaults come from the ``SERVER_*`` settings. ``app.py``'s own
+``app.run(debug=True)`` is Flask's development server and is only meant for
+local work.
+
+gunicorn preforks ``SERVER_WORKERS`` threaded workers. With
+``SERVER_PRELOAD`` the master imports the app once and loads the tenant
+directory and error rollup before forking, so workers share that memory
+copy-on-write, start warm and only catch up incrementally. The refreshers
+and the metrics snapshots are started in each worker after the fork, since
+threads do not survive it.
+
+Workers share one query cache in ``QUERY_CACHE_DIR``: ``QUERY_CACHE_BACKEND``
+defaults to ``shared`` here, so N workers don't mean N cold caches.
+
+Reload gracefully with ``kill -HUP <master pid>``: new workers start and the
+old ones finish their in-flight requests (up to ``SERVER_GRACEFUL_TIMEOUT``
+seconds) before exiting. A preloaded master keeps the code it imported, so
+to deploy new code send ``USR2`` (a new master starts next to the old one)
+and then ``TERM`` the old master once the new one is serving.
+"""
+import argparse
+import logging
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from base import settings
+
+logger = logging.getLogger(__name__)
+
+
+def warm_start() -> None:
+    """Load the tenant directory and error rollup, then drop the connections used to do it."""
+    from error_rollup import get_error_rollup
+    from exec import close_pools
+    from tenant_directory import get_tenant_directory
+
+    for name, target in (("tenant directory", get_tenant_directory()), ("error rate rollup", get_error_rollup())):
+        try:
+            target.refresh()
+        except Exception as e:
+            # Workers load it themselves once their refreshers start.
+            logger.warning("Could not preload the %s: %s", name, e)
+    close_pools()
+
+
+def on_starting(server) -> None:
+    import metrics
+
+    metrics.clear_worker_snapshots()
+
+
+def post_fork(server, worker) -> None:
+    import metrics
+    from app import start_background_refreshers
+
+    start_background_refreshers()
+    metrics.start_worker_snapshots()
+
+
+class DashboardServer(BaseApplication):
+    """gunicorn application serving ``app.server`` with options set in code."""
+
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self) -> None:
+        for name, value in self.options.items():
+            self.cfg.set(name, value)
+
+    def load(self):
+        from app import server
+
+        if self.cfg.preload_app:
+            warm_start()
+        return server
+
+
+def server_options(args) -> dict:
+    """gunicorn settings from the command line, falling back to the ``SERVER_*`` settings."""
+    max_requests = settings.SERVER_MAX_REQUESTS
+    return {
+        "bind": args.bind or settings.SERVER_BIND,
+        "workers": args.workers or settings.SERVER_WORKERS,
+        "threads": args.threads or settings.SERVER_THREADS,
+        "worker_class": "gthread",
+        "preload_app": settings.SERVER_PRELOAD and not args.no_preload,
+        "timeout": settings.SERVER_TIMEOUT,
+        "graceful_timeout": settings.SERVER_GRACEFUL_TIMEOUT,
+        # Recycle workers after this many requests (0 never does), staggered
+        # so they do not all restart at once.
+        "max_requests": max_requests,
+        "max_requests_jitter": max_requests // 10,
+        "on_starting": on_starting,
+        "post_fork": post_fork,
+    }
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bind", help="Address to listen on, e.g. 0.0.0.0:8050.")
+    parser.add_argument("--workers", type=int, help="Worker processes.")
+    parser.add_argument("--threads", type=int, help="Threads per worker.")
+    parser.add_argument("--no-preload", action="store_true", help="Import the app in each worker instead.")
+    args = parser.parse_args(argv)
+    # gunicorn only configures its own loggers; the app's (slow and echoed
+    # queries, refreshers) go through the root logger, which workers inherit.
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    # Before the settings are first read: workers share one query cache
+    # unless configured otherwise.
+    os.environ.setdefault("QUERY_CACHE_BACKEND", "shared")
+    DashboardServer(server_options(args)).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,399 @@
+"""
+Local Parquet snapshot of the write history, and an offline read mode over it.
+
+    python snapshot.py [--once]
+
+The snapshot job copies ``core_master.clickhouse_write_history`` and
+``core_master.tenant`` into ``SNAPSHOT_DIR`` every ``SNAPSHOT_INTERVAL``
+seconds, fetching only what changed since its last run:
+
+    SNAPSHOT_DIR/
+        state.json                                  watermarks of the last run
+        clickhouse_write_history/date=YYYY-MM-DD/   runs by UTC day of finished_at
+            part-<first id>-<last id>.parquet
+        tenant/tenant.parquet
+
+Runs are picked up by ``id`` above the watermark, like the error rollup, and
+written as one part per day per batch. Once a day holds more than
+``SNAPSHOT_COMPACT_FILES`` parts they are merged into one. Tenants modified
+or deleted since the last run are merged into the tenant file by id. Files
+are written under a temporary name and renamed into place, and the
+watermarks are saved only after a batch's files are; parts left behind by an
+interrupted run are removed at the start of the next.
+
+With ``ANALYTICS_SOURCE=snapshot`` the pages read the write history and
+tenants from these files through an embedded DuckDB instead of from
+PostgreSQL. DuckDB views named like the PostgreSQL tables let the SQL that
+``write_history`` builds run unchanged. Results lag by up to
+``SNAPSHOT_INTERVAL`` seconds.
+
+Both sides need the ``analytics`` extra (pyarrow and DuckDB).
+"""
+from __future__ import annotations
+
+import argparse
+import fcntl
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+import metrics
+import query_log
+from base import settings
+from exec import execute_postgres_frame
+from lazy_imports import lazy_import
+
+pd = lazy_import("pandas")
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_SOURCES = ("postgres", "snapshot")
+
+WRITE_HISTORY_TABLE = "clickhouse_write_history"
+TENANT_TABLE = "tenant"
+STATE_FILE = "state.json"
+LOCK_FILE = ".lock"
+
+NEW_RUNS_QUERY = """
+SELECT * FROM core_master.clickhouse_write_history
+WHERE id > %(after_id)s
+ORDER BY id
+LIMIT %(limit)s
+"""
+TENANT_QUERY = """
+SELECT *, GREATEST(modified_date, deleted_date) AS snapshot_changed_at
+FROM core_master.tenant
+"""
+TENANT_CHANGES_FILTER = "WHERE modified_date >= %(since)s OR deleted_date >= %(since)s\n"
+
+_PART = re.compile(r"^part-(\d+)-(\d+)\.parquet$")
+_PLACEHOLDER = re.compile(r"%\((\w+)\)s|%%")
+
+
+def reads_snapshot() -> bool:
+    """Whether the pages read the write history from the snapshot rather than PostgreSQL."""
+    source = settings.ANALYTICS_SOURCE
+    if source not in ANALYTICS_SOURCES:
+        raise ValueError(f"Unknown ANALYTICS_SOURCE {source!r}, expected one of {ANALYTICS_SOURCES}")
+    return source == "snapshot"
+
+
+def _part_name(first_id: int, last_id: int) -> str:
+    return f"part-{first_id:012d}-{last_id:012d}.parquet"
+
+
+def _parts(partition: str) -> list:
+    """``(first_id, last_id, path)`` of every part in ``partition``, in id order."""
+    parts = []
+    for name in os.listdir(partition):
+        match = _PART.match(name)
+        if match:
+            parts.append((int(match.group(1)), int(match.group(2)), os.path.join(partition, name)))
+    return sorted(parts)
+
+
+class SnapshotWriter:
+    """
+    Incremental export of the write history and tenant tables into Parquet files.
+
+    Args:
+    - directory (str): Root of the snapshot.
+    - batch_size (int): Runs fetched per round trip.
+    - compact_files (int): Parts a day may hold before they are merged into one.
+    """
+
+    def __init__(self, directory: str, batch_size: int, compact_files: int):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.compact_files = compact_files
+
+    def refresh(self) -> dict:
+        """Export what changed since the last refresh; returns the rows written per table."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK_FILE), "w") as lock:
+            # One writer at a time; a second job waits for the first to finish.
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self._load_state()
+            self._recover(state)
+            tenants = self._export_tenants(state)
+            runs = self._export_runs(state)
+        return {"runs": runs, "tenants": tenants}
+
+    def _load_state(self) -> dict:
+        try:
+            with open(os.path.join(self.directory, STATE_FILE)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _save_state(self, state: dict) -> None:
+        path = os.path.join(self.directory, STATE_FILE)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(f"{path}.tmp", path)
+
+    def _partitions(self) -> list:
+        root = os.path.join(self.directory, WRITE_HISTORY_TABLE)
+        if not os.path.isdir(root):
+            return []
+        return [os.path.join(root, name) for name in sorted(os.listdir(root))]
+
+    def _recover(self, state: dict) -> None:
+        # Parts past the watermark are from a batch that never committed; parts
+        # inside another part's id range were merged by an interrupted compaction.
+        last_id = state.get("last_id", -1)
+        for partition in self._partitions():
+            for name in os.listdir(partition):
+                if name.endswith(".tmp"):
+                    os.remove(os.path.join(partition, name))
+            for _, last, path in _parts(partition):
+                if last > last_id:
+                    os.remove(path)
+            parts = _parts(partition)
+            for first, last, path in parts:
+                if any(f <= first and last <= l and p != path for f, l, p in parts):
+                    os.remove(path)
+
+    def _write(self, df: pd.DataFrame, path: str) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # A column that is entirely NULL in this batch would be typed "null";
+        # text is the type every reader can widen from.
+        table = table.cast(pa.schema(
+            [field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema]
+        ))
+        pq.write_table(table, f"{path}.tmp", compression="zstd")
+        os.replace(f"{path}.tmp", path)
+
+    def _export_runs(self, state: dict) -> int:
+        added = 0
+        touched = set()
+        while True:
+            df = execute_postgres_frame(
+                NEW_RUNS_QUERY, {"after_id": state.get("last_id", -1), "limit": self.batch_size}, tenant_id="public"
+            )
+            if df.empty:
+                break
+            first, last = int(df["id"].iloc[0]), int(df["id"].iloc[-1])
+            days = df["finished_at"].dt.strftime("%Y-%m-%d").fillna("unknown")
+            for day, part in df.groupby(days, sort=False):
+                partition = os.path.join(self.directory, WRITE_HISTORY_TABLE, f"date={day}")
+                self._write(part, os.path.join(partition, _part_name(first, last)))
+                touched.add(partition)
+            state["last_id"] = last
+            self._save_state(state)
+            added += len(df)
+            if len(df) < self.batch_size:
+                break
+        for partition in sorted(touched):
+            self._compact(partition)
+        return added
+
+    def _compact(self, partition: str) -> None:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        parts = _parts(partition)
+        if len(parts) <= self.compact_files:
+            return
+        table = pa.concat_tables(
+            [pq.read_table(path) for _, _, path in parts], promote_options="permissive"
+        ).sort_by("id")
+        path = os.path.join(partition, _part_name(parts[0][0], max(last for _, last, _ in parts)))
+        pq.write_table(table, f"{path}.tmp", compression="zstd")
+        os.replace(f"{path}.tmp", path)
+        for _, _, old in parts:
+            if old != path:
+                os.remove(old)
+        logger.debug("Compacted %d parts in %s", len(parts), partition)
+
+    def _export_tenants(self, state: dict) -> int:
+        query, params = TENANT_QUERY, {}
+        since = state.get("tenant_changed_at")
+        if since is not None:
+            # >= as in the tenant directory: tenants sharing the watermark
+            # timestamp may have committed after the last run read it.
+            query += TENANT_CHANGES_FILTER
+            params["since"] = pd.Timestamp(since).to_pydatetime()
+        df = execute_postgres_frame(query, params, tenant_id="public")
+        path = os.path.join(self.directory, TENANT_TABLE, "tenant.parquet")
+        if df.empty and os.path.exists(path):
+            return 0
+        changed = df.pop("snapshot_changed_at").max()
+        count = len(df)
+        if since is not None and os.path.exists(path):
+            df = pd.concat([pd.read_parquet(path), df], ignore_index=True).drop_duplicates("id", keep="last")
+        self._write(df, path)
+        if pd.notna(changed):
+            state["tenant_changed_at"] = changed.isoformat()
+        self._save_state(state)
+        return count
+
+
+# -- Reading -------------------------------------------------------------------
+
+_connection = None
+_connection_pid = None
+_connection_lock = threading.Lock()
+
+
+def _snapshot_connection():
+    """The process's DuckDB connection, with a view over the snapshot for each table."""
+    global _connection, _connection_pid, _connection_lock
+    if _connection_pid != os.getpid():
+        # A DuckDB connection must not be shared across fork().
+        _connection_lock = threading.Lock()
+        _connection = None
+        _connection_pid = os.getpid()
+    if _connection is None:
+        with _connection_lock:
+            if _connection is None:
+                import duckdb
+
+                root = os.path.abspath(settings.SNAPSHOT_DIR)
+                sources = {
+                    WRITE_HISTORY_TABLE: os.path.join(root, WRITE_HISTORY_TABLE, "*", "*.parquet"),
+                    TENANT_TABLE: os.path.join(root, TENANT_TABLE, "tenant.parquet"),
+                }
+                conn = duckdb.connect()
+                conn.execute("SET TimeZone = 'UTC'")
+                conn.execute("CREATE SCHEMA core_master")
+                for table, source in sources.items():
+                    # The file list is expanded again on every query, so new
+                    # parts are read as soon as the snapshot job renames them in.
+                    source = source.replace("'", "''")
+                    try:
+                        conn.execute(
+                            f"CREATE VIEW core_master.{table} AS SELECT * FROM "
+                            f"read_parquet('{source}', union_by_name = true, hive_partitioning = false)"
+                        )
+                    except duckdb.IOException:
+                        conn.close()
+                        raise RuntimeError(
+                            f"No {table} snapshot in {root}; run `python snapshot.py --once` first"
+                        ) from None
+                _connection = conn
+    return _connection
+
+
+def _to_duckdb(query: str, params: dict):
+    """``query`` with psycopg2's ``%(name)s`` placeholders rewritten for DuckDB, and the values they bind."""
+    params = params or {}
+    bound = {}
+
+    def placeholder(match):
+        name = match.group(1)
+        if name is None:
+            return "%"
+        value = params[name]
+        if isinstance(value, tuple):
+            # psycopg2 sends a tuple as a row, as in (finished_at, id) > %(newer_than)s.
+            names = [f"{name}_{i}" for i in range(len(value))]
+            bound.update(zip(names, value))
+            return "(" + ", ".join(f"${item}" for item in names) + ")"
+        bound[name] = value
+        return f"${name}"
+
+    return _PLACEHOLDER.sub(placeholder, query), bound
+
+
+def _plain_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    # DuckDB hands back nullable integers and microsecond timestamps; match
+    # what the PostgreSQL paths return.
+    for name, column in df.items():
+        if column.dtype.kind in "iu" and isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+            df[name] = column.astype("float64") if column.hasnans else column.astype("int64")
+        elif column.dtype.kind == "b" and isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+            df[name] = column.astype(object).where(column.notna(), None) if column.hasnans else column.astype(bool)
+        elif column.dtype.kind == "M":
+            column = column.dt.as_unit("ns")
+            df[name] = column.dt.tz_convert("UTC") if column.dt.tz is not None else column
+    return df
+
+
+def _run_snapshot_query(query: str, params: dict, fetch, query_name: str):
+    started = time.perf_counter()
+    with metrics.track_query("snapshot", query_name) as observation:
+        cursor = _snapshot_connection().cursor()
+        try:
+            cursor.execute(*_to_duckdb(query, params))
+            result = fetch(cursor)
+        finally:
+            cursor.close()
+        observation.record(result[1] if isinstance(result, tuple) else result)
+    query_log.observe(
+        "snapshot", query, params, "snapshot", time.perf_counter() - started,
+        rows=observation.rows, query_name=query_name,
+    )
+    return result
+
+
+def execute_snapshot_query(query: str, params: dict, include_columns: bool = False, query_name: str = None):
+    """
+    Execute a query over the snapshot; the counterpart of ``execute_postgres_query``.
+
+    Args:
+    - query (str): The SQL query, with psycopg2-style ``%(name)s`` parameters.
+    - params (dict): The parameters to pass to the query.
+    - include_columns (bool): Return ``(column_names, rows)`` instead of just the rows.
+    - query_name (str): Label for the query metrics, defaults to the calling function's name.
+    """
+    query_name = query_name or sys._getframe(1).f_code.co_name
+    names, rows = _run_snapshot_query(
+        query, params, lambda cursor: ([column[0] for column in cursor.description], cursor.fetchall()), query_name
+    )
+    return (names, rows) if include_columns else rows
+
+
+def execute_snapshot_frame(query: str, params: dict, query_name: str = None) -> pd.DataFrame:
+    """
+    Execute a query over the snapshot into a DataFrame; the counterpart of ``execute_postgres_frame``.
+
+    Args:
+    - query (str): The SQL query, with psycopg2-style ``%(name)s`` parameters.
+    - params (dict): The parameters to pass to the query.
+    - query_name (str): Label for the query metrics, defaults to the calling function's name.
+    """
+    query_name = query_name or sys._getframe(1).f_code.co_name
+    return _plain_dtypes(_run_snapshot_query(query, params, lambda cursor: cursor.df(), query_name))
+
+
+def count_snapshot_rows(query: str, params: dict) -> int:
+    """Rows ``query`` returns over the snapshot; exact, and cheap enough to stand in for a planner estimate."""
+    rows = _run_snapshot_query(
+        f"SELECT count(*) FROM ({query}) AS counted", params, lambda cursor: cursor.fetchall(),
+        f"count:{sys._getframe(1).f_code.co_name}",
+    )
+    return int(rows[0][0])
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--once", action="store_true", help="Refresh once and exit.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    writer = SnapshotWriter(settings.SNAPSHOT_DIR, settings.SNAPSHOT_BATCH_SIZE, settings.SNAPSHOT_COMPACT_FILES)
+    while True:
+        started = time.monotonic()
+        try:
+            added = writer.refresh()
+            logger.info("Snapshot picked up %d runs and %d tenants", added["runs"], added["tenants"])
+        except Exception as e:
+            if args.once:
+                raise
+            logger.warning("Snapshot refresh failed: %s", e)
+        if args.once:
+            return
+        time.sleep(max(0.0, settings.SNAPSHOT_INTERVAL - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Import-time profile of the app's cold start.
+
+``python app.py --profile-startup`` runs ``import app`` again in a fresh
+interpreter under ``python -X importtime`` and prints where the time went:
+the total per top-level package and the slowest individual imports. With
+``--budget`` the exit status is non-zero when importing the app takes
+longer, so a deploy check can keep cold start bounded.
+
+``-X importtime`` itself adds some overhead, so compare numbers from this
+tool with each other rather than with plain start-up times.
+"""
+import argparse
+import subprocess
+import sys
+import time
+from collections import defaultdict, namedtuple
+
+ImportTime = namedtuple("ImportTime", ["module", "level", "self_us", "cumulative_us"])
+
+
+def parse_importtime(output: str) -> list:
+    """
+    The ``ImportTime`` entries in ``-X importtime`` output, in the order reported.
+
+    ``level`` is the nesting depth: 0 for imports made by the top-level
+    statement, 1 for the imports those made, and so on.
+    """
+    entries = []
+    for line in output.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        if not self_us.strip().isdigit():
+            # The header line.
+            continue
+        name = name[1:]
+        module = name.lstrip()
+        entries.append(ImportTime(module, (len(name) - len(module)) // 2, int(self_us), int(cumulative_us)))
+    return entries
+
+
+def by_package(entries) -> dict:
+    """Self time in microseconds per top-level package, largest first."""
+    totals = defaultdict(int)
+    for entry in entries:
+        totals[entry.module.split(".")[0]] += entry.self_us
+    return dict(sorted(totals.items(), key=lambda item: item[1], reverse=True))
+
+
+def profile_startup(module: str = "app", top: int = 20, budget: float = None) -> int:
+    """
+    Import ``module`` in a fresh interpreter and print its import-time breakdown.
+
+    Args:
+    - module (str): Module whose import is profiled.
+    - top (int): Packages and imports listed.
+    - budget (float): Seconds the import may take; exceeding it returns 1.
+
+    Returns the exit status.
+    """
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    wall = time.perf_counter() - started
+    entries = parse_importtime(result.stderr)
+    if result.returncode != 0:
+        print("\n".join(line for line in result.stderr.splitlines() if not line.startswith("import time:")))
+        print(f"import {module} failed with exit status {result.returncode}")
+        return result.returncode
+
+    # The module may be reported more than once (e.g. as __main__'s import
+    # and again by name); take the largest.
+    matches = [entry for entry in entries if entry.module == module]
+    target = max(matches, key=lambda entry: entry.cumulative_us, default=None)
+    module_seconds = target.cumulative_us / 1e6 if target else float("nan")
+    total_us = sum(entry.self_us for entry in entries)
+
+    print(f"import {module}: {module_seconds:.3f}s (interpreter start to exit: {wall:.3f}s)")
+    print(f"\nSlowest packages (own import time, {len(entries)} modules in total):")
+    for package, self_us in list(by_package(entries).items())[:top]:
+        print(f"  {self_us / 1000:9.1f} ms  {self_us * 100 / total_us:5.1f}%  {package}")
+    print("\nSlowest imports (including what they import):")
+    for entry in sorted(entries, key=lambda entry: entry.cumulative_us, reverse=True)[:top]:
+        print(f"  {entry.cumulative_us / 1000:9.1f} ms  {'  ' * entry.level}{entry.module}")
+
+    if budget is not None and not module_seconds <= budget:
+        print(f"\nimport {module} took {module_seconds:.3f}s, over the {budget:.3f}s budget")
+        return 1
+    return 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--profile-startup", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--module", default="app", help="Module to import (default: app).")
+    parser.add_argument("--top", type=int, default=20, help="Packages and imports listed.")
+    parser.add_argument("--budget", type=float, help="Fail when the import takes longer than this many seconds.")
+    args = parser.parse_args(argv)
+    return profile_startup(args.module, top=args.top, budget=args.budget)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+"""
+Parsing of DataTable ``filter_query`` strings for tables filtered server-side.
+
+With ``filter_action="custom"`` the table sends what was typed into its
+filter row as one expression, e.g.
+``{contact_email} contains "acme" && {error_count} > 10``. ``parse_filter_query``
+turns that into ``[column, operator, value]`` conditions; the query modules
+decide which columns may be filtered and build the SQL from them.
+
+Only conditions joined with ``&&`` are supported, which is everything the
+filter row produces. Operators are normalized to ``eq``, ``ne``, ``lt``,
+``le``, ``gt``, ``ge``, ``ieq``, ``ine``, ``contains``, ``icontains``,
+``datestartswith``, ``blank`` and ``notblank``.
+"""
+import re
+
+_TOKEN = re.compile(
+    r"""\s*(?:
+        (?P<field>\{(?:[^{}\\]|\\.)*\})
+      | (?P<quoted>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*'|`(?:[^`\\]|\\.)*`)
+      | (?P<symbol>&&|\|\||<=|>=|!=|=|<|>|\(|\)|!)
+      | (?P<word>[^\s{}"'`()&|<>=!]+)
+    )""",
+    re.VERBOSE,
+)
+_ESCAPE = re.compile(r"\\(.)")
+
+OPERATORS = {
+    "=": "eq",
+    "!=": "ne",
+    "<": "lt",
+    "<=": "le",
+    ">": "gt",
+    ">=": "ge",
+    "datestartswith": "datestartswith",
+}
+for _name in ("eq", "ne", "lt", "le", "gt", "ge", "contains"):
+    # A leading "s" asks for the case-sensitive match, which is the default;
+    # "i" for a case-insensitive one, which only matters for text.
+    OPERATORS[_name] = OPERATORS["s" + _name] = _name
+    OPERATORS["i" + _name] = "i" + _name if _name in ("eq", "ne", "contains") else _name
+
+UNARY_OPERATORS = {
+    ("blank",): "blank",
+    ("nil",): "blank",
+    ("not", "blank"): "notblank",
+    ("not", "nil"): "notblank",
+}
+
+
+def _tokens(filter_query: str) -> list:
+    tokens = []
+    position = 0
+    filter_query = filter_query.rstrip()
+    while position < len(filter_query):
+        match = _TOKEN.match(filter_query, position)
+        if match is None:
+            raise ValueError(f"Cannot read the filter at {filter_query[position:]!r}")
+        kind = match.lastgroup
+        tokens.append((kind, match.group(kind)))
+        position = match.end()
+    return tokens
+
+
+def _unescape(text: str) -> str:
+    return _ESCAPE.sub(r"\1", text[1:-1])
+
+
+def _condition(tokens: list) -> list:
+    if len(tokens) < 2 or tokens[0][0] != "field":
+        raise ValueError("Each filter must start with a {column} and an operator")
+    column = _unescape(tokens[0][1])
+    kind, text = tokens[1]
+
+    if kind == "word" and text.lower() == "is":
+        words = tuple(word.lower() for _, word in tokens[2:])
+        if words not in UNARY_OPERATORS:
+            raise ValueError(f"Unsupported filter operator 'is {' '.join(words)}'")
+        return [column, UNARY_OPERATORS[words], None]
+
+    operator = OPERATORS.get(text.lower())
+    if operator is None or kind not in ("symbol", "word"):
+        raise ValueError(f"Unsupported filter operator {text!r}")
+    if len(tokens) != 3 or tokens[2][0] not in ("quoted", "word"):
+        raise ValueError(f"The {column} filter needs exactly one value")
+    kind, value = tokens[2]
+    return [column, operator, _unescape(value) if kind == "quoted" else value]
+
+
+def parse_filter_query(filter_query: str) -> list:
+    """
+    The ``[column, operator, value]`` conditions of a DataTable ``filter_query``.
+
+    ``value`` is the text as typed (``None`` for ``blank``/``notblank``);
+    converting it to the column's type is left to the caller. Raises
+    ``ValueError`` for anything the filter row would not produce, such as
+    ``||`` or parentheses.
+    """
+    if not filter_query or not filter_query.strip():
+        return []
+    conditions = []
+    term = []
+    for kind, text in _tokens(filter_query) + [("symbol", "&&")]:
+        if text == "&&" or (kind == "word" and text.lower() == "and"):
+            if not term:
+                raise ValueError("Empty condition in the filter")
+            conditions.append(_condition(term))
+            term = []
+        elif kind == "symbol" and text in ("||", "(", ")", "!"):
+            raise ValueError("Only filters joined with && are supported")
+        elif kind == "word" and text.lower() == "or":
+            raise ValueError("Only filters joined with && are supported")
+        else:
+            term.append((kind, text))
+    return conditions
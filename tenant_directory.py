@@ -0,0 +1,345 @@
+"""
+In-process directory of ``core_master.tenant`` with a search index for autocomplete.
+
+The directory is loaded once and then caught up from the tenants modified or
+deleted since the last refresh. Tenant details are held column-wise, one
+list per field, so write history queries can skip the tenant JOIN and have
+``base_domain``, ``name`` and ``contact_email`` filled in from memory.
+
+Search combines a sorted prefix index over every field (binary search) with
+a trigram index for substrings. Both are only ever appended to between
+rebuilds; entries left stale by an update are filtered out when read, and
+the indexes are rebuilt once too many have accumulated.
+"""
+from __future__ import annotations
+
+import bisect
+import logging
+import os
+import threading
+import time
+from array import array
+
+from base import settings
+from exec import execute_postgres_query
+from lazy_imports import lazy_import
+from snapshot import execute_snapshot_query, reads_snapshot
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("tenant_id", "tenant_name", "base_domain", "contact_email")
+SEPARATOR = "\x1f"
+
+# Rebuild the indexes once this share of their entries is stale, or when a
+# refresh brings more tenants than are worth inserting one by one.
+STALE_REBUILD_RATIO = 0.1
+INCREMENTAL_INDEX_LIMIT = 1000
+
+TENANT_QUERY = """
+SELECT id AS tenant_id, name AS tenant_name, base_domain, contact_email, deleted_date,
+       GREATEST(modified_date, deleted_date) AS changed_at
+FROM core_master.tenant
+"""
+TENANT_CHANGES_FILTER = "WHERE modified_date >= %(since)s OR deleted_date >= %(since)s\n"
+
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+_COMPARISONS = {
+    "eq": lambda a, b: a == b,
+    "ne": lambda a, b: a != b,
+    "lt": lambda a, b: a < b,
+    "le": lambda a, b: a <= b,
+    "gt": lambda a, b: a > b,
+    "ge": lambda a, b: a >= b,
+    "ieq": lambda a, b: a.lower() == b.lower(),
+    "ine": lambda a, b: a.lower() != b.lower(),
+    "contains": lambda a, b: b in a,
+    "icontains": lambda a, b: b.lower() in a.lower(),
+    "datestartswith": lambda a, b: a.startswith(b),
+}
+
+
+def _matches(value, operator: str, operand) -> bool:
+    if operator in ("blank", "notblank"):
+        return (value is None or value == "") == (operator == "blank")
+    # Like SQL, a missing value matches no comparison.
+    return value is not None and _COMPARISONS[operator](str(value), str(operand))
+
+
+class TenantDirectory:
+    """
+    Tenants by id, with prefix and substring search over id, name, domain and email.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._columns = {field: [] for field in FIELDS}
+        self._deleted = []
+        self._haystacks = []
+        self._prefix = []
+        self._trigrams = {}
+        self._stale = 0
+        self._deleted_ids = None
+        self._watermark = None
+        self._loaded = False
+        self._refreshed_at = float("-inf")
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @property
+    def loaded(self) -> bool:
+        return self._loaded
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    # -- loading ---------------------------------------------------------------
+
+    def refresh(self) -> int:
+        """Load every tenant, or only those changed since the last refresh; returns how many."""
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+        with self._lock:
+            query, params = TENANT_QUERY, {}
+            if self._watermark is not None:
+                # >= rather than >: tenants sharing the watermark timestamp may
+                # have committed after the last refresh read it.
+                query += TENANT_CHANGES_FILTER
+                params["since"] = self._watermark
+            if reads_snapshot():
+                names, rows = execute_snapshot_query(
+                    query=query + "ORDER BY changed_at", params=params, include_columns=True
+                )
+            else:
+                names, rows = execute_postgres_query(
+                    query=query + "ORDER BY changed_at",
+                    params=params,
+                    tenant_id="public",
+                    include_columns=True,
+                )
+            touched = [self._apply(dict(zip(names, row))) for row in rows]
+            changed_at = names.index("changed_at")
+            latest = max((row[changed_at] for row in rows if row[changed_at] is not None), default=None)
+            if latest is not None and (self._watermark is None or latest > self._watermark):
+                self._watermark = latest
+            if touched:
+                self._deleted_ids = None
+                if len(touched) > INCREMENTAL_INDEX_LIMIT or self._stale > STALE_REBUILD_RATIO * len(self._prefix):
+                    self._rebuild_indexes()
+                else:
+                    for row in touched:
+                        self._index_row(row)
+            self._loaded = True
+            self._refreshed_at = time.monotonic()
+        if rows:
+            logger.debug("Tenant directory picked up %d tenants", len(rows))
+        return len(rows)
+
+    def maybe_refresh(self, interval: float) -> None:
+        """Catch up unless the last refresh was less than ``interval`` seconds ago."""
+        if self._loaded and time.monotonic() - self._refreshed_at >= interval:
+            self.refresh()
+
+    def _apply(self, tenant: dict) -> int:
+        tenant_id = str(tenant["tenant_id"])
+        values = [tenant_id] + [tenant[field] for field in FIELDS[1:]]
+        row = self._rows.get(tenant_id)
+        if row is None:
+            row = self._rows[tenant_id] = len(self._deleted)
+            for field, value in zip(FIELDS, values):
+                self._columns[field].append(value)
+            self._deleted.append(tenant["deleted_date"] is not None)
+            self._haystacks.append("")
+        else:
+            for field, value in zip(FIELDS, values):
+                self._columns[field][row] = value
+            self._deleted[row] = tenant["deleted_date"] is not None
+            # The old index entries stay behind and are filtered out on read.
+            self._stale += len(FIELDS)
+        self._haystacks[row] = SEPARATOR.join(str(self._columns[field][row] or "").lower() for field in FIELDS)
+        return row
+
+    def _index_row(self, row: int) -> None:
+        for key in self._haystacks[row].split(SEPARATOR):
+            if key:
+                bisect.insort(self._prefix, (key, row))
+        for trigram in _trigrams(self._haystacks[row]):
+            postings = self._trigrams.get(trigram)
+            if postings is None:
+                postings = self._trigrams[trigram] = array("I")
+            postings.append(row)
+
+    def _rebuild_indexes(self) -> None:
+        self._prefix = sorted(
+            (key, row)
+            for row, haystack in enumerate(self._haystacks)
+            for key in haystack.split(SEPARATOR)
+            if key
+        )
+        trigrams = {}
+        for row, haystack in enumerate(self._haystacks):
+            for trigram in _trigrams(haystack):
+                trigrams.setdefault(trigram, array("I")).append(row)
+        self._trigrams = trigrams
+        self._stale = 0
+
+    # -- lookups ---------------------------------------------------------------
+
+    def get(self, tenant_id) -> dict:
+        """The tenant's fields plus ``deleted``, or ``None`` if unknown."""
+        row = self._rows.get(str(tenant_id))
+        if row is None:
+            return None
+        tenant = {field: self._columns[field][row] for field in FIELDS}
+        tenant["deleted"] = self._deleted[row]
+        return tenant
+
+    def deleted_ids(self) -> list:
+        """Ids of every deleted tenant."""
+        if self._deleted_ids is None:
+            self._deleted_ids = [
+                tenant_id for tenant_id, deleted in zip(self._columns["tenant_id"], self._deleted) if deleted
+            ]
+        return self._deleted_ids
+
+    def active_ids(self) -> list:
+        """Ids of every tenant that is not deleted."""
+        return [tenant_id for tenant_id, deleted in zip(self._columns["tenant_id"], self._deleted) if not deleted]
+
+    def matching_ids(self, conditions) -> list:
+        """
+        Ids of the tenants meeting every ``(field, operator, value)`` condition.
+
+        Operators are those of ``table_query``, matched the way the SQL built
+        for them would match the tenant table's columns.
+        """
+        rows = range(len(self._deleted))
+        for field, operator, value in conditions:
+            column = self._columns[field]
+            rows = [row for row in rows if _matches(column[row], operator, value)]
+        return [self._columns["tenant_id"][row] for row in rows]
+
+    def enrich(self, tenant_ids: pd.Series, fields) -> dict:
+        """
+        Tenant ``fields`` for every id in ``tenant_ids``, as arrays aligned with it.
+
+        Unknown tenants get ``None``, like the LEFT JOIN they replace.
+        """
+        rows = self._rows
+        positions = [rows.get(str(tenant_id)) for tenant_id in tenant_ids]
+        result = {}
+        for field in fields:
+            column = self._columns[field]
+            result[field] = np.array([None if row is None else column[row] for row in positions], dtype=object)
+        return result
+
+    def search(self, text: str, limit: int = 20) -> list:
+        """
+        Tenants matching ``text``, best matches first, as dicts like ``get``.
+
+        An exact id comes first, then tenants with a field starting with
+        ``text``, then tenants containing it anywhere.
+        """
+        text = (text or "").strip().lower()
+        if not text:
+            return []
+        found = []
+        seen = set()
+
+        def add(row):
+            if row not in seen:
+                seen.add(row)
+                found.append(row)
+
+        exact = self._rows.get(text)
+        if exact is not None:
+            add(exact)
+
+        prefix = self._prefix
+        i = bisect.bisect_left(prefix, (text,))
+        while i < len(prefix) and len(found) < limit:
+            key, row = prefix[i]
+            if not key.startswith(text):
+                break
+            if key in self._haystacks[row].split(SEPARATOR):
+                add(row)
+            i += 1
+
+        if len(found) < limit:
+            for row in self._substring_candidates(text):
+                if row not in seen and text in self._haystacks[row]:
+                    add(row)
+                    if len(found) >= limit:
+                        break
+
+        return [self.get(self._columns["tenant_id"][row]) for row in found[:limit]]
+
+    def _substring_candidates(self, text: str):
+        trigrams = _trigrams(text)
+        if not trigrams:
+            return range(len(self._haystacks))
+        postings = []
+        for trigram in trigrams:
+            rows = self._trigrams.get(trigram)
+            if rows is None:
+                return ()
+            postings.append(rows)
+        # Every candidate contains the rarest trigram; the caller checks the rest.
+        return min(postings, key=len)
+
+
+_directory = None
+_directory_lock = threading.Lock()
+
+
+def get_tenant_directory() -> TenantDirectory:
+    """
+    Return the process-wide tenant directory, creating it (empty) on first use.
+    """
+    global _directory
+    if _directory is None:
+        with _directory_lock:
+            if _directory is None:
+                _directory = TenantDirectory()
+    return _directory
+
+
+def active_tenant_ids() -> list:
+    """Ids of the tenants that are not deleted, from the directory once it has loaded."""
+    directory = get_tenant_directory()
+    if directory.loaded:
+        return directory.active_ids()
+    query = "SELECT id FROM core_master.tenant WHERE deleted_date IS NULL"
+    if reads_snapshot():
+        rows = execute_snapshot_query(query=query, params={})
+    else:
+        rows = execute_postgres_query(query=query, params={}, tenant_id="public")
+    return [str(row[0]) for row in rows]
+
+
+def start_tenant_directory_refresher() -> threading.Thread:
+    """
+    Load the tenant directory and keep it current from a daemon thread.
+
+    Until the first load completes, queries fall back to joining the tenant table.
+    """
+
+    def run():
+        directory = get_tenant_directory()
+        while True:
+            try:
+                directory.refresh()
+            except Exception as e:
+                logger.warning("Tenant directory refresh failed: %s", e)
+            time.sleep(settings.TENANT_DIRECTORY_REFRESH_INTERVAL)
+
+    thread = threading.Thread(target=run, name="tenant-directory-refresher", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,455 @@
+"""
+Per-tenant health baselines from the write history tail, with anomaly and staleness alerts.
+
+    python tenant_health.py [--once]
+
+The job keeps, for every tenant, exponentially weighted means and variances
+(``HEALTH_EWMA_ALPHA``) of each run's error rate, ``duration`` and
+``db_persist_duration``, of the gap between its runs, and of how far its
+``last_event_received_at`` trails ``finished_at``. Every
+``HEALTH_CHECK_INTERVAL`` seconds it pulls the runs added since its ``id``
+watermark, like the error rollup, folds them into the baselines, and checks:
+
+- anomaly: a run's error rate, duration or persist duration is more than
+  ``HEALTH_ANOMALY_Z`` standard deviations above the tenant's baseline;
+- stale: the tenant's last event is older than its usual event lag plus its
+  usual gap between runs, by the same margin (and at least
+  ``HEALTH_STALE_MIN_SECONDS``).
+
+Tenants are only judged once they have ``HEALTH_MIN_RUNS`` runs. Newly raised
+and cleared flags go out as one email per check to
+``HEALTH_ALERT_RECIPIENTS`` through the ``SMTP_*`` settings; a flag is only
+mailed once until it clears. Deleted tenants are not alerted on.
+
+The baselines are a handful of NumPy arrays indexed by tenant, saved to
+``HEALTH_STATE_PATH`` after every check, so a restart resumes from the
+watermark. With no saved state the job starts ``HEALTH_WARMUP_DAYS`` back
+rather than from the first run. Run a single instance: a second one waits on
+the state file's lock and takes over when the first exits.
+"""
+from __future__ import annotations
+
+import argparse
+import fcntl
+import logging
+import os
+import smtplib
+import time
+from datetime import datetime, timezone
+from email.message import EmailMessage
+from email.utils import formataddr
+
+from base import settings
+from lazy_imports import lazy_import
+from tenant_directory import get_tenant_directory
+from write_history import fetch_new_runs
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+logger = logging.getLogger(__name__)
+
+HEALTH_COLUMNS = [
+    "id", "tenant_id", "finished_at", "records_count", "error_count", "duration", "db_persist_duration",
+    "last_event_timestamp",
+]
+
+# Baselines kept per tenant. The first three are checked run by run; the gap
+# and event lag (seconds) only feed the staleness threshold.
+METRICS = ("error_rate", "duration", "db_persist_duration", "gap", "event_lag")
+ANOMALY_METRICS = METRICS[:3]
+STALE_FLAG = len(ANOMALY_METRICS)
+FLAG_NAMES = ANOMALY_METRICS + ("stale",)
+
+# A tenant with a very steady baseline would otherwise flag on noise; the
+# deviation used is at least this share of the mean, and at least the floor
+# (percentage points for the error rate, seconds for the durations).
+MIN_SIGMA_RATIO = 0.1
+MIN_SIGMA = {"error_rate": 1.0, "duration": 1.0, "db_persist_duration": 1.0}
+
+_NO_EVENT = -1
+
+
+def _to_ns(values) -> np.ndarray:
+    """UTC epoch nanoseconds; naive timestamps are taken to be UTC."""
+    return pd.to_datetime(values, utc=True).to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+def _empty_stats() -> dict:
+    stats = {
+        "runs": np.empty(0, dtype=np.int64),
+        "last_finished": np.empty(0, dtype=np.int64),
+        "last_event": np.empty(0, dtype=np.int64),
+        "flags": np.empty(0, dtype=np.uint8),
+        "alerted": np.empty(0, dtype=np.uint8),
+    }
+    for metric in METRICS:
+        stats[f"{metric}_n"] = np.empty(0, dtype=np.int64)
+        stats[f"{metric}_mean"] = np.empty(0, dtype=np.float64)
+        stats[f"{metric}_var"] = np.empty(0, dtype=np.float64)
+    return stats
+
+
+class TenantHealth:
+    """
+    Rolling per-tenant baselines and the flags raised against them.
+
+    Args:
+    - alpha (float): EWMA weight of each new run.
+    - anomaly_z (float): Standard deviations above the baseline that raise a flag.
+    - min_runs (int): Runs a tenant needs before it is judged.
+    - stale_min_seconds (float): Lower bound of every tenant's staleness threshold.
+    - batch_size (int): Rows fetched per round trip while catching up.
+    """
+
+    def __init__(self, alpha: float, anomaly_z: float, min_runs: int, stale_min_seconds: float, batch_size: int):
+        self.alpha = alpha
+        self.anomaly_z = anomaly_z
+        self.min_runs = min_runs
+        self.stale_min_seconds = stale_min_seconds
+        self.batch_size = batch_size
+        self._stats = _empty_stats()
+        self._tenants = []
+        self._tenant_codes = {}
+        self._last_id = None
+
+    def __len__(self) -> int:
+        return len(self._tenants)
+
+    # -- state -----------------------------------------------------------------
+
+    def load(self, path: str) -> bool:
+        """Resume from the state saved at ``path``; returns whether there was any."""
+        try:
+            with np.load(path, allow_pickle=False) as saved:
+                stats = {name: saved[name] for name in _empty_stats()}
+                tenants = saved["tenants"].tolist()
+                last_id = int(saved["last_id"])
+        except FileNotFoundError:
+            return False
+        self._stats = stats
+        self._tenants = tenants
+        self._tenant_codes = {tenant_id: code for code, tenant_id in enumerate(tenants)}
+        self._last_id = last_id if last_id >= 0 else None
+        return True
+
+    def save(self, path: str) -> None:
+        """Write the state to ``path`` atomically."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                tenants=np.array(self._tenants, dtype=str),
+                last_id=np.int64(self._last_id if self._last_id is not None else -1),
+                **self._stats,
+            )
+        os.replace(f"{path}.tmp", path)
+
+    # -- updates ---------------------------------------------------------------
+
+    def refresh(self, warmup_days: int = None) -> int:
+        """
+        Fold in every run added since the watermark; returns how many.
+
+        Without a watermark only runs finished in the last ``warmup_days``
+        days are read.
+        """
+        filters = {}
+        if self._last_id is None and warmup_days is not None:
+            start = time.time() - warmup_days * 86400
+            filters["finished_after"] = datetime.fromtimestamp(start, tz=timezone.utc)
+        added = 0
+        while True:
+            df = fetch_new_runs(
+                HEALTH_COLUMNS,
+                after_id=self._last_id if self._last_id is not None else -1,
+                limit=self.batch_size,
+                filters=filters,
+            )
+            if df.empty:
+                break
+            self.update(df)
+            self._last_id = int(df["id"].max())
+            added += len(df)
+            if len(df) < self.batch_size:
+                break
+        if added:
+            logger.debug("Tenant health picked up %d runs (watermark id %s)", added, self._last_id)
+        return added
+
+    def update(self, df: pd.DataFrame) -> None:
+        """Fold a batch of runs (``HEALTH_COLUMNS``) into the baselines, oldest first."""
+        if df.empty:
+            return
+        finished = _to_ns(df["finished_at"])
+        order = np.lexsort((df["id"].to_numpy(dtype=np.int64), finished))
+        df = df.iloc[order]
+        finished = finished[order]
+        codes = self._encode_tenants(df["tenant_id"].tolist())
+
+        records = df["records_count"].to_numpy(dtype=np.float64, na_value=np.nan)
+        errors = df["error_count"].fillna(0).to_numpy(dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # Runs that wrote nothing have no error rate.
+            error_rate = np.where(records > 0, errors * 100.0 / records, np.nan)
+        values = {
+            "error_rate": error_rate,
+            "duration": df["duration"].to_numpy(dtype=np.float64, na_value=np.nan),
+            "db_persist_duration": df["db_persist_duration"].to_numpy(dtype=np.float64, na_value=np.nan),
+        }
+        last_event = df["last_event_timestamp"].to_numpy(dtype=np.float64, na_value=np.nan)
+        values["event_lag"] = (finished / 1e6 - last_event) / 1e3
+        last_event = np.where(np.isnan(last_event), _NO_EVENT, last_event).astype(np.int64)
+
+        # A tenant's runs must be applied in order, but different tenants'
+        # runs are independent: apply the first run of every tenant in the
+        # batch at once, then the second, and so on.
+        rank = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+        by_rank = np.argsort(rank, kind="stable")
+        bounds = np.searchsorted(rank[by_rank], np.arange(rank.max() + 2))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            rows = by_rank[lo:hi]
+            self._apply(
+                codes[rows], finished[rows], last_event[rows], {name: column[rows] for name, column in values.items()}
+            )
+
+    def _encode_tenants(self, tenant_ids) -> np.ndarray:
+        codes = np.empty(len(tenant_ids), dtype=np.int64)
+        for i, tenant_id in enumerate(tenant_ids):
+            # Kept as text, the way they are saved and the tenant directory keys them.
+            tenant_id = str(tenant_id)
+            code = self._tenant_codes.get(tenant_id)
+            if code is None:
+                code = self._tenant_codes[tenant_id] = len(self._tenants)
+                self._tenants.append(tenant_id)
+            codes[i] = code
+        grow = len(self._tenants) - len(self._stats["runs"])
+        if grow:
+            for name, column in self._stats.items():
+                self._stats[name] = np.concatenate([column, np.zeros(grow, dtype=column.dtype)])
+            self._stats["last_event"][-grow:] = _NO_EVENT
+        return codes
+
+    def _apply(self, codes: np.ndarray, finished: np.ndarray, last_event: np.ndarray, values: dict) -> None:
+        # Every tenant appears at most once in ``codes``.
+        stats = self._stats
+        alpha = self.alpha
+        seen = stats["runs"][codes] > 0
+        gap = np.where(seen, (finished - stats["last_finished"][codes]) / 1e9, np.nan)
+        # A run committed out of order says nothing about the gap.
+        values["gap"] = np.where(gap > 0, gap, np.nan)
+
+        flags = stats["flags"][codes]
+        for metric in METRICS:
+            x = values[metric]
+            n = stats[f"{metric}_n"][codes]
+            mean = stats[f"{metric}_mean"][codes]
+            var = stats[f"{metric}_var"][codes]
+            valid = ~np.isnan(x)
+            if metric in ANOMALY_METRICS:
+                # Judged against the baseline before this run is folded in;
+                # the flag stays until a normal run of the same metric.
+                bit = np.uint8(1 << ANOMALY_METRICS.index(metric))
+                sigma = np.maximum(np.sqrt(var), np.maximum(MIN_SIGMA[metric], MIN_SIGMA_RATIO * np.abs(mean)))
+                anomalous = valid & (n >= self.min_runs) & (x - mean > self.anomaly_z * sigma)
+                flags = np.where(valid, np.where(anomalous, flags | bit, flags & ~bit), flags)
+            diff = np.where(valid, x - mean, 0.0)
+            increment = alpha * diff
+            first = valid & (n == 0)
+            stats[f"{metric}_mean"][codes] = np.where(first, x, mean + increment)
+            stats[f"{metric}_var"][codes] = np.where(
+                first, 0.0, np.where(valid, (1 - alpha) * (var + diff * increment), var)
+            )
+            stats[f"{metric}_n"][codes] = n + valid
+
+        stats["flags"][codes] = flags
+        stats["runs"][codes] += 1
+        stats["last_finished"][codes] = np.maximum(stats["last_finished"][codes], finished)
+        stats["last_event"][codes] = np.maximum(stats["last_event"][codes], last_event)
+
+    # -- checks ----------------------------------------------------------------
+
+    def stale_after(self) -> np.ndarray:
+        """Seconds without an event after which each tenant is stale; NaN until it has a baseline."""
+        stats = self._stats
+        expected = stats["event_lag_mean"] + stats["gap_mean"]
+        spread = np.sqrt(stats["event_lag_var"] + stats["gap_var"])
+        threshold = np.maximum(self.stale_min_seconds, expected + self.anomaly_z * spread)
+        judged = (stats["gap_n"] >= self.min_runs) & (stats["last_event"] != _NO_EVENT)
+        return np.where(judged, threshold, np.nan)
+
+    def check(self, now: float = None) -> np.ndarray:
+        """Set the stale flag of every tenant as of ``now`` (epoch seconds); returns all flags."""
+        now = time.time() if now is None else now
+        stats = self._stats
+        silent = now - stats["last_event"] / 1e3
+        with np.errstate(invalid="ignore"):
+            stale = silent > self.stale_after()
+        bit = np.uint8(1 << STALE_FLAG)
+        stats["flags"] = np.where(stale, stats["flags"] | bit, stats["flags"] & ~bit).astype(np.uint8)
+        return stats["flags"]
+
+    def report(self, now: float = None) -> pd.DataFrame:
+        """Every tenant's baselines, flags and time since its last event, as a frame."""
+        now = time.time() if now is None else now
+        stats = self._stats
+        last_event = stats["last_event"]
+        df = pd.DataFrame({
+            "tenant_id": self._tenants,
+            "runs": stats["runs"],
+            "error_rate": stats["error_rate_mean"].round(2),
+            "duration": stats["duration_mean"].round(1),
+            "db_persist_duration": stats["db_persist_duration_mean"].round(1),
+            "gap": stats["gap_mean"].round(1),
+            "silent_for": np.where(last_event != _NO_EVENT, now - last_event / 1e3, np.nan).round(0),
+            "stale_after": self.stale_after().round(0),
+            "flags": [_flag_names(flags) for flags in stats["flags"]],
+        })
+        return df
+
+    def pending_alerts(self, ignore=()) -> tuple:
+        """
+        Tenants whose flags changed since the last alert, as ``(raised, cleared)``.
+
+        Each is a list of ``(tenant_id, [flag names])``. Tenants in ``ignore``
+        are left out of both, and forgotten for alerting.
+        """
+        stats = self._stats
+        ignore = {str(tenant_id) for tenant_id in ignore}
+        raised, cleared = [], []
+        for code in np.flatnonzero(stats["flags"] != stats["alerted"]):
+            tenant_id = self._tenants[code]
+            if tenant_id in ignore:
+                continue
+            flags, alerted = int(stats["flags"][code]), int(stats["alerted"][code])
+            if flags & ~alerted:
+                raised.append((tenant_id, _flag_names(flags & ~alerted)))
+            if alerted & ~flags:
+                cleared.append((tenant_id, _flag_names(alerted & ~flags)))
+        return raised, cleared
+
+    def mark_alerted(self, ignore=()) -> None:
+        """Record the current flags as sent, for every tenant not in ``ignore``."""
+        stats = self._stats
+        ignore = {str(tenant_id) for tenant_id in ignore}
+        ignored = np.array([tenant_id in ignore for tenant_id in self._tenants], dtype=bool)
+        stats["alerted"] = np.where(ignored, 0, stats["flags"]).astype(np.uint8)
+
+
+def _flag_names(flags: int) -> list:
+    return [name for bit, name in enumerate(FLAG_NAMES) if flags & (1 << bit)]
+
+
+def _describe(tenant_id: str, names: list, report: pd.DataFrame) -> str:
+    directory = get_tenant_directory()
+    tenant = directory.get(tenant_id) if directory.loaded else None
+    label = f"{tenant['tenant_name']} ({tenant_id})" if tenant and tenant["tenant_name"] else tenant_id
+    row = report.loc[report["tenant_id"] == tenant_id].iloc[0]
+    details = []
+    for name in names:
+        if name == "stale":
+            details.append(f"no events for {row['silent_for']:.0f}s (stale after {row['stale_after']:.0f}s)")
+        else:
+            details.append(f"{name} above its baseline of {row[name]}")
+    return f"- {label}: {'; '.join(details)}"
+
+
+def send_alert(raised: list, cleared: list, health: TenantHealth) -> None:
+    """Mail the raised and cleared flags to ``HEALTH_ALERT_RECIPIENTS``."""
+    recipients = [address.strip() for address in settings.HEALTH_ALERT_RECIPIENTS.split(",") if address.strip()]
+    if not recipients:
+        logger.warning("Tenant health flags for %d tenants not mailed: no HEALTH_ALERT_RECIPIENTS", len(raised))
+        return
+    report = health.report()
+    lines = []
+    if raised:
+        lines += ["Raised:"] + [_describe(tenant_id, names, report) for tenant_id, names in raised] + [""]
+    if cleared:
+        lines += ["Cleared:"] + [f"- {tenant_id}: {', '.join(names)}" for tenant_id, names in cleared]
+
+    message = EmailMessage()
+    message["Subject"] = f"{settings.SMTP_DEFAULT_SUBJECT}: tenant health, {len(raised)} raised, {len(cleared)} cleared"
+    message["From"] = formataddr((settings.SENDERNAME, settings.SMTP_DEFAULT_FROM_ADDRESS))
+    if settings.SENDER and settings.SENDER != settings.SMTP_DEFAULT_FROM_ADDRESS:
+        message["Sender"] = settings.SENDER
+    message["To"] = ", ".join(recipients)
+    message.set_content("\n".join(lines))
+
+    smtp_class = smtplib.SMTP_SSL if settings.SMTP_PORT == 465 else smtplib.SMTP
+    with smtp_class(settings.SMTP_HOST, settings.SMTP_PORT, timeout=30) as smtp:
+        if smtp_class is smtplib.SMTP:
+            smtp.ehlo()
+            if smtp.has_extn("starttls"):
+                smtp.starttls()
+                smtp.ehlo()
+        if settings.SMTP_USER:
+            smtp.login(settings.SMTP_USER, settings.SMTP_PASSWORD)
+        smtp.send_message(message)
+
+
+def _deleted_tenants() -> list:
+    directory = get_tenant_directory()
+    try:
+        directory.refresh()
+    except Exception as e:
+        logger.warning("Tenant directory refresh failed: %s", e)
+    return directory.deleted_ids() if directory.loaded else []
+
+
+def run_check(health: TenantHealth) -> dict:
+    """One pass of the job: catch up, check, alert and save."""
+    added = health.refresh(settings.HEALTH_WARMUP_DAYS)
+    health.check()
+    deleted = _deleted_tenants()
+    raised, cleared = health.pending_alerts(ignore=deleted)
+    if raised or cleared:
+        try:
+            send_alert(raised, cleared, health)
+        except Exception as e:
+            # Left pending, so the next pass tries again.
+            logger.warning("Sending the tenant health alert failed: %s", e)
+        else:
+            health.mark_alerted(ignore=deleted)
+    health.save(settings.HEALTH_STATE_PATH)
+    return {"runs": added, "raised": len(raised), "cleared": len(cleared)}
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--once", action="store_true", help="Check once and exit.")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    path = settings.HEALTH_STATE_PATH
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(f"{path}.lock", "w") as lock:
+        # One job at a time, or every tenant would be mailed about twice.
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        health = TenantHealth(
+            alpha=settings.HEALTH_EWMA_ALPHA,
+            anomaly_z=settings.HEALTH_ANOMALY_Z,
+            min_runs=settings.HEALTH_MIN_RUNS,
+            stale_min_seconds=settings.HEALTH_STALE_MIN_SECONDS,
+            batch_size=settings.HEALTH_BATCH_SIZE,
+        )
+        if health.load(path):
+            logger.info("Tenant health resumed with %d tenants", len(health))
+        while True:
+            started = time.monotonic()
+            try:
+                result = run_check(health)
+                logger.info(
+                    "Tenant health picked up %d runs; %d flags raised, %d cleared",
+                    result["runs"], result["raised"], result["cleared"],
+                )
+            except Exception as e:
+                if args.once:
+                    raise
+                logger.warning("Tenant health check failed: %s", e)
+            if args.once:
+                return
+            time.sleep(max(0.0, settings.HEALTH_CHECK_INTERVAL - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    main()
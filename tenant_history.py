@@ -0,0 +1,189 @@
+"""
+One tenant's write history, a page at a time, for the drill-down panel.
+
+Pages are cached for the ``TENANT_HISTORY_CACHE_TENANTS`` most recently
+viewed tenants, least recently viewed evicted first, and expire after
+``TENANT_HISTORY_CACHE_TTL`` seconds. Whenever a page is served, the page
+after it is fetched on a background thread, so stepping forward through a
+tenant's history is answered from memory. A request for a page that is
+still being prefetched waits for that query instead of running its own.
+
+The cache lives in the process serving the callbacks; under gunicorn each
+worker keeps its own.
+"""
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from base import settings
+from write_history import PAGE_SIZE, TENANT_DETAIL_COLUMNS, estimate_runs, fetch_runs, last_row_cursor
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_WORKERS = 2
+
+
+def _page_key(cursor, offset: int) -> tuple:
+    return tuple(cursor) if cursor is not None else None, offset
+
+
+class TenantHistoryCache:
+    """
+    LRU of tenants' history pages, keyed by the keyset position of each page.
+
+    Args:
+    - max_tenants (int): Tenants whose pages are kept.
+    - ttl (float): Seconds a page or row estimate stays valid.
+    """
+
+    def __init__(self, max_tenants: int, ttl: float):
+        self.max_tenants = max_tenants
+        self.ttl = ttl
+        self._tenants = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="tenant-history-prefetch")
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+
+    def page(self, tenant_id: str, cursor=None, offset: int = 0):
+        """
+        The page of ``tenant_id``'s runs after ``cursor`` (skipping ``offset`` rows), newest first.
+
+        Returns a copy of the cached DataFrame, so the caller may format it in
+        place; the cached frame keeps its raw timestamps for the cursors.
+        """
+        key = _page_key(cursor, offset)
+        with self._lock:
+            df = self._get(tenant_id, key)
+            future = None if df is not None else self._inflight.get((tenant_id, key))
+            if df is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if future is not None:
+            try:
+                df = future.result()
+            except Exception:
+                # Already logged by the prefetch; try again below.
+                df = None
+        if df is None:
+            df = self._fetch(tenant_id, cursor, offset)
+        self.prefetch_next(tenant_id, df)
+        return df.copy()
+
+    def estimate(self, tenant_id: str) -> int:
+        """Planner estimate of the tenant's run count, cached like the pages."""
+        with self._lock:
+            entry = self._entry(tenant_id)
+            estimate = entry["estimate"]
+            if estimate is not None and time.monotonic() - estimate[1] < self.ttl:
+                return estimate[0]
+        rows = estimate_runs({"tenant_id": tenant_id})
+        with self._lock:
+            self._entry(tenant_id)["estimate"] = (rows, time.monotonic())
+        return rows
+
+    def prefetch_next(self, tenant_id: str, df) -> None:
+        """Fetch the page after ``df`` in the background, unless it is cached, loading, or there is none."""
+        if len(df) < PAGE_SIZE:
+            return
+        cursor = last_row_cursor(df)
+        key = _page_key(cursor, 0)
+        with self._lock:
+            if self._get(tenant_id, key) is not None or (tenant_id, key) in self._inflight:
+                return
+            future = Future()
+            self._inflight[(tenant_id, key)] = future
+            self.prefetches += 1
+        self._executor.submit(self._prefetch, future, tenant_id, cursor)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tenants.clear()
+
+    def wait_for_prefetches(self) -> None:
+        """Block until the prefetches started so far have finished."""
+        with self._lock:
+            futures = list(self._inflight.values())
+        for future in futures:
+            future.exception()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "tenants": len(self._tenants),
+                "pages": sum(len(entry["pages"]) for entry in self._tenants.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "prefetches": self.prefetches,
+            }
+
+    def _prefetch(self, future: Future, tenant_id: str, cursor) -> None:
+        try:
+            future.set_result(self._fetch(tenant_id, cursor, 0))
+        except Exception as e:
+            logger.warning("Prefetching history for tenant %s failed: %s", tenant_id, e)
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._inflight.pop((tenant_id, _page_key(cursor, 0)), None)
+
+    def _fetch(self, tenant_id: str, cursor, offset: int):
+        # The cache is this page's only copy; the shared query cache is skipped.
+        df = fetch_runs(
+            TENANT_DETAIL_COLUMNS, filters={"tenant_id": tenant_id}, after=cursor, offset=offset, use_cache=False
+        )
+        with self._lock:
+            self._entry(tenant_id)["pages"][_page_key(cursor, offset)] = (df, time.monotonic())
+        return df
+
+    def _entry(self, tenant_id: str) -> dict:
+        # Caller holds the lock.
+        entry = self._tenants.get(tenant_id)
+        if entry is None:
+            entry = self._tenants[tenant_id] = {"pages": {}, "estimate": None}
+            while len(self._tenants) > self.max_tenants:
+                self._tenants.popitem(last=False)
+        self._tenants.move_to_end(tenant_id)
+        return entry
+
+    def _get(self, tenant_id: str, key: tuple):
+        # Caller holds the lock.
+        entry = self._tenants.get(tenant_id)
+        if entry is None:
+            return None
+        self._tenants.move_to_end(tenant_id)
+        cached = entry["pages"].get(key)
+        if cached is None:
+            return None
+        if time.monotonic() - cached[1] >= self.ttl:
+            del entry["pages"][key]
+            return None
+        return cached[0]
+
+
+_history = None
+_history_pid = None
+_history_lock = threading.Lock()
+
+
+def get_tenant_history() -> TenantHistoryCache:
+    """Return the process-wide tenant history cache, creating it on first use."""
+    global _history, _history_pid, _history_lock
+    if _history_pid != os.getpid():
+        # The prefetch threads do not survive fork(); each process gets its own.
+        _history_lock = threading.Lock()
+        _history = None
+        _history_pid = os.getpid()
+    if _history is None:
+        with _history_lock:
+            if _history is None:
+                _history = TenantHistoryCache(settings.TENANT_HISTORY_CACHE_TENANTS, settings.TENANT_HISTORY_CACHE_TTL)
+    return _history
@@ -0,0 +1,254 @@
+import threading
+import types
+
+import pytest
+
+import db_pool
+from db_pool import ClickHousePool, PoolTimeout, PostgresPool
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeOperationalError(FakeError):
+    pass
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query):
+        if self.conn.fail_ping and query == "SELECT 1":
+            raise FakeError("server closed the connection")
+        self.conn.executed.append(query)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.fail_ping = False
+        self.executed = []
+        self.commits = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = []
+
+    def connect(**kwargs):
+        opened.append(FakeConnection())
+        return opened[-1]
+
+    monkeypatch.setattr(db_pool, "psycopg2", types.SimpleNamespace(
+        connect=connect,
+        Error=FakeError,
+        OperationalError=FakeOperationalError,
+        InterfaceError=FakeOperationalError,
+    ))
+    monkeypatch.setattr(db_pool, "sql", types.SimpleNamespace(
+        SQL=lambda text: types.SimpleNamespace(format=lambda schema: text.format(schema)),
+        Identifier=lambda name: f'"{name}"',
+    ))
+    return opened
+
+
+def make_pool(**kwargs):
+    options = dict(min_size=0, max_size=2, timeout=0.05, idle_timeout=60, health_check_interval=60)
+    options.update(kwargs)
+    return PostgresPool(**options)
+
+
+def test_postgres_pool_rejects_invalid_sizes():
+    with pytest.raises(ValueError):
+        make_pool(min_size=3, max_size=2)
+    with pytest.raises(ValueError):
+        make_pool(max_size=0)
+
+
+def test_postgres_pool_reuses_connection_and_search_path(connections):
+    pool = make_pool()
+    with pool.connection("tenant_a") as conn:
+        first = conn
+    with pool.connection("tenant_a") as conn:
+        assert conn is first
+    assert len(connections) == 1
+    # The search path is only set when it changes.
+    assert first.executed == ['SET search_path TO "tenant_a", public']
+    with pool.connection("tenant_b"):
+        pass
+    assert first.executed[-1] == 'SET search_path TO "tenant_b", public'
+    stats = pool.stats()
+    assert stats["checkouts"] == 3
+    assert stats["connections_created"] == 1
+    assert stats["idle"] == 1 and stats["in_use"] == 0
+
+
+def test_postgres_pool_rolls_back_and_discards_broken_connections(connections):
+    pool = make_pool()
+    with pytest.raises(KeyError):
+        with pool.connection() as conn:
+            raise KeyError("not a connection problem")
+    assert conn.rollbacks == 1 and not conn.closed
+    assert pool.stats()["idle"] == 1
+
+    with pytest.raises(FakeOperationalError):
+        with pool.connection() as conn:
+            raise FakeOperationalError("connection lost")
+    assert conn.closed
+    stats = pool.stats()
+    assert stats["size"] == 0 and stats["connections_closed"] == 1
+
+
+def test_postgres_pool_times_out_when_exhausted(connections):
+    pool = make_pool(max_size=1)
+    with pool.connection():
+        with pytest.raises(PoolTimeout):
+            with pool.connection():
+                pass
+    assert pool.stats()["timeouts"] == 1
+
+
+def test_postgres_pool_waiter_gets_released_connection(connections):
+    pool = make_pool(max_size=1, timeout=5)
+    checked_out = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with pool.connection():
+            checked_out.set()
+            release.wait()
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    checked_out.wait()
+    threading.Timer(0.05, release.set).start()
+    with pool.connection() as conn:
+        assert conn is connections[0]
+    thread.join()
+    assert pool.stats()["waits"] == 1
+
+
+def test_postgres_pool_replaces_connection_failing_health_check(connections):
+    pool = make_pool(health_check_interval=0)
+    with pool.connection() as conn:
+        first = conn
+    first.fail_ping = True
+    with pool.connection() as conn:
+        assert conn is not first
+    assert first.closed
+    assert pool.stats()["health_check_failures"] == 1
+
+
+def test_postgres_pool_reaps_idle_connections_above_min_size(connections):
+    pool = make_pool(min_size=1, idle_timeout=0)
+    held = [pool._acquire(), pool._acquire()]
+    for pooled in held:
+        pool._release(pooled)
+    with pool.connection():
+        pass
+    # One idle connection past idle_timeout was closed, min_size kept the other.
+    assert sum(conn.closed for conn in connections) == 1
+    assert pool.stats()["size"] == 1
+
+
+class FakeClient:
+    def __init__(self, database, settings=None, **kwargs):
+        self.database = database
+        self.settings = settings
+        self.disconnected = False
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture
+def clients(monkeypatch):
+    created = []
+
+    def client(**kwargs):
+        created.append(FakeClient(**kwargs))
+        return created[-1]
+
+    monkeypatch.setattr(db_pool, "clickhouse_driver", types.SimpleNamespace(Client=client))
+    monkeypatch.setattr(ClickHousePool, "retryable_errors", staticmethod(lambda: (ConnectionError,)))
+    return created
+
+
+def test_clickhouse_pool_reuses_clients_per_database_and_mode(clients):
+    pool = ClickHousePool(max_idle_per_database=2, max_idle=10, idle_timeout=60)
+    with pool.client("a") as client:
+        first = client
+    with pool.client("a") as client:
+        assert client is first
+    with pool.client("a", use_numpy=True) as client:
+        assert client is not first
+        assert client.settings == {"use_numpy": True}
+    with pool.client("b") as client:
+        assert client.database == "b"
+    stats = pool.stats()
+    assert stats["clients_created"] == 3
+    assert stats["idle"] == 3 and stats["idle_databases"] == 3
+
+
+def test_clickhouse_pool_caps_idle_clients(clients):
+    pool = ClickHousePool(max_idle_per_database=1, max_idle=2, idle_timeout=60)
+    held = [pool._acquire("a", False), pool._acquire("a", False)]
+    for client in held:
+        pool._release(client, "a", False)
+    # Only one idle client per database is kept.
+    assert [client.disconnected for client in held] == [False, True]
+
+    for database in ("b", "c"):
+        with pool.client(database):
+            pass
+    # Over max_idle, the least recently returned client ("a") goes first.
+    assert held[0].disconnected
+    assert pool.stats()["idle"] == 2
+
+
+def test_clickhouse_pool_disconnects_idle_clients_past_timeout(clients):
+    pool = ClickHousePool(max_idle_per_database=2, max_idle=10, idle_timeout=0)
+    with pool.client("a") as client:
+        first = client
+    with pool.client("b"):
+        pass
+    assert first.disconnected
+
+
+def test_clickhouse_pool_run_reconnects_once(clients):
+    pool = ClickHousePool(max_idle_per_database=2, max_idle=10, idle_timeout=60)
+    calls = []
+
+    def query(client):
+        calls.append(client)
+        if len(calls) == 1:
+            raise ConnectionError("connection reset")
+        return "rows"
+
+    assert pool.run("a", query) == "rows"
+    assert calls[0] is not calls[1] and calls[0].disconnected
+    assert pool.stats()["reconnects"] == 1
+
+    with pytest.raises(ConnectionError):
+        pool.run("a", lambda client: (_ for _ in ()).throw(ConnectionError("still down")))
@@ -0,0 +1,118 @@
+import math
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+import pytest
+
+import error_rollup
+from error_rollup import ROLLUP_COLUMNS, ErrorRateRollup
+
+NOW = datetime.now(timezone.utc)
+
+
+def run(id, tenant_id, minutes_ago, records, errors):
+    return {
+        "id": id,
+        "tenant_id": tenant_id,
+        "finished_at": NOW - timedelta(minutes=minutes_ago),
+        "records_count": records,
+        "error_count": errors,
+    }
+
+
+@pytest.fixture
+def history(monkeypatch):
+    """Runs served to the rollup by a fake ``fetch_new_runs``, in id order."""
+    runs = []
+
+    def fetch_new_runs(columns, after_id, limit, filters=None):
+        assert columns == ROLLUP_COLUMNS
+        rows = [row for row in runs if row["id"] > after_id]
+        if filters and "finished_after" in filters:
+            rows = [row for row in rows if row["finished_at"] >= filters["finished_after"]]
+        frame = pd.DataFrame(rows[:limit], columns=ROLLUP_COLUMNS)
+        # Nullable counts, as read from PostgreSQL.
+        return frame.astype({"records_count": "Int64", "error_count": "Int64"})
+
+    monkeypatch.setattr(error_rollup, "fetch_new_runs", fetch_new_runs)
+    return runs
+
+
+def test_rollup_is_not_used_before_it_loads(history):
+    rollup = ErrorRateRollup()
+    assert rollup.runs_above(10) is None
+    assert rollup.tenants_above(10, hours=1) is None
+
+
+def test_runs_above_newest_first_with_keyset_paging(history):
+    history += [
+        run(1, "a", 50, 100, 50),
+        run(2, "b", 40, 100, 5),
+        run(3, "a", 30, 10, 9),
+        run(4, "b", 20, 0, 0),
+        run(5, "a", 10, 100, 10),
+    ]
+    rollup = ErrorRateRollup(batch_size=2)
+    assert rollup.refresh() == 5
+
+    # A run with no records matches every threshold, like the SQL filter.
+    assert rollup.runs_above(10) == ([5, 4, 3, 1], 4)
+    assert rollup.runs_above(10, limit=2) == ([5, 4], 4)
+    assert rollup.runs_above(10, offset=1, limit=2) == ([4, 3], 4)
+    cursor = [history[3]["finished_at"].isoformat(), 4]
+    assert rollup.runs_above(10, after=cursor, limit=2) == ([3, 1], 4)
+
+
+def test_refresh_picks_up_new_runs_out_of_order(history):
+    history += [run(1, "a", 30, 10, 5), run(2, "a", 10, 10, 5)]
+    rollup = ErrorRateRollup()
+    rollup.refresh()
+    # A run with a higher id that finished earlier is merged into place.
+    history.append(run(3, "b", 20, 10, 5))
+    assert rollup.refresh() == 1
+    assert rollup.refresh() == 0
+    assert rollup.runs_above(50)[0] == [2, 3, 1]
+
+
+def test_runs_with_null_counts_match_no_threshold(history):
+    history += [run(1, "a", 20, None, 5), run(2, "a", 10, 100, None), run(3, "a", 5, 0, 0)]
+    rollup = ErrorRateRollup()
+    rollup.refresh()
+    assert rollup.runs_above(0) == ([3], 1)
+
+
+def test_retention_window_defers_to_the_database(history):
+    history += [run(1, "a", 3 * 24 * 60, 10, 10), run(2, "a", 10, 10, 10)]
+    rollup = ErrorRateRollup(retention_days=1)
+    rollup.refresh()
+    assert not rollup.covers_all
+    assert rollup.runs_above(50, limit=1) == ([2], None)
+    # The second page would reach past the retention window.
+    assert rollup.runs_above(50, limit=2) is None
+
+
+def test_tenants_above_aggregates_the_window(history):
+    history += [
+        run(1, "a", 120, 100, 100),
+        run(2, "a", 30, 100, 10),
+        run(3, "a", 20, 100, 30),
+        run(4, "b", 30, 100, 1),
+        run(5, "c", 10, 0, 0),
+        run(6, "d", 10, None, 4),
+        run(7, "d", 5, 10, None),
+    ]
+    rollup = ErrorRateRollup()
+    rollup.refresh()
+    df = rollup.tenants_above(10, hours=1)
+    assert df["tenant_id"].tolist() == ["c", "d", "a"]
+    assert math.isinf(df["error_rate"][0])
+    # NULL counts are left out of the sums, like SQL sum().
+    assert df.iloc[1][["runs", "records_count", "error_count", "error_rate"]].tolist() == [2, 10, 4, 40.0]
+    assert df.iloc[2][["runs", "records_count", "error_count", "error_rate"]].tolist() == [2, 200, 40, 20.0]
+
+
+def test_tenants_above_skips_tenants_with_only_null_counts(history):
+    history += [run(1, "a", 10, None, None), run(2, "b", 10, None, 3)]
+    rollup = ErrorRateRollup()
+    rollup.refresh()
+    assert rollup.tenants_above(0, hours=1).empty
@@ -0,0 +1,157 @@
+import types
+
+import pytest
+
+import query_cache
+from query_cache import QueryCache, SharedQueryCache, make_cache_key
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = types.SimpleNamespace(now=1000.0)
+    clock.monotonic = clock.time = lambda: clock.now
+    monkeypatch.setattr(query_cache, "time", clock)
+    return clock
+
+
+def test_make_cache_key_normalizes_whitespace_and_param_order():
+    assert make_cache_key("SELECT  1\n FROM t", {"b": 2, "a": 1}, "x") == make_cache_key(
+        "SELECT 1 FROM t", {"a": 1, "b": 2}, "x"
+    )
+    assert make_cache_key("SELECT 1", {}, "x") != make_cache_key("SELECT 1", {}, "y")
+
+
+def test_query_cache_hit_and_ttl(clock):
+    cache = QueryCache(max_bytes=10_000, ttl=10)
+    hit, _, generation = cache.get("k")
+    assert not hit
+    cache.set("k", [(1,)], generation)
+    assert cache.get("k")[:2] == (True, [(1,)])
+    clock.now += 11
+    assert not cache.get("k")[0]
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["expirations"]) == (1, 2, 1)
+    assert stats["entries"] == 0 and stats["bytes"] == 0
+
+
+def test_query_cache_evicts_least_recently_used(clock):
+    cache = QueryCache(max_bytes=30, ttl=60)
+    for key in ("a", "b", "c"):
+        cache.set(key, key, 0, size=10)
+    cache.get("a")
+    cache.set("d", "d", 0, size=10)
+    assert [key for key in "abcd" if cache.get(key)[0]] == ["a", "c", "d"]
+    assert cache.stats()["evictions"] == 1
+
+    cache.set("big", "big", 0, size=31)
+    assert not cache.get("big")[0]
+    assert cache.stats()["oversized"] == 1
+
+
+def test_query_cache_drops_results_read_before_invalidation(clock):
+    cache = QueryCache(max_bytes=10_000, ttl=60)
+    _, _, generation = cache.get("k")
+    cache.invalidate()
+    cache.set("k", "stale", generation)
+    assert not cache.get("k")[0]
+    _, _, generation = cache.get("k")
+    cache.set("k", "fresh", generation)
+    assert cache.get("k")[1] == "fresh"
+
+
+def test_query_cache_invalidates_when_watermark_moves(clock):
+    watermark = {"value": 1, "probes": 0}
+
+    def probe():
+        watermark["probes"] += 1
+        return watermark["value"]
+
+    cache = QueryCache(max_bytes=10_000, ttl=60, watermark_fn=probe, watermark_interval=2)
+    _, _, generation = cache.get("k")
+    cache.set("k", "v1", generation)
+    watermark["value"] = 2
+    # Not probed again within the interval.
+    assert cache.get("k")[:2] == (True, "v1")
+    assert watermark["probes"] == 1
+    clock.now += 2
+    assert not cache.get("k")[0]
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_query_cache_keeps_serving_when_probe_fails(clock):
+    def probe():
+        raise RuntimeError("database down")
+
+    cache = QueryCache(max_bytes=10_000, ttl=60, watermark_fn=probe, watermark_interval=0)
+    _, _, generation = cache.get("k")
+    cache.set("k", "v", generation)
+    assert cache.get("k")[:2] == (True, "v")
+
+
+def test_shared_query_cache_is_shared_between_instances(tmp_path):
+    writer = SharedQueryCache(str(tmp_path), max_bytes=10**6, ttl=60)
+    reader = SharedQueryCache(str(tmp_path), max_bytes=10**6, ttl=60)
+    _, _, generation = writer.get(("q", "{}", "t"))
+    writer.set(("q", "{}", "t"), [(1, "a")], generation)
+    assert reader.get(("q", "{}", "t"))[:2] == (True, [(1, "a")])
+
+
+def test_shared_query_cache_keys_results_by_watermark(tmp_path, clock):
+    watermark = {"value": 1}
+    cache = SharedQueryCache(
+        str(tmp_path), max_bytes=10**6, ttl=60, watermark_fn=lambda: watermark["value"], watermark_interval=2
+    )
+    _, _, generation = cache.get("k")
+    cache.set("k", "v1", generation)
+    watermark["value"] = 2
+    assert cache.get("k")[:2] == (True, "v1")
+    clock.now += 2
+    hit, _, generation = cache.get("k")
+    assert not hit
+    cache.set("k", "v2", generation)
+    assert cache.get("k")[1] == "v2"
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_shared_query_cache_invalidate_moves_the_epoch(tmp_path, clock):
+    other = SharedQueryCache(str(tmp_path), max_bytes=10**6, ttl=60, watermark_fn=lambda: 1)
+    cache = SharedQueryCache(str(tmp_path), max_bytes=10**6, ttl=60, watermark_fn=lambda: 1)
+    _, _, generation = cache.get("k")
+    cache.set("k", "v", generation)
+    other.invalidate()
+    hit, _, new_generation = cache.get("k")
+    assert not hit and new_generation != generation
+    # A result read before the invalidation is stored under the old epoch only.
+    cache.set("k", "stale", generation)
+    assert not cache.get("k")[0]
+
+
+def test_shared_query_cache_survives_losing_its_state(tmp_path, clock):
+    # Regression: a lookup right after the watermark was cleared raised a TypeError.
+    cache = SharedQueryCache(str(tmp_path), max_bytes=10**6, ttl=60, watermark_fn=lambda: 1)
+    cache.get("k")
+    cache._state.clear()
+    _, _, generation = cache.get("k")
+    cache.set("k", "v", generation)
+    assert cache.get("k")[:2] == (True, "v")
+
+
+def test_shared_query_cache_does_not_store_without_a_watermark(tmp_path, clock):
+    def probe():
+        raise RuntimeError("database down")
+
+    cache = SharedQueryCache(str(tmp_path), max_bytes=10**6, ttl=60, watermark_fn=probe)
+    hit, _, generation = cache.get("k")
+    assert generation is SharedQueryCache.UNKNOWN
+    cache.set("k", "v", generation)
+    assert not cache.get("k")[0]
+
+
+def test_shared_query_cache_counts_expirations_and_oversized(tmp_path):
+    cache = SharedQueryCache(str(tmp_path), max_bytes=10**6, ttl=-1)
+    _, _, generation = cache.get("k")
+    cache.set("k", "v", generation)
+    assert cache.stats()["expirations"] == 1
+    cache.set("big", "v", generation, size=10**6 + 1)
+    stats = cache.stats()
+    assert stats["oversized"] == 1 and stats["entries"] == 0
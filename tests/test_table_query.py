@@ -0,0 +1,101 @@
+import pytest
+
+from table_query import parse_filter_query
+from write_history import build_select, sort_order, table_filters
+
+
+@pytest.mark.parametrize(
+    "filter_query, expected",
+    [
+        ("", []),
+        ("   ", []),
+        (None, []),
+        ("{error_count} > 10", [["error_count", "gt", "10"]]),
+        ("{error_count} ge 10", [["error_count", "ge", "10"]]),
+        ('{contact_email} contains "acme"', [["contact_email", "contains", "acme"]]),
+        ('{contact_email} icontains "Acme"', [["contact_email", "icontains", "Acme"]]),
+        ("{name} seq 'Acme'", [["name", "eq", "Acme"]]),
+        ("{name} ieq `acme`", [["name", "ieq", "acme"]]),
+        # Case-insensitivity only applies to text operators.
+        ("{id} ilt 5", [["id", "lt", "5"]]),
+        ('{name} = "say \\"hi\\""', [["name", "eq", 'say "hi"']]),
+        ("{odd \\} name} = x", [["odd } name", "eq", "x"]]),
+        ("{finished_at} datestartswith 2024-01", [["finished_at", "datestartswith", "2024-01"]]),
+        ("{contact_email} is blank", [["contact_email", "blank", None]]),
+        ("{contact_email} is not nil", [["contact_email", "notblank", None]]),
+        (
+            '{error_count} >= 10 && {base_domain} != "x.io" and {id} < 3',
+            [["error_count", "ge", "10"], ["base_domain", "ne", "x.io"], ["id", "lt", "3"]],
+        ),
+    ],
+)
+def test_parse_filter_query(filter_query, expected):
+    assert parse_filter_query(filter_query) == expected
+
+
+@pytest.mark.parametrize(
+    "filter_query",
+    [
+        "{id} = 1 || {id} = 2",
+        "{id} = 1 or {id} = 2",
+        "({id} = 1)",
+        "!{id} = 1",
+        "{id} = 1 &&",
+        "{id} like 1",
+        "{id} = 1 2",
+        "{id} =",
+        "{id} is empty",
+        "id = 1",
+        '{name} = "unterminated',
+    ],
+)
+def test_parse_filter_query_rejects_what_the_filter_row_cannot_produce(filter_query):
+    with pytest.raises(ValueError):
+        parse_filter_query(filter_query)
+
+
+def test_table_filters_checks_columns():
+    filters = table_filters({"tenant_id": "t1"}, "{error_count} > 1")
+    assert filters == {"tenant_id": "t1", "table_filter": [["error_count", "gt", "1"]]}
+    assert table_filters({"tenant_id": "t1"}, "") == {"tenant_id": "t1"}
+    with pytest.raises(ValueError):
+        table_filters({}, "{password} = x")
+
+
+def test_table_filter_clauses_are_parameterized():
+    filters = table_filters(
+        {}, '{contact_email} icontains "50%_off" && {error_count} >= 7 && {base_domain} is blank'
+    )
+    query, params = build_select(["id"], filters=filters)
+    assert "tenant.contact_email::text ILIKE %(table_filter_0)s" in query
+    assert "cwh.errors_count >= %(table_filter_1)s" in query
+    assert "(tenant.base_domain IS NULL OR tenant.base_domain = '')" in query
+    assert params["table_filter_0"] == "%50\\%\\_off%"
+    assert params["table_filter_1"] == 7.0
+    with pytest.raises(ValueError):
+        build_select(["id"], filters=table_filters({}, "{error_count} > many"))
+
+
+def test_table_filter_on_time_is_a_range_of_what_is_shown():
+    query, params = build_select(["id"], filters=table_filters({}, "{finished_at} = 2024-01-02"))
+    assert "(cwh.finished_at >= %(table_filter_0)s AND cwh.finished_at < %(table_filter_0_end)s)" in query
+    # The table shows IST (UTC+5:30).
+    assert params["table_filter_0"].isoformat() == "2024-01-01T18:30:00+00:00"
+    assert params["table_filter_0_end"].isoformat() == "2024-01-02T18:30:00+00:00"
+
+
+def test_sort_order():
+    assert sort_order(None) == (
+        "cwh.finished_at DESC, cwh.id DESC",
+        ("finished_at", "(cwh.finished_at, cwh.id) < (%(after_finished_at)s, %(after_id)s)"),
+    )
+    assert sort_order([{"column_id": "id", "direction": "asc"}]) == ("cwh.id ASC", ("id", "cwh.id > %(after_id)s"))
+    order_by, seek = sort_order([{"column_id": "error_count", "direction": "desc"}])
+    assert (order_by, seek) == ("cwh.errors_count DESC NULLS LAST, cwh.id DESC", None)
+    with pytest.raises(ValueError):
+        sort_order([{"column_id": "password", "direction": "asc"}])
+
+
+def test_build_select_cannot_seek_a_nullable_sort():
+    with pytest.raises(ValueError):
+        build_select(["id"], after=[3, 1], sort_by=[{"column_id": "duration", "direction": "asc"}])
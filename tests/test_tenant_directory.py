@@ -0,0 +1,114 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import tenant_directory
+from tenant_directory import TenantDirectory
+from write_history import IdArray
+
+COLUMNS = ["tenant_id", "tenant_name", "base_domain", "contact_email", "deleted_date", "changed_at"]
+T0 = datetime(2024, 1, 1)
+
+
+def tenant(tenant_id, name, domain, email, deleted=False, changed=0):
+    changed_at = T0 + timedelta(minutes=changed)
+    return (tenant_id, name, domain, email, changed_at if deleted else None, changed_at)
+
+
+@pytest.fixture
+def table(monkeypatch):
+    """The tenant table, served to ``refresh`` by a fake ``execute_postgres_query``."""
+    rows = []
+
+    def execute_postgres_query(query, params, tenant_id, include_columns):
+        since = params.get("since")
+        return COLUMNS, [row for row in rows if since is None or row[-1] >= since]
+
+    monkeypatch.setattr(tenant_directory, "reads_snapshot", lambda: False)
+    monkeypatch.setattr(tenant_directory, "execute_postgres_query", execute_postgres_query)
+    return rows
+
+
+@pytest.fixture
+def directory(table):
+    table += [
+        tenant("acme-1", "Acme Corp", "acme.example.com", "ops@acme.example.com", changed=-4),
+        tenant("globex", "Globex", "globex.io", "it@globex.io", changed=-3),
+        tenant("initech", "Initech", "initech.com", None, deleted=True, changed=-2),
+        tenant("acme-2", "Acme Labs", "labs.acme.dev", "labs@acme.dev", changed=-1),
+    ]
+    directory = TenantDirectory()
+    directory.refresh()
+    return directory
+
+
+def ids(tenants):
+    return [tenant["tenant_id"] for tenant in tenants]
+
+
+def test_search_ranks_exact_id_then_prefix_then_substring(directory):
+    assert ids(directory.search("globex")) == ["globex"]
+    assert ids(directory.search("ACME")) == ["acme-1", "acme-2"]
+    assert ids(directory.search("acme labs")) == ["acme-2"]
+    assert ids(directory.search("acme-2")) == ["acme-2"]
+    assert ids(directory.search("example")) == ["acme-1"]
+
+
+def test_search_limit_and_empty_text(directory):
+    assert ids(directory.search("acme", limit=1)) == ["acme-1"]
+    assert directory.search("  ") == []
+    assert directory.search(None) == []
+    assert directory.search("zz") == []
+
+
+def test_search_short_text_scans_everything(directory):
+    # Under three characters there are no trigrams to narrow by.
+    assert ids(directory.search("ex")) == ["acme-1", "globex"]
+
+
+def test_refresh_applies_updates_and_deletions(table, directory):
+    table[1] = tenant("globex", "Globex Intl", "globex.net", "it@globex.net", changed=5)
+    table[0] = tenant("acme-1", "Acme Corp", "acme.example.com", None, deleted=True, changed=6)
+    # Tenants changed at the watermark itself are read again.
+    assert directory.refresh() == 3
+    assert directory.refresh() == 1
+    assert directory.get("globex")["base_domain"] == "globex.net"
+    # Stale index entries of the old values are not returned.
+    assert directory.search("globex.io") == []
+    assert ids(directory.search("globex.n")) == ["globex"]
+    assert directory.get("acme-1")["deleted"]
+    assert sorted(directory.deleted_ids()) == ["acme-1", "initech"]
+    assert sorted(directory.active_ids()) == ["acme-2", "globex"]
+
+
+def test_refresh_rebuilds_indexes_once_stale(table, directory, monkeypatch):
+    monkeypatch.setattr(tenant_directory, "STALE_REBUILD_RATIO", 0)
+    table[0] = tenant("acme-1", "Acme Holdings", "acme.example.com", "ops@acme.example.com", changed=5)
+    directory.refresh()
+    table.append(tenant("umbrella", "Umbrella", "umbrella.co", None, changed=6))
+    directory.refresh()
+    assert directory._stale == 0
+    assert ids(directory.search("acme h")) == ["acme-1"]
+    assert ids(directory.search("umbrella")) == ["umbrella"]
+
+
+def test_matching_ids_follows_sql_null_semantics(directory):
+    assert directory.matching_ids([("tenant_name", "icontains", "acme")]) == ["acme-1", "acme-2"]
+    assert directory.matching_ids([("contact_email", "blank", None)]) == ["initech"]
+    assert directory.matching_ids([("contact_email", "ne", "it@globex.io")]) == ["acme-1", "acme-2"]
+    assert directory.matching_ids(
+        [("base_domain", "contains", "acme"), ("tenant_name", "ieq", "ACME LABS")]
+    ) == ["acme-2"]
+
+
+def test_enrich_aligns_with_ids(directory):
+    result = directory.enrich(["acme-2", "unknown", "globex"], ["tenant_name"])
+    assert result["tenant_name"].tolist() == ["Acme Labs", None, "Globex"]
+
+
+def test_id_array_quotes_an_untyped_array_literal():
+    assert IdArray(["a", "b"]).getquoted() == b"""'{"a","b"}'"""
+    assert IdArray(['it\'s', 'say "hi"', "back\\slash"]).getquoted() == (
+        b"""'{"it''s","say \\"hi\\"","back\\\\slash"}'"""
+    )
+    assert IdArray([]).getquoted() == b"'{}'"
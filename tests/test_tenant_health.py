@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tenant_health import HEALTH_COLUMNS, TenantHealth
+
+T0 = 1_700_000_000  # epoch seconds
+GAP = 600
+
+
+def runs(*rows):
+    """Runs from ``(id, tenant_id, minutes, records, errors, duration)``, events 60s before finishing."""
+    return pd.DataFrame(
+        [
+            {
+                "id": id,
+                "tenant_id": tenant_id,
+                "finished_at": pd.Timestamp((T0 + minutes * 60) * 10**9, tz="UTC"),
+                "records_count": records,
+                "error_count": errors,
+                "duration": duration,
+                "db_persist_duration": 1.0,
+                "last_event_timestamp": (T0 + minutes * 60 - 60) * 1000,
+            }
+            for id, tenant_id, minutes, records, errors, duration in rows
+        ],
+        columns=HEALTH_COLUMNS,
+    ).astype({"records_count": "Int64", "error_count": "Int64"})
+
+
+def steady(tenant_id, count, first_id=1, start=0):
+    return runs(*[
+        (first_id + i, tenant_id, start + i * GAP // 60, 100, 1, 10.0 + i % 2) for i in range(count)
+    ])
+
+
+def make_health(**kwargs):
+    options = dict(alpha=0.2, anomaly_z=3.0, min_runs=5, stale_min_seconds=300, batch_size=1000)
+    options.update(kwargs)
+    return TenantHealth(**options)
+
+
+def flags(health, tenant_id):
+    return health.report(now=T0)["flags"][health._tenant_codes[tenant_id]]
+
+
+def test_update_flags_anomalies_and_clears_them():
+    health = make_health()
+    health.update(steady("a", 10))
+    assert flags(health, "a") == []
+    health.update(runs((11, "a", 100, 100, 50, 60.0)))
+    assert flags(health, "a") == ["error_rate", "duration"]
+    # A normal run clears the flags of the metrics it has.
+    health.update(runs((12, "a", 110, 100, 1, 10.0)))
+    assert flags(health, "a") == []
+
+
+def test_update_does_not_judge_new_tenants():
+    health = make_health()
+    health.update(steady("a", 4))
+    health.update(runs((5, "a", 40, 100, 90, 500.0)))
+    assert flags(health, "a") == []
+
+
+def test_runs_without_records_have_no_error_rate():
+    health = make_health()
+    health.update(steady("a", 10))
+    health.update(runs((11, "a", 100, 0, 0, 10.0), (12, "a", 110, None, 5, 10.0)))
+    report = health.report(now=T0)
+    assert report["runs"][0] == 12
+    assert health._stats["error_rate_n"][0] == 10
+
+
+def test_update_matches_run_by_run_regardless_of_batching_and_order():
+    batch = pd.concat([steady("a", 8), steady("b", 6, first_id=100, start=3)], ignore_index=True)
+    batched = make_health()
+    batched.update(batch.sample(frac=1, random_state=1))
+    one_by_one = make_health()
+    for i in batch.sort_values(["finished_at", "id"]).index:
+        one_by_one.update(batch.loc[[i]])
+    for name, column in batched._stats.items():
+        order = [batched._tenant_codes[tenant_id] for tenant_id in one_by_one._tenants]
+        np.testing.assert_allclose(column[order], one_by_one._stats[name], err_msg=name)
+
+
+def test_check_flags_stale_tenants():
+    health = make_health()
+    health.update(steady("a", 10))
+    last_event = T0 + 9 * GAP - 60
+    threshold = health.stale_after()[0]
+    # Steady 600s gaps and 60s lags: the threshold is about their sum.
+    assert threshold == pytest.approx(GAP + 60)
+    assert health.check(now=last_event + threshold - 1)[0] == 0
+    assert flags(health, "a") == []
+    health.check(now=last_event + threshold + 1)
+    assert flags(health, "a") == ["stale"]
+    health.check(now=last_event + 1)
+    assert flags(health, "a") == []
+
+
+def test_check_uses_the_minimum_stale_threshold():
+    health = make_health(stale_min_seconds=3600)
+    health.update(steady("a", 10))
+    assert health.stale_after()[0] == 3600
+
+
+def test_check_skips_tenants_without_a_baseline():
+    health = make_health()
+    health.update(steady("a", 3))
+    assert np.isnan(health.stale_after()[0])
+    assert health.check(now=T0 + 10**6)[0] == 0
+
+
+def test_pending_alerts_until_marked():
+    health = make_health()
+    health.update(pd.concat([steady("a", 10), steady("b", 10, first_id=100)], ignore_index=True))
+    health.update(runs((11, "a", 100, 100, 50, 10.0), (111, "b", 100, 100, 50, 10.0)))
+    assert health.pending_alerts() == ([("a", ["error_rate"]), ("b", ["error_rate"])], [])
+    assert health.pending_alerts(ignore=["b"]) == ([("a", ["error_rate"])], [])
+    health.mark_alerted()
+    assert health.pending_alerts() == ([], [])
+    health.update(runs((12, "a", 110, 100, 1, 10.0)))
+    assert health.pending_alerts() == ([], [("a", ["error_rate"])])
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = str(tmp_path / "state" / "health.npz")
+    health = make_health()
+    assert not health.load(path)
+    health.update(steady("a", 10))
+    health._last_id = 10
+    health.save(path)
+    restored = make_health()
+    assert restored.load(path)
+    assert restored._tenants == ["a"] and restored._last_id == 10
+    for name, column in health._stats.items():
+        np.testing.assert_array_equal(restored._stats[name], column, err_msg=name)
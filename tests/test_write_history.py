@@ -0,0 +1,75 @@
+from datetime import datetime
+
+import pytest
+
+from write_history import PAGE_SIZE, build_estimate, build_select, seek_position
+
+
+def test_build_select_projects_only_requested_columns():
+    query, params = build_select(["id", "error_count"])
+    assert query == (
+        "SELECT cwh.id AS id, cwh.errors_count AS error_count\n"
+        "FROM core_master.clickhouse_write_history cwh\n"
+        "ORDER BY cwh.finished_at DESC, cwh.id DESC\n"
+        "LIMIT %(limit)s OFFSET %(offset)s"
+    )
+    assert params == {"limit": PAGE_SIZE, "offset": 0}
+
+
+def test_build_select_joins_tenant_only_when_used():
+    query, _ = build_select(["id", "base_domain"])
+    assert "LEFT JOIN core_master.tenant tenant ON cwh.tenant_id = tenant.id" in query
+    query, _ = build_select(["id"], filters={"active_tenants": True})
+    assert "LEFT JOIN core_master.tenant" in query
+    assert "WHERE tenant.deleted_date IS NULL" in query
+    query, _ = build_select(["id"], filters={"active_tenants": False})
+    assert "tenant" not in query.replace("tenant_id", "")
+
+
+def test_build_select_binds_filters_and_skips_unset_ones():
+    query, params = build_select(
+        ["id"], filters={"tenant_id": "t1", "error_threshold": 5, "ids": None}, limit=None
+    )
+    assert "WHERE cwh.tenant_id = %(tenant_id)s\nAND cwh.errors_count >=" in query
+    assert "ANY(%(ids)s)" not in query
+    assert "LIMIT" not in query
+    assert params == {"tenant_id": "t1", "error_threshold": 5}
+
+
+def test_build_select_seeks_past_cursor():
+    query, params = build_select(["id"], after=["2024-01-02T03:04:05+00:00", 42], offset=20)
+    assert "WHERE (cwh.finished_at, cwh.id) < (%(after_finished_at)s, %(after_id)s)" in query
+    assert params["after_id"] == 42
+    # Cursors hold ISO strings; they are bound as timestamps.
+    assert isinstance(params["after_finished_at"], datetime)
+    assert params["offset"] == 20
+
+
+def test_build_select_rejects_unknown_columns_and_filters():
+    with pytest.raises(ValueError):
+        build_select(["id", "password"])
+    with pytest.raises(ValueError):
+        build_select(["id"], filters={"tenant": "t1"})
+
+
+def test_build_estimate_uses_the_same_filters():
+    query, params = build_estimate({"tenant_id": "t1"})
+    assert query == (
+        "SELECT 1\nFROM core_master.clickhouse_write_history cwh\nWHERE cwh.tenant_id = %(tenant_id)s"
+    )
+    assert params == {"tenant_id": "t1"}
+
+
+@pytest.mark.parametrize(
+    "page, cursors, expected",
+    [
+        (0, {"0": ["t0", 1]}, (None, 0)),
+        (1, {}, (None, PAGE_SIZE)),
+        (1, {"0": ["t0", 1]}, (["t0", 1], 0)),
+        (3, {"0": ["t0", 1], "1": ["t1", 2]}, (["t1", 2], PAGE_SIZE)),
+        # Cursors of later pages are no use for an earlier one.
+        (2, {"0": ["t0", 1], "5": ["t5", 6]}, (["t0", 1], PAGE_SIZE)),
+    ],
+)
+def test_seek_position(page, cursors, expected):
+    assert seek_position(page, cursors) == expected
@@ -0,0 +1,571 @@
+"""
+Queries over ``core_master.clickhouse_write_history`` for the dashboard pages.
+
+Every view declares the columns it displays and the filters it applies; the
+SQL is built from the declarations below so each view fetches only its own
+columns and the tenant JOIN is added only when a tenant column is used.
+Results are mapped to columns by ``cursor.description``, never by position.
+
+Once the tenant directory is loaded, ``fetch_runs`` leaves the tenant
+columns out of the SQL altogether and fills them in from memory.
+
+With ``ANALYTICS_SOURCE=snapshot`` the same SQL runs over the local Parquet
+snapshot instead; see ``snapshot``.
+
+Tables sorted and filtered server-side pass their DataTable ``sort_by`` and
+``filter_query`` through. Both are checked against ``COLUMNS`` and turned
+into ORDER BY and parameterized WHERE clauses, so the database sorts and
+filters every run and only one page is fetched.
+"""
+from __future__ import annotations
+
+from exec import estimate_postgres_row_count, execute_postgres_frame, execute_postgres_query
+from lazy_imports import lazy_import
+from results import IST, format_datetime_columns
+from snapshot import count_snapshot_rows, execute_snapshot_frame, execute_snapshot_query, reads_snapshot
+from table_query import parse_filter_query
+from tenant_directory import get_tenant_directory
+
+pd = lazy_import("pandas")
+
+PAGE_SIZE = 20
+
+# Output column -> SQL expression. Output names are the DataTable column ids.
+COLUMNS = {
+    "id": "cwh.id",
+    "tenant_id": "cwh.tenant_id",
+    "run_id": "cwh.run_id",
+    "finished_at": "cwh.finished_at",
+    "records_count": "cwh.records_count",
+    "error_count": "cwh.errors_count",
+    "duration": "cwh.duration",
+    "db_persist_duration": "cwh.db_persist_duration",
+    "last_event_timestamp": "cwh.last_event_received_at",
+    "first_event_timestamp": "cwh.first_event_received_at",
+    "base_domain": "tenant.base_domain",
+    "name": "tenant.name",
+    "tenant_name": "tenant.name",
+    "contact_email": "tenant.contact_email",
+}
+
+# Tenant columns the tenant directory can fill in, and the field each maps to.
+TENANT_COLUMNS = {
+    "base_domain": "base_domain",
+    "name": "tenant_name",
+    "tenant_name": "tenant_name",
+    "contact_email": "contact_email",
+}
+
+TIMESTAMP_COLUMNS = ("finished_at",)
+EPOCH_MS_COLUMNS = ("last_event_timestamp", "first_event_timestamp")
+NUMERIC_COLUMNS = ("id", "records_count", "error_count", "duration", "db_persist_duration")
+# Never NULL, so pages sorted on them can seek past the previous page's last
+# row; other sorts page with OFFSET.
+KEYSET_COLUMNS = ("finished_at", "id")
+
+# Filter name -> WHERE fragment. A filter is applied unless its value is None
+# or False; the value is bound to the parameter of the same name, if any.
+FILTERS = {
+    "tenant_id": "cwh.tenant_id = %(tenant_id)s",
+    "error_threshold": "cwh.errors_count >= (cwh.records_count * %(error_threshold)s / 100.0)",
+    "active_tenants": "tenant.deleted_date IS NULL",
+    "exclude_tenants": "cwh.tenant_id <> ALL(%(exclude_tenants)s)",
+    "ids": "cwh.id = ANY(%(ids)s)",
+    "after_id": "cwh.id > %(after_id)s",
+    "finished_after": "cwh.finished_at >= %(finished_after)s",
+    "newer_than": "(cwh.finished_at, cwh.id) > %(newer_than)s",
+    "tenant_ids": "cwh.tenant_id = ANY(%(tenant_ids)s)",
+}
+# Filters holding tenant ids, bound as ``IdArray`` so the bare column is compared.
+TENANT_ID_FILTERS = ("exclude_tenants", "tenant_ids")
+# Filter holding a table's ``[column, operator, value]`` conditions; see
+# ``table_filters``. Its clauses are built from the conditions.
+TABLE_FILTER = "table_filter"
+
+ORDER_BY = "cwh.finished_at DESC, cwh.id DESC"
+SEEK_CLAUSE = "(cwh.finished_at, cwh.id) < (%(after_finished_at)s, %(after_id)s)"
+OLDEST_FIRST = "cwh.finished_at, cwh.id"
+
+# Aggregates per time bucket for the trend charts. Durations keep their
+# minimum and maximum as well as the mean, so downsampling does not hide spikes.
+BUCKET_AGGREGATES = {
+    "runs": "count(*)",
+    "records_count": "sum(cwh.records_count)",
+    "error_count": "sum(cwh.errors_count)",
+    "duration_min": "min(cwh.duration)",
+    "duration_avg": "avg(cwh.duration)",
+    "duration_max": "max(cwh.duration)",
+    "db_persist_duration_min": "min(cwh.db_persist_duration)",
+    "db_persist_duration_avg": "avg(cwh.db_persist_duration)",
+    "db_persist_duration_max": "max(cwh.db_persist_duration)",
+}
+# Bucket widths in seconds the charts choose from: the narrowest that keeps a
+# time range within its point budget.
+BUCKET_WIDTHS = (60, 300, 900, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400, 7 * 86400)
+
+# Projections used by the dashboard views.
+ACTIVITY_COLUMNS = [
+    "id", "tenant_id", "base_domain", "name", "contact_email", "finished_at", "last_event_timestamp", "duration",
+    "error_count",
+]
+HIGH_ERROR_COLUMNS = [
+    "id", "finished_at", "tenant_id", "tenant_name", "base_domain", "contact_email", "error_count", "records_count",
+]
+EXPORT_COLUMNS = [
+    "id", "run_id", "tenant_id", "tenant_name", "base_domain", "contact_email", "finished_at", "records_count",
+    "error_count", "duration", "db_persist_duration", "last_event_timestamp", "first_event_timestamp",
+]
+TENANT_DETAIL_COLUMNS = [
+    "id", "run_id", "finished_at", "records_count", "error_count", "duration", "db_persist_duration",
+    "last_event_timestamp", "first_event_timestamp", "base_domain", "tenant_name",
+]
+
+
+class IdArray(list):
+    """
+    Ids bound as an untyped PostgreSQL array literal (``'{...}'``) instead of ``ARRAY[...]``.
+
+    psycopg2 sends a list of strings as ``ARRAY['a', 'b']``, a ``text[]``,
+    which only compares with the column after casting the column, and then
+    its index is not used. An untyped literal takes the type of the column
+    it is compared with, whatever that is. Other drivers (DuckDB, for the
+    snapshot) see a plain list.
+    """
+
+    def __conform__(self, protocol):
+        return self
+
+    def getquoted(self) -> bytes:
+        items = ",".join('"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for value in self)
+        return ("'{" + items.replace("'", "''") + "}'").encode()
+
+
+def _condition_clause(condition, name: str):
+    column, operator, value = condition
+    expression = COLUMNS[column]
+    text = column not in NUMERIC_COLUMNS + TIMESTAMP_COLUMNS + EPOCH_MS_COLUMNS
+    if operator == "blank":
+        return f"({expression} IS NULL OR {expression} = '')" if text else f"{expression} IS NULL", {}
+    if operator == "notblank":
+        return f"{expression} <> ''" if text else f"{expression} IS NOT NULL", {}
+
+    if column in TIMESTAMP_COLUMNS + EPOCH_MS_COLUMNS and operator not in ("ieq", "ine"):
+        # A time as shown in the table (IST) stands for the whole second,
+        # minute, day... it names, so every comparison becomes a range check.
+        start, end = _time_range(value, epoch_ms=column in EPOCH_MS_COLUMNS)
+        in_range = f"{expression} >= %({name})s AND {expression} < %({name}_end)s"
+        clauses = {
+            "lt": f"{expression} < %({name})s",
+            "le": f"{expression} < %({name}_end)s",
+            "gt": f"{expression} >= %({name}_end)s",
+            "ge": f"{expression} >= %({name})s",
+            "ne": f"NOT ({in_range})",
+        }
+        clause = clauses.get(operator, in_range)
+        params = {key: bound for key, bound in ((name, start), (f"{name}_end", end)) if f"%({key})s" in clause}
+        return f"({clause})", params
+
+    if operator in ("contains", "icontains"):
+        like = "ILIKE" if operator == "icontains" else "LIKE"
+        return f"{expression}::text {like} %({name})s", {name: f"%{_like_escape(value)}%"}
+    if operator == "datestartswith":
+        return f"{expression}::text LIKE %({name})s", {name: f"{_like_escape(value)}%"}
+    if operator in ("ieq", "ine"):
+        comparison = "=" if operator == "ieq" else "<>"
+        return f"lower({expression}::text) {comparison} lower(%({name})s)", {name: value}
+
+    if column in NUMERIC_COLUMNS:
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError(f"The {column} filter needs a number, not {value!r}") from None
+    comparison = {"eq": "=", "ne": "<>", "lt": "<", "le": "<=", "gt": ">", "ge": ">="}[operator]
+    return f"{expression} {comparison} %({name})s", {name: value}
+
+
+def _like_escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _time_range(value: str, epoch_ms: bool = False):
+    try:
+        period = pd.Period(str(value).strip())
+    except ValueError:
+        raise ValueError(f"Filter times as YYYY-MM-DD HH:MM:SS (IST), not {value!r}") from None
+    bounds = [pd.Timestamp(bound).tz_localize(IST) for bound in (period.start_time, (period + 1).start_time)]
+    if epoch_ms:
+        return [bound.value // 10**6 for bound in bounds]
+    return [bound.tz_convert("UTC").to_pydatetime() for bound in bounds]
+
+
+def _timestamp(value):
+    # Cursors keep timestamps as ISO strings; they are bound as timestamps so
+    # row comparisons don't depend on the database casting text implicitly.
+    return pd.Timestamp(value).to_pydatetime() if isinstance(value, str) else value
+
+
+def _where(filters: dict, after=None, seek=None):
+    clauses = []
+    params = {}
+    for name, value in (filters or {}).items():
+        if name == TABLE_FILTER:
+            for i, condition in enumerate(value or ()):
+                clause, clause_params = _condition_clause(condition, f"{TABLE_FILTER}_{i}")
+                clauses.append(clause)
+                params.update(clause_params)
+            continue
+        if name not in FILTERS:
+            raise ValueError(f"Unknown write history filter {name!r}")
+        if value is None or value is False:
+            continue
+        if name == "newer_than":
+            value = (_timestamp(value[0]), value[1])
+        elif name in TENANT_ID_FILTERS:
+            value = IdArray(value)
+        clauses.append(FILTERS[name])
+        if f"%({name})s" in FILTERS[name]:
+            params[name] = value
+    if after is not None:
+        column, clause = seek or ("finished_at", SEEK_CLAUSE)
+        clauses.append(clause)
+        value, params["after_id"] = after
+        params[f"after_{column}"] = _timestamp(value) if column in TIMESTAMP_COLUMNS else value
+    return clauses, params
+
+
+def _from(*fragments) -> str:
+    source = "core_master.clickhouse_write_history cwh"
+    if any("tenant." in fragment for fragment in fragments):
+        source += "\nLEFT JOIN core_master.tenant tenant ON cwh.tenant_id = tenant.id"
+    return source
+
+
+def sort_order(sort_by) -> tuple:
+    """
+    The ORDER BY for a DataTable ``sort_by``, and how to seek past a page in it.
+
+    Returns ``(order_by, seek)``. ``id`` breaks ties so the order is total.
+    ``seek`` is ``(column, clause)`` when the table is sorted on one of the
+    ``KEYSET_COLUMNS`` alone, and ``None`` when pages must be reached with
+    OFFSET. An empty ``sort_by`` is the default newest-first order.
+    """
+    if not sort_by:
+        return ORDER_BY, ("finished_at", SEEK_CLAUSE)
+    keys = []
+    for sort in sort_by:
+        column = sort["column_id"]
+        if column not in COLUMNS:
+            raise ValueError(f"Cannot sort write history by {column!r}")
+        direction = "ASC" if sort.get("direction") == "asc" else "DESC"
+        # Keyset columns keep the index's NULL ordering so it can serve the sort.
+        nulls = "" if column in KEYSET_COLUMNS else " NULLS LAST"
+        keys.append(f"{COLUMNS[column]} {direction}{nulls}")
+    if all(sort["column_id"] != "id" for sort in sort_by):
+        keys.append(f"cwh.id {direction}")
+
+    column = sort_by[0]["column_id"]
+    if len(sort_by) > 1 or column not in KEYSET_COLUMNS:
+        return ", ".join(keys), None
+    comparison = ">" if direction == "ASC" else "<"
+    if column == "id":
+        return ", ".join(keys), ("id", f"cwh.id {comparison} %(after_id)s")
+    return ", ".join(keys), (column, f"({COLUMNS[column]}, cwh.id) {comparison} (%(after_{column})s, %(after_id)s)")
+
+
+def seek_column(sort_by) -> str:
+    """The column the keyset cursors of pages in ``sort_by`` order hold, or ``None`` for OFFSET paging."""
+    seek = sort_order(sort_by)[1]
+    return seek[0] if seek else None
+
+
+def table_filters(filters: dict, filter_query: str) -> dict:
+    """
+    ``filters`` plus the conditions of a DataTable ``filter_query``.
+
+    Raises ``ValueError`` for a filter on an unknown column or one the
+    filter row could not have produced.
+    """
+    conditions = parse_filter_query(filter_query)
+    unknown = [column for column, _, _ in conditions if column not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Cannot filter write history by {unknown}")
+    if not conditions:
+        return filters
+    return {**(filters or {}), TABLE_FILTER: conditions}
+
+
+def build_select(
+    columns,
+    filters: dict = None,
+    after=None,
+    limit: int = PAGE_SIZE,
+    offset: int = 0,
+    order_by: str = ORDER_BY,
+    sort_by=None,
+):
+    """
+    Build the SELECT for one page of write history runs.
+
+    Args:
+    - columns (list): Output column names, keys of ``COLUMNS``.
+    - filters (dict): Filter name (key of ``FILTERS``) to value; ``None``/``False`` values are skipped.
+    - after (list): ``[value, id]`` keyset cursor; only rows after it are returned.
+    - limit (int): Page size; ``None`` for every matching row.
+    - offset (int): Rows to skip after the cursor.
+    - order_by (str): ORDER BY clause; the keyset cursor assumes the default.
+    - sort_by (list): DataTable ``sort_by``; replaces ``order_by`` when given, and
+      ``after`` then holds the sort column's value (see ``seek_column``).
+
+    Returns ``(query, params)``.
+    """
+    unknown = [column for column in columns if column not in COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown write history columns {unknown}")
+    seek = None
+    if sort_by:
+        order_by, seek = sort_order(sort_by)
+        if after is not None and seek is None:
+            raise ValueError("Pages sorted on a nullable column can only be reached by offset")
+    select = [f"{COLUMNS[column]} AS {column}" for column in columns]
+    clauses, params = _where(filters, after, seek)
+    query = f"SELECT {', '.join(select)}\nFROM {_from(*select, *clauses, order_by)}"
+    if clauses:
+        query += "\nWHERE " + "\nAND ".join(clauses)
+    query += f"\nORDER BY {order_by}"
+    if limit is not None:
+        query += "\nLIMIT %(limit)s OFFSET %(offset)s"
+        params.update(limit=limit, offset=offset)
+    return query, params
+
+
+def build_estimate(filters: dict = None):
+    """Build the query whose planner row estimate sizes the pager; returns ``(query, params)``."""
+    clauses, params = _where(filters)
+    query = f"SELECT 1\nFROM {_from(*clauses)}"
+    if clauses:
+        query += "\nWHERE " + "\nAND ".join(clauses)
+    return query, params
+
+
+def split_tenant_columns(columns, filters: dict = None):
+    """
+    Work out what the database must serve once the tenant directory is loaded.
+
+    Returns ``(db_columns, filters, tenant_columns)``: the tenant columns are
+    dropped from the SELECT (``tenant_id`` is added to look them up by) and
+    ``active_tenants`` becomes an exclusion of the deleted tenant ids, so the
+    query no longer needs the tenant JOIN. Table filters on tenant columns
+    are matched against the directory too and become a ``tenant_ids`` filter.
+    Before the directory has loaded, everything is left to the database.
+    """
+    directory = get_tenant_directory()
+    if not directory.loaded:
+        return list(columns), filters, []
+    tenant_columns = [column for column in columns if column in TENANT_COLUMNS]
+    db_columns = [column for column in columns if column not in TENANT_COLUMNS]
+    if tenant_columns and "tenant_id" not in db_columns:
+        db_columns.append("tenant_id")
+    if filters and filters.get("active_tenants"):
+        filters = {**filters, "active_tenants": None, "exclude_tenants": directory.deleted_ids()}
+    conditions = (filters or {}).get(TABLE_FILTER) or ()
+    tenant_conditions = [condition for condition in conditions if condition[0] in TENANT_COLUMNS]
+    if tenant_conditions:
+        filters = {
+            **filters,
+            TABLE_FILTER: [condition for condition in conditions if condition[0] not in TENANT_COLUMNS],
+            "tenant_ids": directory.matching_ids(
+                [(TENANT_COLUMNS[column], operator, value) for column, operator, value in tenant_conditions]
+            ),
+        }
+    return db_columns, filters, tenant_columns
+
+
+def add_tenant_columns(df: pd.DataFrame, columns, tenant_columns) -> pd.DataFrame:
+    """Fill ``tenant_columns`` in from the tenant directory and order ``df`` as ``columns``."""
+    if tenant_columns:
+        values = get_tenant_directory().enrich(df["tenant_id"], {TENANT_COLUMNS[c] for c in tenant_columns})
+        for column in tenant_columns:
+            df[column] = values[TENANT_COLUMNS[column]]
+    return df.reindex(columns=list(columns))
+
+
+def fetch_runs(
+    columns,
+    filters: dict = None,
+    after=None,
+    limit: int = PAGE_SIZE,
+    offset: int = 0,
+    order_by: str = ORDER_BY,
+    sort_by=None,
+    use_cache: bool = True,
+    columnar: bool = False,
+) -> pd.DataFrame:
+    """
+    Fetch one page of runs as a DataFrame with exactly ``columns``.
+
+    Timestamps are left unformatted so they can still serve as keyset cursors;
+    see ``format_datetimes``. ``columnar`` reads large batches through
+    ``execute_postgres_frame`` instead of as tuples; it is never cached.
+    """
+    db_columns, filters, tenant_columns = split_tenant_columns(columns, filters)
+    query, params = build_select(
+        db_columns, filters=filters, after=after, limit=limit, offset=offset, order_by=order_by, sort_by=sort_by
+    )
+    if reads_snapshot():
+        df = execute_snapshot_frame(query=query, params=params)
+    elif columnar:
+        df = execute_postgres_frame(query=query, params=params, tenant_id="public")
+    else:
+        names, rows = execute_postgres_query(
+            query=query,
+            params=params,
+            tenant_id="public",
+            use_cache=use_cache,
+            include_columns=True,
+        )
+        df = pd.DataFrame(rows, columns=names)
+    return add_tenant_columns(df, columns, tenant_columns)
+
+
+def fetch_new_runs(columns, after_id, limit: int, filters: dict = None) -> pd.DataFrame:
+    """
+    Fetch up to ``limit`` runs with ``id > after_id`` in id order.
+
+    Used by in-process aggregates that follow the write history from a
+    watermark; relies on ``id`` increasing with insertion order. Batches are
+    large, so they are read column-wise.
+    """
+    filters = {**(filters or {}), "after_id": after_id}
+    return fetch_runs(columns, filters=filters, limit=limit, order_by="cwh.id", use_cache=False, columnar=True)
+
+
+def fetch_runs_since(columns, cursor, limit: int, filters: dict = None) -> pd.DataFrame:
+    """
+    Fetch up to ``limit`` runs after the ``[finished_at, id]`` cursor, oldest first.
+
+    Used by live refresh to pick up the runs finished since the newest one on
+    screen. A run committed with a ``finished_at`` older than the cursor is
+    not picked up.
+    """
+    filters = {**(filters or {}), "newer_than": tuple(cursor)}
+    return fetch_runs(columns, filters=filters, limit=limit, order_by=OLDEST_FIRST, use_cache=False)
+
+
+def fetch_tenants(tenant_ids) -> pd.DataFrame:
+    """Name, base domain and contact email for ``tenant_ids``, indexed by tenant id."""
+    directory = get_tenant_directory()
+    if directory.loaded:
+        ids = pd.Series(list(tenant_ids), dtype=object)
+        values = directory.enrich(ids, ("tenant_name", "base_domain", "contact_email"))
+        return pd.DataFrame(values, index=pd.Index(ids, name="tenant_id"))
+    query = """
+    SELECT id AS tenant_id, name AS tenant_name, base_domain, contact_email
+    FROM core_master.tenant
+    WHERE id = ANY(%(ids)s)
+    """
+    params = {"ids": IdArray(tenant_ids)}
+    if reads_snapshot():
+        names, rows = execute_snapshot_query(query=query, params=params, include_columns=True)
+    else:
+        names, rows = execute_postgres_query(query=query, params=params, tenant_id="public", include_columns=True)
+    return pd.DataFrame(rows, columns=names).set_index("tenant_id")
+
+
+def bucket_width(span_seconds: float, points: int) -> int:
+    """The narrowest of ``BUCKET_WIDTHS`` that splits ``span_seconds`` into at most ``points`` buckets."""
+    for width in BUCKET_WIDTHS:
+        if span_seconds / width <= points:
+            return width
+    return BUCKET_WIDTHS[-1]
+
+
+def build_buckets(bucket_seconds: int, filters: dict = None):
+    """
+    Build the aggregation of matching runs into ``bucket_seconds`` wide buckets of ``finished_at``.
+
+    Buckets are aligned to the epoch and labelled by their start in epoch
+    seconds; empty buckets are left out. Returns ``(query, params)``.
+    """
+    clauses, params = _where(filters)
+    bucket = "floor(extract(epoch FROM cwh.finished_at) / %(bucket_seconds)s) * %(bucket_seconds)s"
+    select = [f"{bucket} AS bucket"] + [f"{expression} AS {name}" for name, expression in BUCKET_AGGREGATES.items()]
+    query = f"SELECT {', '.join(select)}\nFROM {_from(*clauses)}"
+    if clauses:
+        query += "\nWHERE " + "\nAND ".join(clauses)
+    query += "\nGROUP BY 1\nORDER BY 1"
+    params["bucket_seconds"] = bucket_seconds
+    return query, params
+
+
+def fetch_run_buckets(bucket_seconds: int, filters: dict = None) -> pd.DataFrame:
+    """
+    Runs matching ``filters`` aggregated per time bucket, oldest first.
+
+    However many runs match, at most one row per bucket is returned.
+    ``bucket`` is the bucket's start in epoch seconds.
+    """
+    _, filters, _ = split_tenant_columns([], filters)
+    query, params = build_buckets(bucket_seconds, filters)
+    if reads_snapshot():
+        df = execute_snapshot_frame(query=query, params=params)
+    else:
+        names, rows = execute_postgres_query(
+            query=query,
+            params=params,
+            tenant_id="public",
+            use_cache=True,
+            include_columns=True,
+        )
+        df = pd.DataFrame(rows, columns=names)
+    # Sums, averages and the bucket itself come back as Decimal.
+    return df.astype({name: float for name in df.columns if name != "runs"})
+
+
+def estimate_runs(filters: dict = None) -> int:
+    """Approximate number of runs matching ``filters``, from the planner (exact over the snapshot)."""
+    _, filters, _ = split_tenant_columns([], filters)
+    query, params = build_estimate(filters)
+    if reads_snapshot():
+        return count_snapshot_rows(query=query, params=params)
+    return estimate_postgres_row_count(query=query, params=params, tenant_id="public")
+
+
+def format_datetimes(df: pd.DataFrame) -> pd.DataFrame:
+    """Render whichever declared datetime columns ``df`` has as IST strings."""
+    return format_datetime_columns(
+        df,
+        columns=[column for column in TIMESTAMP_COLUMNS if column in df],
+        epoch_ms_columns=[column for column in EPOCH_MS_COLUMNS if column in df],
+    )
+
+
+def seek_position(page: int, cursors: dict):
+    """
+    Work out how to reach ``page`` from the keyset cursors seen so far.
+
+    ``cursors`` maps a page number (as a string, since it round-trips through
+    a ``dcc.Store``) to the ``[finished_at, id]`` of that page's last row.
+    Returns ``(cursor, offset)``: seek past ``cursor`` (``None`` for the start)
+    and skip ``offset`` rows. Stepping to the next or previous page always
+    finds a cursor, so ``offset`` is only non-zero when the user jumps ahead.
+    """
+    if page <= 0:
+        return None, 0
+    known = [int(p) for p in cursors if int(p) < page]
+    if not known:
+        return None, page * PAGE_SIZE
+    nearest = max(known)
+    return cursors[str(nearest)], (page - 1 - nearest) * PAGE_SIZE
+
+
+def row_cursor(df: pd.DataFrame, position: int, column: str = "finished_at") -> list:
+    """Keyset cursor ``[value, id]`` for the row at ``position``, on ``column``."""
+    value = df[column].tolist()[position]
+    if column in TIMESTAMP_COLUMNS:
+        value = pd.Timestamp(value).isoformat()
+    return [value, df["id"].tolist()[position]]
+
+
+def last_row_cursor(df: pd.DataFrame, column: str = "finished_at") -> list:
+    """Keyset cursor for the last row of a page."""
+    return row_cursor(df, -1, column)